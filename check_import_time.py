@@ -0,0 +1,65 @@
+"""
+Guards the startup time of the CLI. Every jab command imports run.py before doing
+anything, so the heavy dependencies only some commands use must not be imported
+with it.
+
+Usage: python check_import_time.py [--budget MILLISECONDS] [--runs N]
+Exits with 1 if run.py imports a forbidden module, or takes longer than the
+budget to import (median of the runs).
+"""
+
+import re
+import subprocess
+from pathlib import Path
+from statistics import median
+from sys import argv, executable, exit
+
+# Only imported by the commands that need them
+FORBIDDEN = (
+    "asyncio",
+    "github",
+    "paramiko",
+    "requests",
+    "src.containers.container_builder",
+    "src.containers.container_manager_server",
+    "src.repo.repo_manager",
+    "src.system.update",
+)
+
+root = Path(__file__).parent.absolute()
+budget = float(argv[argv.index("--budget") + 1]) if "--budget" in argv else 150.0
+runs = int(argv[argv.index("--runs") + 1]) if "--runs" in argv else 5
+
+imported = subprocess.run(
+    [executable, "-c", "import sys, run; print('\\n'.join(sys.modules))"],
+    cwd=root,
+    capture_output=True,
+    text=True,
+    check=True,
+).stdout.split()
+offenders = [
+    module
+    for module in imported
+    if any(module == name or module.startswith(f"{name}.") for name in FORBIDDEN)
+]
+
+times = []
+for _ in range(runs):
+    report = subprocess.run(
+        [executable, "-X", "importtime", "-c", "import run"],
+        cwd=root,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stderr
+    # The line of run.py itself: "import time: self | cumulative | run"
+    cumulative = re.search(r"^import time:\s*\d+ \|\s*(\d+) \| run$", report, re.M)
+    times.append(int(cumulative.group(1)) / 1000)
+
+print(f"import run: {median(times):.1f} ms (median of {runs}, budget {budget:g} ms)")
+if offenders:
+    print("Imported at startup, but only needed by some commands:")
+    for module in sorted(offenders):
+        print(f"  {module}")
+if offenders or median(times) > budget:
+    exit(1)
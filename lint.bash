@@ -1,3 +1,4 @@
 black .
 isort .
-pylint ./src/ ./src/cli ./src/containers ./src/repo ./src/system
\ No newline at end of file
+pylint ./src/ ./src/cli ./src/containers ./src/repo ./src/system
+python check_import_time.py
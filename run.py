@@ -1,17 +1,14 @@
 import logging
-import os
-import subprocess
-import sys
-import time
 import traceback
-from pathlib import Path
-from sys import argv, exit, stdin, stdout
+from sys import argv, exit, stderr, stdin, stdout
 
 from server import server_is_running
 from src.cli.cli import JabberwockyCLI
-from src.containers.container_manager_client import ContainerManagerClient
+from src.system.readiness import launch_server, server_command
 from src.system.state import frozen
-from src.system.syspath import get_server_info_file
+
+# Seconds the server gets to start listening
+SERVER_START_TIMEOUT = 10
 
 
 def main():
@@ -20,46 +17,16 @@ def main():
     logger.setLevel(logging.DEBUG)
 
     if not server_is_running():
-        if frozen():
-            target = Path(sys.executable).parent.parent / "server" / "server"
-        else:
-            target = f'"{sys.executable}" server.py'
-
-        if os.name == "nt":
-            subprocess.Popen(
-                str(target),
-                shell=True,
-                stdin=None,
-                stdout=None,
-                stderr=None,
-                creationflags=subprocess.DETACHED_PROCESS,
-            )
-        else:
-            subprocess.Popen(
-                str(target),
-                shell=True,
-                stdin=None,
-                stdout=None,
-                stderr=None,
-            )
-
-        # Wait for server to start
-        timeout = 10
-        begin = time.time()
-        while not get_server_info_file().is_file():
-            if time.time() - begin > timeout:
-                raise TimeoutError("Server took too long to start.")
-            else:
-                time.sleep(0.5)
+        launch_server(server_command(), SERVER_START_TIMEOUT)
 
-    cli = JabberwockyCLI(stdin, stdout)
+    cli = JabberwockyCLI(stdin, stdout, stderr)
     inp = argv[1:]
-    cli.parse_cmd(inp)
+    return cli.parse_cmd(inp)
 
 
 if __name__ == "__main__":
     try:
-        main()
+        exit(main())
     except Exception as ex:
         if frozen():
             traceback.print_exception(type(ex), ex, None)
@@ -1,41 +1,98 @@
 import json
-import logging
 import os
+import socket
+from contextlib import suppress
+from typing import Any, Dict
 
-import psutil
-
-from src.containers.container_manager_server import ContainerManagerServer
+from src.system.my_socket import ClientServerSocket
 from src.system.syspath import get_server_info_file, get_server_log_file
 
+# Seconds the server gets to answer the PING of server_is_running
+PING_TIMEOUT = 2.0
+
 
 def server_is_running() -> bool:
     """
-    Determines if the server is running.
+    Determines if the server is running, by pinging it. A server that does not
+    answer in time is still considered running as long as its process exists.
 
     :return: True is sever is running, False if not.
     """
     if not get_server_info_file().is_file():
         return False
 
-    with open(get_server_info_file(), "r", encoding="utf-8") as f:
-        info = json.load(f)
-        pid = info["pid"]
-        boot = info["boot"]
+    info: Dict[str, Any] = {}
+    try:
+        with open(get_server_info_file(), "r", encoding="utf-8") as f:
+            info = json.load(f)
+        if info.get("sock") and hasattr(socket, "AF_UNIX"):
+            family, address = socket.AF_UNIX, info["sock"]  # pylint: disable=no-member
+        else:
+            family, address = socket.AF_INET, (info["addr"], info["port"])
 
-    if boot > psutil.boot_time() and psutil.pid_exists(pid):
+        with socket.socket(family, socket.SOCK_STREAM) as sock:
+            sock.settimeout(PING_TIMEOUT)
+            sock.connect(address)
+            conn = ClientServerSocket(sock)
+            conn.request("PING")
+            conn.recv_response()
         return True
-    else:
+    except (ConnectionRefusedError, FileNotFoundError, ValueError, KeyError):
+        pass  # Left behind by a server that is gone
+    except OSError:
+        # Busy or hung rather than gone, unless its process exited
+        import psutil  # pylint: disable=import-outside-toplevel
+
+        if isinstance(info.get("pid"), int) and psutil.pid_exists(info["pid"]):
+            return True
+
+    with suppress(FileNotFoundError):
         os.remove(get_server_info_file())
-        return False
+    return False
 
 
 if __name__ == "__main__":
-    logging.basicConfig(filename=get_server_log_file(), filemode="w")
-    logger = logging.getLogger(__name__)
-    logger.setLevel(logging.DEBUG)
-    server = ContainerManagerServer(logger=logger)
+    import multiprocessing
+
+    # Session workers are started with the spawn method, which frozen builds need
+    multiprocessing.freeze_support()
+
+    # Imported here, as the CLI imports this module for server_is_running alone
+    from src.containers.container_manager_server import ContainerManagerServer
+    from src.containers.warm_pool import POOL_PARALLELISM
+    from src.system.server_logging import (
+        LOG_MAX_BYTES,
+        parse_levels,
+        start_server_logging,
+        stop_server_logging,
+    )
+
+    # JAB_LOG_LEVEL sets the level of the whole server (DEBUG by default), and
+    # JAB_LOG_LEVELS that of single subsystems, as in "ssh=INFO,container=WARNING".
+    # server.log is rotated once it reaches JAB_LOG_MAX_BYTES.
+    logger = start_server_logging(
+        get_server_log_file(),
+        level=os.environ.get("JAB_LOG_LEVEL", "DEBUG"),
+        levels=parse_levels(os.environ.get("JAB_LOG_LEVELS", "")),
+        max_bytes=int(os.environ.get("JAB_LOG_MAX_BYTES", LOG_MAX_BYTES)),
+    )
+
+    # Set JAB_METRICS_PORT to serve Prometheus metrics on localhost (0 = any port)
+    metrics_port = os.environ.get("JAB_METRICS_PORT")
+    # Set JAB_SESSION_WORKERS to stream run sessions and file transfers from that
+    # many worker processes, instead of from the server process (POSIX only).
+    # Set JAB_POOL_PARALLELISM to boot that many containers of the warm pool at once
+    # (see pool.json)
+    server = ContainerManagerServer(
+        logger=logger,
+        metrics_port=int(metrics_port) if metrics_port else None,
+        session_workers=int(os.environ.get("JAB_SESSION_WORKERS", "0")),
+        pool_parallelism=int(os.environ.get("JAB_POOL_PARALLELISM", POOL_PARALLELISM)),
+    )
 
     try:
         server.listen()
     except Exception as ex:
         raise ex
+    finally:
+        stop_server_logging()
@@ -2,24 +2,41 @@
 Defines the CLI that takes user input and dispatches the container manager
 """
 
+import json
 import os
 import re
+import time
+from contextlib import ExitStack
 from getpass import getpass
 from pathlib import Path
-from sys import stdin, stdout
-from typing import List
+from sys import stderr, stdin, stdout
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
 
-from github.GithubException import RateLimitExceededException
-
-import src.containers.container_builder as builder
 from src.containers.container_manager_client import ContainerManagerClient
+from src.containers.exceptions import ContainerNotStartedError, ServerError
 from src.globals import VERSION
-from src.repo.repo_manager import RepoManager
 from src.system.multithreading import InterruptibleTask, SpinningTask
 from src.system.state import frozen
-from src.system.update import get_newest_supported_version, update
+from src.system.tracing import chrome_trace, current_trace, new_trace_id, traced, tracer
+
+if TYPE_CHECKING:
+    from src.repo.repo_manager import RepoManager
+
+# Modules only needed by a few commands (the builder, the repo manager and the
+# updater, which pull in PyGithub and requests) are imported by those commands,
+# so that the other commands start quickly. See check_import_time.py.
 
 CONTAINER_NAME_REGEX = r"""\w+"""
+CONTAINER_PATTERN_REGEX = r"""[\w*?\[\]!-]+$"""
+
+# Exit codes of a captured `jab run`, besides the exit status of the command:
+# the command could not be run (bad arguments, no such container, boot failure,
+# server error)...
+RUN_FAILED = 125
+# ...or it did not exit on its own (killed by a signal, or cut short)
+RUN_NO_EXIT_STATUS = 255
+# Options of `jab run` taking a file
+RUN_FILE_OPTIONS = ("--stdout", "--stderr", "--result")
 
 
 class JabberwockyCLI:  # pylint: disable=too-many-public-methods
@@ -28,19 +45,39 @@ class JabberwockyCLI:  # pylint: disable=too-many-public-methods
     """
 
     container_manager: ContainerManagerClient
-    repo_manager: RepoManager
+    _repo_manager: Optional["RepoManager"] = None
     out_stream = stdout
     in_stream = stdin
+    err_stream = stderr
 
-    def __init__(self, in_stream=stdin, out_stream=stdout) -> None:
+    def __init__(self, in_stream=stdin, out_stream=stdout, err_stream=stderr) -> None:
         self.in_stream = in_stream
         self.out_stream = out_stream
-        self.repo_manager = RepoManager(in_stream=in_stream, out_stream=out_stream)
-        self.container_manager = ContainerManagerClient(in_stream, out_stream)
+        self.err_stream = err_stream
+        self.container_manager = ContainerManagerClient(
+            in_stream, out_stream, err_stream
+        )
+
+    @property
+    def repo_manager(self) -> "RepoManager":
+        """
+        The repo manager, created the first time a repo command needs it
+        """
+        if self._repo_manager is None:
+            from src.repo.repo_manager import (  # pylint: disable=import-outside-toplevel
+                RepoManager,
+            )
 
-    def parse_cmd(self, cmd: List[str]) -> None:
+            self._repo_manager = RepoManager(
+                in_stream=self.in_stream, out_stream=self.out_stream
+            )
+        return self._repo_manager
+
+    def parse_cmd(self, cmd: List[str]) -> Optional[int]:
         """
         Parses the cmd sent from script
+
+        :return: The exit code of the command, if it has one
         """
         subcmd_dict = {
             "help": self.help,
@@ -50,12 +87,15 @@ class JabberwockyCLI:  # pylint: disable=too-many-public-methods
             "start": self.start,
             "stop": self.stop,
             "kill": self.kill,
+            "status": self.status,
             "run": self.run,
             "send-file": self.send_file,
             "get-file": self.get_file,
             "install": self.install,
             "delete": self.delete,
             "rename": self.rename,
+            "clone": self.clone,
+            "pool": self.pool,
             "download": self.download,
             "archive": self.archive,
             "export": self.archive,
@@ -65,6 +105,13 @@ class JabberwockyCLI:  # pylint: disable=too-many-public-methods
             "create": self.create,
             "server-halt": self.server_halt,
             "ping": self.ping,
+            "stats": self.stats,
+            "profile": self.profile,
+            "trace": self.trace,
+            "events": self.events,
+            "ops": self.ops,
+            "wait": self.wait,
+            "cancel": self.cancel,
             "ssh-address": self.ssh_address,
             "update": self.update,
             "sftp": self.sftp,
@@ -91,7 +138,7 @@ class JabberwockyCLI:  # pylint: disable=too-many-public-methods
                 " a list of commands\n"
             )
             return
-        subcmd_dict[command.lower()](rest)
+        return subcmd_dict[command.lower()](rest)
 
     def version(self, cmd: List[str]) -> None:  # pylint: disable=unused-argument
         """
@@ -117,6 +164,8 @@ class JabberwockyCLI:  # pylint: disable=too-many-public-methods
 
         :param cmd: The command-line args sent
         """
+        import src.containers.container_builder as builder  # pylint: disable=import-outside-toplevel
+
         builder.make_skeleton(Path(cmd[0]) if cmd else Path.cwd())
 
     def clean(self, cmd: List[str]) -> None:
@@ -125,6 +174,8 @@ class JabberwockyCLI:  # pylint: disable=too-many-public-methods
 
         :param cmd: The command-line args sent
         """
+        import src.containers.container_builder as builder  # pylint: disable=import-outside-toplevel
+
         builder.clean(
             Path(cmd[0]) if cmd else Path.cwd(),
             self.in_stream,
@@ -138,6 +189,8 @@ class JabberwockyCLI:  # pylint: disable=too-many-public-methods
 
         :param cmd: The command-line args sent
         """
+        import src.containers.container_builder as builder  # pylint: disable=import-outside-toplevel
+
         if "--uncompressed" in cmd:
             cmd.remove("--uncompressed")
             compress = False
@@ -173,19 +226,37 @@ stop  [container_name] - Power off the virtual environment
 kill  [container_name] - Kill the virtual environment in the event of a crash
 run   [container_name] - Execute a single command in the shell.
 
+Scripting:
+run (--capture)? (--stdout file)? (--stderr file)? (--result file)?
+    [container_name] [command]...
+    - Runs a command without any interaction: it gets no input, and its output
+      is passed through as is, or written to the given files. --result writes
+      the exit status and the wall time of the command as JSON. Exits with the
+      exit status of the command, 125 if it could not be run, or 255 if it did
+      not exit on its own (killed by a signal, or cut short).
+
+Many containers at once:
+start  [container_name|pattern]... (--parallel N)?
+stop   [container_name|pattern]... (--parallel N)?
+kill   [container_name|pattern]... (--parallel N)?
+status [container_name|pattern]...
+    - Patterns are quoted globs, as in 'lab_*'. Up to N containers (8 by
+      default) are worked on at once, and each result is shown when it is done.
+      --detach only applies to a single container.
+
 Container Building:
 build-init  (directory)? - Prepare a directory for building.
 build       (directory)? - Build a container.
 build-clean (directory)? - Delete temporary files.
 
 File Transfer:
-send-file [container_name] [path_to_source] [path_to_destination]
-get-file  [container_name] [path_to_source] [path_to_destination]
+send-file [container_name] [path_to_source] [path_to_destination] (--detach)?
+get-file  [container_name] [path_to_source] [path_to_destination] (--detach)?
 
 Managing your containers:
-install [path_to_archive] [name]
+install [path_to_archive] [name] (--detach)?
     - Install a container from a tar archive.
-archive [container_name] [path_to_destination]
+archive [container_name] [path_to_destination] (--detach)?
     - Send a container to an installable tar archive.
 delete [container_name]
     - Delete a container from your system. (~/.containers)
@@ -193,6 +264,10 @@ create
     - Start the container creation process.
 rename [old_container_name] [new_container_name]
     - Rename a container in your file system
+clone [container_name] [new_container_name]
+    - Create a container sharing the disk of another (the image). The image
+      cannot be started, modified, renamed or deleted while clones of it exist
+      or it has a warm pool. Clones cannot be archived.
 update
     - Downloads and installs the newest version of the container manager tool
 version
@@ -205,8 +280,32 @@ remove-repo [URL]                - Removes a repo from the repo list
 update-repo [URL]?               - Gets what archives are in a repo (or all of them)
 
 Local server:
-server-halt   - Gracefully halts the local server
-panic         - Ungracefully stops the local server
+server-halt    - Gracefully halts the local server
+panic          - Ungracefully stops the local server
+stats --server - Shows request counts, latencies and throughput of the local server
+profile (cpu|memory)? (seconds)?
+               - Profiles the local server, 10 seconds by default
+trace [file.json] [command]
+               - Runs a command, and writes how its time was spent in the client
+                 and in the server as a Chrome trace (chrome://tracing, Perfetto)
+events [container_name|pattern]... (--only event,...)? (--json)?
+               - Shows what happens on the local server as it happens: boots,
+                 stops, crashes, sessions and file transfers. Ctrl+C to quit.
+
+Warm pool:
+    The local server can keep containers booted ahead of time for some images.
+    The first start of a clone of such an image then takes one over at once.
+pool (image=N)... - Shows the warm pool, or keeps N containers of images ready
+                    (0 to stop). Saved to ~/.containers/pool.json.
+
+Background operations:
+    Starting a container, install and archive run on the local server, and
+    show their progress until they are done. Ctrl+C cancels them; with
+    --detach, the ID of the operation is printed and it keeps running. File
+    transfers only run in the background with --detach.
+ops (--json)?   - Lists the operations running or recently finished
+wait [op_id]    - Shows the progress of an operation until it is done
+cancel [op_id]  - Cancels an operation
 """
         self.out_stream.write(help_str)
 
@@ -261,9 +360,7 @@ panic         - Ungracefully stops the local server
         if not comp.match(name):
             self.out_stream.write(f"'{name}' is not a valid container name.\n")
             return
-        if not self.container_manager.started(name):
-            self.start([name])
-        self.container_manager.run_shell(name)
+        self.container_manager.run_shell(name, self._open_session(name))
 
     def start(self, cmd: List[str]) -> None:
         """
@@ -271,16 +368,88 @@ panic         - Ungracefully stops the local server
 
         :param cmd: The rest of the command sent
         """
+        cmd, detach = self._pop_detach(cmd)
+        if self._is_batch(cmd):
+            if detach:
+                self.out_stream.write("--detach only applies to a single container.\n")
+                return
+            self._batch("START", cmd)
+            return
+
         name = cmd[0]
         comp = re.compile(CONTAINER_NAME_REGEX)
         if not comp.match(name):
             self.out_stream.write(f"'{name}' is not a valid container name.\n")
             return
 
-        task = SpinningTask(
-            f"Starting {name}", self.container_manager.start, (name,), self.out_stream
+        self._follow(
+            f"Starting {name}",
+            self.container_manager.start(name, background=True),
+            detach,
         )
-        task.exec()
+
+    def _open_session(self, name: str) -> Dict[str, Any]:
+        """
+        Boots a container if it is not running, in the same request that gets it
+        ready for a session
+
+        :param name: The name of the container
+        :return: See ContainerManagerClient.open_session
+        """
+
+        def on_boot() -> None:
+            self.out_stream.write(f"Starting {name}... ")
+            self.out_stream.flush()
+
+        session = self.container_manager.open_session(name, on_boot)
+        if session["booted"]:
+            self.out_stream.write("Done!\n")
+        return session
+
+    @staticmethod
+    def _pop_detach(cmd: List[str]) -> Tuple[List[str], bool]:
+        """
+        Takes the "--detach" option out of a command
+
+        :param cmd: The rest of the command sent
+        :return: The command without the option, and whether it was given
+        """
+        return [arg for arg in cmd if arg != "--detach"], "--detach" in cmd
+
+    def _follow(self, prompt: str, operation_id: str, detach: bool = False) -> None:
+        """
+        Shows the progress of an operation of the server until it ends. Ctrl+C
+        cancels it.
+
+        :param prompt: What the operation does
+        :param operation_id: The ID of the operation
+        :param detach: Only print the ID, and leave the operation running
+        """
+        if detach:
+            self.out_stream.write(f"{operation_id}\n")
+            return
+
+        width = 0
+
+        def show(line: str, end: str = "") -> None:
+            nonlocal width
+            self.out_stream.write(f"\r{line.ljust(width)}{end}")
+            self.out_stream.flush()
+            width = len(line)
+
+        def on_progress(snapshot: Dict[str, Any]) -> None:
+            show(f"{prompt}... {_format_progress(snapshot)}")
+
+        try:
+            self.container_manager.follow_operation(operation_id, on_progress)
+        except KeyboardInterrupt:
+            self.container_manager.cancel_operation(operation_id)
+            show(f"{prompt}... Cancelled", "\n")
+            return
+        except Exception:
+            self.out_stream.write("\r\n")
+            raise
+        show(f"{prompt}... Done!", "\n")
 
     def stop(self, cmd: List[str]) -> None:
         """
@@ -288,6 +457,10 @@ panic         - Ungracefully stops the local server
 
         :param cmd: The rest of the command sent
         """
+        if self._is_batch(cmd):
+            self._batch("STOP", cmd)
+            return
+
         name = cmd[0]
         comp = re.compile(CONTAINER_NAME_REGEX)
         if not comp.match(name):
@@ -305,6 +478,10 @@ panic         - Ungracefully stops the local server
 
         :param cmd: The rest of the command sent
         """
+        if self._is_batch(cmd):
+            self._batch("KILL", cmd)
+            return
+
         name = cmd[0]
         comp = re.compile(CONTAINER_NAME_REGEX)
         if not comp.match(name):
@@ -316,12 +493,79 @@ panic         - Ungracefully stops the local server
             self.container_manager.kill(name)
             self.out_stream.write("Done.\n")
 
-    def run(self, cmd: List[str]) -> None:
+    def status(self, cmd: List[str]) -> None:
+        """
+        Prints the state of containers, all of them by default
+
+        :param cmd: The rest of the command sent
+        """
+        self._batch("STARTED", cmd or ["*"])
+
+    @staticmethod
+    def _is_batch(cmd: List[str]) -> bool:
+        """
+        Determines whether a command applies to many containers
+
+        :param cmd: The rest of the command sent
+        :return: True if there are several names, a pattern or options
+        """
+        return len(cmd) != 1 or any(char in cmd[0] for char in "*?[")
+
+    def _batch(self, action: str, cmd: List[str]) -> None:
+        """
+        Applies an action to many containers in a single request, printing the
+        result of each container as soon as it is done
+
+        :param action: "START", "STOP", "KILL" or "STARTED"
+        :param cmd: Names of containers or patterns, and maybe "--parallel N"
+        """
+        parallel = None
+        if "--parallel" in cmd:
+            index = cmd.index("--parallel")
+            try:
+                parallel = int(cmd[index + 1])
+            except (IndexError, ValueError):
+                self.out_stream.write("--parallel requires a number.\n")
+                return
+            cmd = cmd[:index] + cmd[index + 2 :]
+
+        comp = re.compile(CONTAINER_PATTERN_REGEX)
+        for pattern in cmd:
+            if not comp.match(pattern):
+                self.out_stream.write(
+                    f"'{pattern}' is not a valid container name or pattern.\n"
+                )
+                return
+
+        def on_result(name: str, result: str) -> None:
+            self.out_stream.write(f"{name}: {result}\n")
+            self.out_stream.flush()
+
+        results = self.container_manager.batch(action, cmd, parallel, on_result)
+        if not results:
+            self.out_stream.write("No container matches.\n")
+
+    def run(self, cmd: List[str]) -> Optional[int]:
         """
         Runs a command in the container
 
         :param cmd: The rest of the command sent
+        :return: The exit code of a captured command, see RUN_FAILED
         """
+        options: Dict[str, Optional[str]] = {}
+        while cmd and cmd[0].startswith("--"):
+            if cmd[0] == "--capture":
+                options[cmd[0]] = None
+                cmd = cmd[1:]
+            elif cmd[0] in RUN_FILE_OPTIONS and len(cmd) > 1:
+                options[cmd[0]] = cmd[1]
+                cmd = cmd[2:]
+            else:
+                self.err_stream.write(f"Invalid option '{cmd[0]}'\n")
+                return RUN_FAILED
+        if options:
+            return self._run_captured(cmd, options)
+
         if len(cmd) < 2:
             self.out_stream.write("Command requires two arguments\n")
             return
@@ -332,18 +576,73 @@ panic         - Ungracefully stops the local server
                 f"'{container_name}' is not a valid container name.\n"
             )
             return
-        if not self.container_manager.started(container_name):
-            self.start([container_name])
+        self._open_session(container_name)
         InterruptibleTask(
             self.container_manager.run_command, (container_name, command)
         ).exec()
 
+    def _run_captured(self, cmd: List[str], options: Dict[str, Optional[str]]) -> int:
+        """
+        Runs a command without any interaction, booting the container if needed
+
+        :param cmd: The container, then the command
+        :param options: The options of `jab run`, and their files
+        :return: The exit status of the command, or RUN_FAILED or
+                 RUN_NO_EXIT_STATUS
+        """
+        began = time.monotonic()
+        result: Dict[str, Any] = {"exit_status": None}
+        try:
+            if len(cmd) < 2:
+                raise ValueError("Command requires two arguments")
+            container_name, command = cmd[0], cmd[1:]
+            if not re.match(CONTAINER_NAME_REGEX, container_name):
+                raise ValueError(f"'{container_name}' is not a valid container name")
+
+            with ExitStack() as stack:
+                sinks = {
+                    option: stack.enter_context(open(path, "wb"))
+                    for option, path in options.items()
+                    if option in ("--stdout", "--stderr")
+                }
+                try:
+                    result = self.container_manager.capture_command(
+                        container_name,
+                        command,
+                        sinks.get("--stdout"),
+                        sinks.get("--stderr"),
+                    )
+                except ContainerNotStartedError:
+                    # Only booted on demand, so running on a running container
+                    # takes a single request
+                    self.container_manager.start(container_name)
+                    result = self.container_manager.capture_command(
+                        container_name,
+                        command,
+                        sinks.get("--stdout"),
+                        sinks.get("--stderr"),
+                    )
+        except (ValueError, OSError, ServerError) as ex:
+            self.err_stream.write(f"jab: {ex}\n")
+            result["error"] = str(ex)
+            code = RUN_FAILED
+        else:
+            exit_status = result["exit_status"]
+            code = RUN_NO_EXIT_STATUS if exit_status is None else exit_status
+
+        if options.get("--result"):
+            result["seconds"] = time.monotonic() - began
+            with open(options["--result"], "w", encoding="utf-8") as f:
+                json.dump({**result, "exit_code": code}, f)
+        return code
+
     def send_file(self, cmd: List[str]) -> None:
         """
         Sends a file to a container
 
         :param cmd: The rest of the command sent
         """
+        cmd, detach = self._pop_detach(cmd)
         if len(cmd) < 2:
             self.out_stream.write("Command requires two or three arguments\n")
             return
@@ -358,10 +657,19 @@ panic         - Ungracefully stops the local server
                 f"'{container_name}' is not a valid container name.\n"
             )
             return
-        if not self.container_manager.started(container_name):
-            self.start([container_name])
+        self._open_session(container_name)
 
         string = f"Copying '{local_file}' -> '{remote_file if remote_file else '~'}'"
+        if detach:
+            self._follow(
+                string,
+                self.container_manager.put_file(
+                    container_name, local_file, remote_file, background=True
+                ),
+                detach,
+            )
+            return
+        # In the foreground, the file is opened here and handed to the server
         task = SpinningTask(
             string,
             self.container_manager.put_file,
@@ -375,6 +683,7 @@ panic         - Ungracefully stops the local server
 
         :param cmd: The rest of the command sent
         """
+        cmd, detach = self._pop_detach(cmd)
         if len(cmd) < 2:
             self.out_stream.write("Command requires two or three arguments\n")
             return
@@ -389,10 +698,18 @@ panic         - Ungracefully stops the local server
                 f"'{container_name}' is not a valid container name.\n"
             )
             return
-        if not self.container_manager.started(container_name):
-            self.start([container_name])
+        self._open_session(container_name)
 
         string = f"Copying '{remote_file}' -> '{local_file if local_file else '.'}'"
+        if detach:
+            self._follow(
+                string,
+                self.container_manager.get_file(
+                    container_name, remote_file, local_file, background=True
+                ),
+                detach,
+            )
+            return
         task = SpinningTask(
             string,
             self.container_manager.get_file,
@@ -406,6 +723,7 @@ panic         - Ungracefully stops the local server
 
         :param cmd: The rest of the command sent
         """
+        cmd, detach = self._pop_detach(cmd)
         if len(cmd) != 2:
             self.out_stream.write("Command requires two arguments\n")
             return
@@ -416,12 +734,13 @@ panic         - Ungracefully stops the local server
                 f"'{container_name}' is not a valid container name.\n"
             )
             return
-        task = SpinningTask(
-            f"Installing {container_name}. This may take several minutes",
-            self.container_manager.install,
-            (archive_path_str, container_name),
+        self._follow(
+            f"Installing {container_name}",
+            self.container_manager.install(
+                archive_path_str, container_name, background=True
+            ),
+            detach,
         )
-        task.exec()
 
     def delete(self, cmd: List[str]) -> None:
         """
@@ -472,6 +791,50 @@ panic         - Ungracefully stops the local server
 
         self.container_manager.rename(old_name, new_name)
 
+    def clone(self, cmd: List[str]) -> None:
+        """
+        Creates a container sharing the disk of another
+
+        :param cmd: The rest of the command sent
+        """
+        if len(cmd) != 2:
+            self.out_stream.write("Command requires two arguments\n")
+            return
+
+        image, new_name = cmd[0], cmd[1]
+        comp = re.compile(CONTAINER_NAME_REGEX)
+        if not comp.match(image):
+            self.out_stream.write(f"'{image}' is not a valid container name.\n")
+            return
+        if not comp.match(new_name):
+            self.out_stream.write(f"'{new_name}' is not a valid container name.\n")
+            return
+
+        self.container_manager.clone(image, new_name)
+
+    def pool(self, cmd: List[str]) -> None:
+        """
+        Prints the warm pool of the server, once resized if sizes are given
+
+        :param cmd: Sizes, as in "lab=4"
+        """
+        sizes = {}
+        for arg in cmd:
+            image, _, size = arg.partition("=")
+            if not re.fullmatch(CONTAINER_NAME_REGEX, image) or not size.isdigit():
+                self.out_stream.write(f"'{arg}' is not of the form image=size.\n")
+                return
+            sizes[image] = int(size)
+
+        pool = self.container_manager.pool(sizes or None)
+        if not pool:
+            self.out_stream.write("The warm pool is empty.\n")
+        for image, state in pool.items():
+            self.out_stream.write(
+                f"{image}: {state['ready']}/{state['size']} ready, "
+                f"{state['booting']} booting\n"
+            )
+
     def download(self, cmd: List[str]) -> None:  # pylint: disable=unused-argument
         """
         Downloads a container from an archive
@@ -499,6 +862,7 @@ panic         - Ungracefully stops the local server
 
         :param cmd: The rest of the command sent
         """
+        cmd, detach = self._pop_detach(cmd)
         if len(cmd) == 0:
             self.out_stream.write("Command requires at leas one argument\n")
             return
@@ -511,12 +875,13 @@ panic         - Ungracefully stops the local server
             self.out_stream.write(f"'{container_name}' is not a valid container name\n")
             return
 
-        task = SpinningTask(
-            f"Exporting {container_name}. This will take a long time",
-            self.container_manager.archive,
-            (container_name, path_to_destination),
+        self._follow(
+            f"Exporting {container_name}",
+            self.container_manager.archive(
+                container_name, path_to_destination, background=True
+            ),
+            detach,
         )
-        task.exec()
 
     def upload(self, cmd: List[str]) -> None:
         """
@@ -589,7 +954,9 @@ panic         - Ungracefully stops the local server
 
         :param cmd: The rest of the command sent
         """
-        self.container_manager.server_halt()
+        results = self.container_manager.server_halt()
+        for name, result in sorted(results.items()):
+            self.out_stream.write(f"{name}: {result}\n")
 
     def server_panic(self, cmd: List[str]) -> None:  # pylint: disable=unused-argument
         """
@@ -605,8 +972,181 @@ panic         - Ungracefully stops the local server
 
         :param cmd: The rest of the command sent
         """
-        time = self.container_manager.ping()
-        self.out_stream.write(f"Got OK in {time:.5f} seconds.\n")
+        seconds = self.container_manager.ping()
+        self.out_stream.write(f"Got OK in {seconds:.5f} seconds.\n")
+
+    def stats(self, cmd: List[str]) -> None:
+        """
+        Prints the metrics of the server
+
+        :param cmd: The rest of the command sent
+        """
+        if cmd not in ([], ["--server"]):
+            self.out_stream.write("Usage: stats --server\n")
+            return
+
+        stats = self.container_manager.stats()
+        gauges = stats["gauges"]
+        self.out_stream.write(
+            f"Uptime: {stats['uptime']:.0f} seconds\n"
+            f"Containers: {gauges['containers_running']} running, "
+            f"{gauges['containers_booting']} booting, "
+            f"{gauges['containers_pooled']} ready in the warm pool\n"
+            f"Connections: {gauges['connections']}, "
+            f"sessions: {gauges['sessions']}\n"
+        )
+
+        boots = stats["boot_duration"]
+        if boots["count"]:
+            self.out_stream.write(
+                f"Boots: {boots['count']}, "
+                f"{boots['sum'] / boots['count']:.1f} seconds on average\n"
+            )
+
+        self.out_stream.write("Requests:\n")
+        for op, latency in sorted(stats["latency"].items()):
+            self.out_stream.write(
+                f"  {op:<15} {stats['requests'][op]:>8} requests "
+                f"{stats['errors'].get(op, 0):>6} errors "
+                f"{1000 * latency['sum'] / latency['count']:>10.2f} ms on average\n"
+            )
+
+        if stats["bytes_streamed"]:
+            self.out_stream.write("Bytes streamed:\n")
+            for direction, size in sorted(stats["bytes_streamed"].items()):
+                self.out_stream.write(f"  {direction:<15} {size:>14}\n")
+
+    def profile(self, cmd: List[str]) -> None:
+        """
+        Profiles the server, and prints where the results were written
+
+        :param cmd: The rest of the command sent
+        """
+        mode = cmd[0] if cmd else "cpu"
+        if mode not in ("cpu", "memory") or len(cmd) > 2:
+            self.out_stream.write("Usage: profile (cpu|memory)? (seconds)?\n")
+            return
+        try:
+            seconds = float(cmd[1]) if len(cmd) > 1 else 10.0
+        except ValueError:
+            self.out_stream.write(f"'{cmd[1]}' is not a number of seconds.\n")
+            return
+
+        self.out_stream.write(f"Profiling the server for {seconds:g} seconds...\n")
+        self.out_stream.flush()
+        for path in self.container_manager.profile(mode, seconds):
+            self.out_stream.write(f"{path}\n")
+
+    def trace(self, cmd: List[str]) -> None:
+        """
+        Runs a command under a single trace, then writes the spans recorded by the
+        client and by the server for it
+
+        :param cmd: The rest of the command sent
+        """
+        if len(cmd) < 2:
+            self.out_stream.write("Usage: trace [file.json] [command]\n")
+            return
+        path, command = cmd[0], cmd[1:]
+
+        trace_id = new_trace_id()
+        token = current_trace.set(trace_id)
+        try:
+            with traced(f"jab {command[0]}", args=" ".join(command[1:])):
+                self.parse_cmd(command)
+        finally:
+            current_trace.reset(token)
+
+        events = tracer.export(trace_id) + self.container_manager.trace(trace_id)
+        with open(path, "w", encoding="utf-8") as trace_file:
+            json.dump(chrome_trace(events), trace_file)
+        self.out_stream.write(f"Trace {trace_id} written to {path}\n")
+
+    def events(self, cmd: List[str]) -> None:
+        """
+        Prints the events of the server as they happen, until interrupted
+
+        :param cmd: Names of containers or patterns, and maybe "--json" and
+                    "--only kind,kind"
+        """
+        as_json = "--json" in cmd
+        cmd = [arg for arg in cmd if arg != "--json"]
+        kinds = None
+        if "--only" in cmd:
+            index = cmd.index("--only")
+            if index + 1 == len(cmd):
+                self.out_stream.write("--only requires a list of events.\n")
+                return
+            kinds = cmd[index + 1].split(",")
+            cmd = cmd[:index] + cmd[index + 2 :]
+
+        comp = re.compile(CONTAINER_PATTERN_REGEX)
+        for pattern in cmd:
+            if not comp.match(pattern):
+                self.out_stream.write(
+                    f"'{pattern}' is not a valid container name or pattern.\n"
+                )
+                return
+
+        try:
+            for event in self.container_manager.subscribe(cmd or None, kinds):
+                if as_json:
+                    self.out_stream.write(json.dumps(event) + "\n")
+                else:
+                    self.out_stream.write(_format_event(event) + "\n")
+                self.out_stream.flush()
+        except KeyboardInterrupt:
+            pass
+        except ConnectionError:
+            self.out_stream.write("The server stopped.\n")
+
+    def ops(self, cmd: List[str]) -> None:
+        """
+        Prints the operations of the server, running or recently finished
+
+        :param cmd: Maybe "--json"
+        """
+        operations = self.container_manager.operations()
+        if "--json" in cmd:
+            self.out_stream.write(json.dumps(operations, indent=2) + "\n")
+            return
+        if not operations:
+            self.out_stream.write("No operations.\n")
+        for snapshot in operations:
+            line = (
+                f"{snapshot['id']} {snapshot['op']} {snapshot['container'] or '-'} "
+                f"{snapshot['state']} {_format_progress(snapshot)}"
+            )
+            if "error" in snapshot:
+                line += f" error={snapshot['error']}"
+            self.out_stream.write(line + "\n")
+
+    def wait(self, cmd: List[str]) -> None:
+        """
+        Shows the progress of an operation of the server until it ends
+
+        :param cmd: The ID of the operation
+        """
+        if len(cmd) != 1:
+            self.out_stream.write("Command requires one argument\n")
+            return
+        snapshot = self.container_manager.operation(cmd[0])
+        self._follow(f"{snapshot['id']} {snapshot['op']}", snapshot["id"])
+
+    def cancel(self, cmd: List[str]) -> None:
+        """
+        Cancels an operation of the server
+
+        :param cmd: The ID of the operation
+        """
+        if len(cmd) != 1:
+            self.out_stream.write("Command requires one argument\n")
+            return
+        snapshot = self.container_manager.cancel_operation(cmd[0])
+        if snapshot["state"] == "running":
+            self.out_stream.write(f"Cancelling {snapshot['id']}.\n")
+        else:
+            self.out_stream.write(f"{snapshot['id']} is already {snapshot['state']}.\n")
 
     def ssh_address(self, cmd: List[str]) -> None:  # pylint: disable=unused-argument
         """
@@ -631,6 +1171,11 @@ panic         - Ungracefully stops the local server
 
         :param cmd: The rest of the command sent
         """
+        # pylint: disable=import-outside-toplevel
+        from github.GithubException import RateLimitExceededException
+
+        from src.system.update import get_newest_supported_version, update
+
         try:
             release, asset = get_newest_supported_version()
         except RateLimitExceededException:
@@ -655,3 +1200,51 @@ panic         - Ungracefully stops the local server
                 self.out_stream.write("Update cancelled.")
             else:
                 update(release, asset)
+
+
+def _format_progress(snapshot: Dict[str, Any]) -> str:
+    """
+    Formats the progress of an operation of the server for people
+
+    :param snapshot: The state of the operation, see ContainerManagerClient.operation
+    :return: The bytes processed, the throughput, the phase and the time elapsed
+    """
+    mib = 1 << 20
+    parts = []
+    if snapshot["total"]:
+        parts.append(
+            f"{100 * snapshot['done'] // snapshot['total']}% "
+            f"{snapshot['done'] / mib:.1f}/{snapshot['total'] / mib:.1f} MiB"
+        )
+    elif snapshot["done"]:
+        parts.append(f"{snapshot['done'] / mib:.1f} MiB")
+    if snapshot["rate"]:
+        parts.append(f"{snapshot['rate'] / mib:.1f} MiB/s")
+    if snapshot["phase"]:
+        parts.append(snapshot["phase"])
+    parts.append(f"{snapshot['elapsed']:.0f}s")
+    return " ".join(parts)
+
+
+def _format_event(event: Dict[str, Any]) -> str:
+    """
+    Formats an event of the server for people
+
+    :param event: The event, see ContainerManagerClient.subscribe
+    :return: A line describing the event
+    """
+    details = {
+        key: value
+        for key, value in event.items()
+        if key not in ("event", "time", "container", "id")
+    }
+    line = time.strftime("%H:%M:%S", time.localtime(event["time"]))
+    line += f" {event.get('container', '-')} {event['event']}"
+    if event["event"] == "transfer" and event.get("total"):
+        line += (
+            f" {event['direction']} {event['path']} "
+            f"{event['done']}/{event['total']} bytes"
+        )
+    elif details:
+        line += " " + " ".join(f"{key}={value}" for key, value in details.items())
+    return line
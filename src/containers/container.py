@@ -4,19 +4,49 @@ Manages the individual container objects
 
 import json
 import logging
+import os
+import shutil
+import socket
+import subprocess
+import time
+from contextlib import suppress
 from io import BytesIO
 from pathlib import Path
 from signal import SIGABRT
-from typing import List, Optional, Tuple, Union
+from typing import BinaryIO, Callable, ContextManager, List, Optional, Tuple, Union
 
+import paramiko
 import psutil
 from paramiko.channel import ChannelFile, ChannelStderrFile, ChannelStdinFile
 from pexpect import ExceptionPexpect, popen_spawn
 
 from src.containers.container_config import ContainerConfig
-from src.containers.exceptions import PortAllocationError, gen_boot_exception
+from src.containers.container_extras import create_overlay
+from src.containers.exceptions import (
+    BootFailure,
+    PortAllocationError,
+    gen_boot_exception,
+)
 from src.containers.port_allocation import allocate_port
 from src.system import ssh, syspath
+from src.system.server_logging import subsystem_logger
+from src.system.tracing import span
+
+# Name of the snapshot holding the state restored by warm starts
+WARM_SNAPSHOT = "jab-warm"
+# Seconds a warm start waits for SSH to answer before booting instead
+WARM_START_TIMEOUT = 30
+# Seconds between two attempts to connect to a container being restored
+WARM_START_POLL_INTERVAL = 0.2
+# Seconds the monitor gets to save the state of the machine
+SAVEVM_TIMEOUT = 300
+# Seconds QEMU gets to exit once killed
+ABORT_TIMEOUT = 10
+MONITOR_PROMPT = b"(qemu) "
+# Keys used for the SSH, written by update_hostkey
+KEY_FILES = ("id_rsa", "id_rsa.pub")
+# Files handed over to a clone along with a running container, see move_to
+MOVED_FILES = ("hdd.qcow2", "id_rsa", "id_rsa.pub", "pexpect.log", "warmstart.json")
 
 
 class Container(ContainerConfig):  # pylint: disable=abstract-method
@@ -25,12 +55,19 @@ class Container(ContainerConfig):  # pylint: disable=abstract-method
 
     :param booter: Popen that stores the boot of the instance
     :param ex_port: The ssh port of the system
+    :param monitor_port: The port of the QEMU monitor, with warmstart set
+    :param warm_state_path: Exists once the state of the machine was saved
+    :param directory: The folder of the container. Containers of the warm pool
+                      live outside of the folder of installed containers.
     :param arch: The arch of the container
     """
 
     logger: logging.Logger
     booter: Optional[popen_spawn.PopenSpawn] = None
     ex_port: int
+    monitor_port: Optional[int] = None
+    warm_state_path: Path
+    directory: Path
     name: str
     sshi: ssh.SSHInterface
     timeout: int = 60 * 5
@@ -38,37 +75,102 @@ class Container(ContainerConfig):  # pylint: disable=abstract-method
     logging_file_path: Path
     logging_file: BytesIO
 
-    def __init__(self, name: str, logger: logging.Logger) -> None:
-        if not syspath.get_container_dir(name).is_dir():
-            raise FileNotFoundError(syspath.get_container_dir(name))
-        if not syspath.get_container_config(name).is_file():
-            raise FileNotFoundError(syspath.get_container_config(name))
+    def __init__(
+        self, name: str, logger: logging.Logger, directory: Optional[Path] = None
+    ) -> None:
+        directory = directory or syspath.get_container_dir(name)
+        if not directory.is_dir():
+            raise FileNotFoundError(directory)
+        if not (directory / "config.json").is_file():
+            raise FileNotFoundError(directory / "config.json")
 
-        self.logging_file_path = syspath.get_container_dir(name) / "pexpect.log"
         self.name = name
-        self.logger = logger
+        self._set_directory(directory)
+        self.logger = subsystem_logger(logger, "container")
 
-        with open(
-            syspath.get_container_config(name), "r", encoding="utf-8"
-        ) as config_file:
+        with open(directory / "config.json", "r", encoding="utf-8") as config_file:
             super().__init__(json.load(config_file))
 
-    def start(self) -> None:
+    def _set_directory(self, directory: Path) -> None:
+        self.directory = directory
+        self.logging_file_path = directory / "pexpect.log"
+        self.warm_state_path = directory / "warmstart.json"
+
+    def start(self, on_phase: Optional[Callable[[str], None]] = None) -> None:
         """
-        Starts a container
+        Starts a container. With warmstart set, the state saved after its first
+        boot is restored instead, and the container is booted if that fails.
+
+        :param on_phase: Called with the name of each phase of the boot as it begins
         """
+
+        def phase(name: str, **args):
+            if on_phase is not None:
+                on_phase(name)
+            return span(name, container=self.name, **args)
+
         self.logging_file = open(  # pylint: disable=consider-using-with
             self.logging_file_path, "wb"
         )
-        for _ in range(self.max_retries):
-            self.ex_port = allocate_port()
+        if self.image is not None and not (self.directory / "hdd.qcow2").is_file():
+            with phase("create_overlay"):
+                create_overlay(self.image, self.directory)
+
+        if self.warmstart and self.warm_state_path.is_file():
+            try:
+                self._restore(phase)
+            except BootFailure as exc:
+                self.logger.warning(
+                    "Could not restore %s, booting it instead: %s", self.name, exc
+                )
+                self.warm_state_path.unlink()
+            else:
+                # The key authorized in the machine was saved along with its state
+                if not all((self.directory / f).is_file() for f in KEY_FILES):
+                    with phase("update_hostkey"):
+                        self.sshi.update_hostkey()
+                    with phase("savevm"):
+                        self._save_warm_state()
+                return
+
+        self._boot(phase)
+        self.sshi = ssh.SSHInterface(
+            "127.0.0.1",
+            self.username,
+            self.ex_port,
+            self.password,
+            self.name,
+            self.logger,
+            self.directory,
+        )
+        with phase("ssh_connect"):
+            self.sshi.open_all()
+        with phase("update_hostkey"):
+            self.sshi.update_hostkey()
+        if self.warmstart:
+            with phase("savevm"):
+                self._save_warm_state()
+
+    def _boot(self, phase: Callable[..., ContextManager]) -> None:
+        """
+        Boots QEMU, and waits for the login prompt on the console
+
+        :param phase: Wraps each phase of the boot
+        """
+        for attempt in range(self.max_retries):
+            with phase("allocate_port", attempt=attempt):
+                self._allocate_ports()
             cmd = self._generate_start_cmd()
-            self.logger.debug(f"Executing {cmd}")
-            self.booter = popen_spawn.PopenSpawn(
-                cmd, logfile=self.logging_file, cwd=syspath.get_container_dir(self.name)
-            )
+            self.logger.debug("Executing %s", cmd)
+            with phase("qemu_spawn", port=self.ex_port):
+                self.booter = popen_spawn.PopenSpawn(
+                    cmd,
+                    logfile=self.logging_file,
+                    cwd=self.directory,
+                )
             try:
-                self.booter.expect(f"{self.hostname} login: ", timeout=self.timeout)
+                with phase("console_login"):
+                    self.booter.expect(f"{self.hostname} login: ", timeout=self.timeout)
             except ExceptionPexpect as exc:
                 my_exc = gen_boot_exception(exc, self.logging_file_path)
                 if not isinstance(my_exc, PortAllocationError):
@@ -78,6 +180,25 @@ class Container(ContainerConfig):  # pylint: disable=abstract-method
         else:
             raise PortAllocationError
 
+    def _restore(self, phase: Callable[..., ContextManager]) -> None:
+        """
+        Starts QEMU from the state saved by _save_warm_state, and connects to the
+        container once its SSH server answers. Raises BootFailure if QEMU exits or
+        SSH does not answer within WARM_START_TIMEOUT; QEMU is then killed.
+
+        :param phase: Wraps each phase of the boot
+        """
+        with phase("allocate_port"):
+            self._allocate_ports()
+        cmd = self._generate_start_cmd(restore=True)
+        self.logger.debug("Executing %s", cmd)
+        with phase("qemu_spawn", port=self.ex_port, restore=True):
+            self.booter = popen_spawn.PopenSpawn(
+                cmd,
+                logfile=self.logging_file,
+                cwd=self.directory,
+            )
+
         self.sshi = ssh.SSHInterface(
             "127.0.0.1",
             self.username,
@@ -85,9 +206,96 @@ class Container(ContainerConfig):  # pylint: disable=abstract-method
             self.password,
             self.name,
             self.logger,
+            self.directory,
         )
-        self.sshi.open_all()
-        self.sshi.update_hostkey()
+        # There is no login prompt on the console this time, as the machine is
+        # restored past it
+        with phase("ssh_connect", restore=True):
+            deadline = time.monotonic() + WARM_START_TIMEOUT
+            while True:
+                # Checked first, as paramiko logs every failed attempt at length
+                if _ssh_answers(self.ex_port):
+                    try:
+                        self.sshi.open_all()
+                        return
+                    except (paramiko.SSHException, OSError, EOFError):
+                        self.sshi.ssh_client.close()
+                if self.exited() or time.monotonic() > deadline:
+                    self._abort()
+                    raise BootFailure(str(self.logging_file_path))
+                time.sleep(WARM_START_POLL_INTERVAL)
+
+    def _save_warm_state(self) -> None:
+        """
+        Saves the state of the machine through the QEMU monitor, for _restore.
+        The container keeps running if it cannot be saved.
+        """
+        try:
+            output = self._monitor(f"savevm {WARM_SNAPSHOT}", SAVEVM_TIMEOUT)
+        except OSError as exc:
+            self.logger.warning("Could not save the state of %s: %r", self.name, exc)
+            return
+        if "Error" in output:
+            self.logger.warning(
+                "Could not save the state of %s: %s", self.name, output.strip()
+            )
+            return
+
+        with open(self.warm_state_path, "w", encoding="utf-8") as file:
+            json.dump({"snapshot": WARM_SNAPSHOT, "saved": time.time()}, file)
+        self.logger.debug("Saved the state of %s", self.name)
+
+    def _monitor(self, command: str, timeout: float) -> str:
+        """
+        Runs a command on the QEMU monitor. Raises OSError if the monitor does not
+        answer within timeout seconds.
+
+        :param command: The command
+        :param timeout: Seconds the command gets to complete
+        :return: What the monitor printed in response
+        """
+        with socket.create_connection(
+            ("127.0.0.1", self.monitor_port), timeout=timeout
+        ) as sock:
+            _read_until(sock, MONITOR_PROMPT)
+            sock.sendall(f"{command}\n".encode())
+            return _read_until(sock, MONITOR_PROMPT).decode("utf-8", "replace")
+
+    def _allocate_ports(self) -> None:
+        """
+        Allocates the port forwarded to SSH, and the port of the monitor if needed
+        """
+        self.ex_port = allocate_port()
+        if self.warmstart:
+            self.monitor_port = allocate_port(self.ex_port + 1)
+
+    def _abort(self) -> None:
+        """
+        Kills QEMU if it is still running, and waits for it to exit so that it lets
+        go of the disk
+        """
+        if not self.exited():
+            self.booter.kill(SIGABRT)
+            with suppress(subprocess.TimeoutExpired):
+                self.booter.proc.wait(ABORT_TIMEOUT)
+
+    def move_to(self, name: str) -> None:
+        """
+        Hands a running container over to a clone that was never started, by
+        moving its disk, keys and logs into the folder of the clone. QEMU keeps
+        the files open, so it does not notice.
+
+        :param name: The name of the clone
+        """
+        directory = syspath.get_container_dir(name)
+        for file in MOVED_FILES:
+            if (self.directory / file).exists():
+                os.replace(self.directory / file, directory / file)
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.name = name
+        self._set_directory(directory)
+        self.sshi.container_name = name
+        self.sshi.key_dir = directory
 
     def run(
         self, cmd: List[str]
@@ -99,23 +307,67 @@ class Container(ContainerConfig):  # pylint: disable=abstract-method
         """
         return self.sshi.exec_ssh_command(cmd)
 
-    def get(self, remote_file_path: str, local_file_path: str):
+    def get(
+        self,
+        remote_file_path: str,
+        local_file_path: str,
+        callback: Optional[Callable[[int, int], None]] = None,
+    ):
         """
         Gets a file from the container
 
         :param remote_file_path: Path to remote file to grab from container
         :param local_file_path: Local path to store file
+        :param callback: Called with the bytes transferred so far and the total
         """
-        self.sshi.get(remote_file_path, local_file_path)
+        self.sshi.get(remote_file_path, local_file_path, callback)
 
-    def put(self, local_file_path: str, remote_file_path: str):
+    def put(
+        self,
+        local_file_path: str,
+        remote_file_path: str,
+        callback: Optional[Callable[[int, int], None]] = None,
+    ):
         """
         Sends a file to the container
 
         :param local_file_path: Path to the local file to send to the container
         :param remote_file_path: Remote path to store file
+        :param callback: Called with the bytes transferred so far and the total
+        """
+        self.sshi.put(local_file_path, remote_file_path, callback)
+
+    def getfo(
+        self,
+        remote_file_path: str,
+        fileobj: BinaryIO,
+        callback: Optional[Callable[[int, int], None]] = None,
+    ):
+        """
+        Gets a file from the container into an open file
+
+        :param remote_file_path: Path to remote file to grab from container
+        :param fileobj: Open local file to write to
+        :param callback: Called with the bytes transferred so far and the total
+        """
+        self.sshi.getfo(remote_file_path, fileobj, callback)
+
+    def putfo(
+        self,
+        fileobj: BinaryIO,
+        local_file_path: str,
+        remote_file_path: str,
+        callback: Optional[Callable[[int, int], None]] = None,
+    ):
+        """
+        Sends the contents of an open file to the container
+
+        :param fileobj: Open local file to read from
+        :param local_file_path: Path of the local file
+        :param remote_file_path: Remote path to store file
+        :param callback: Called with the bytes transferred so far and the total
         """
-        self.sshi.put(local_file_path, remote_file_path)
+        self.sshi.putfo(fileobj, local_file_path, remote_file_path, callback)
 
     def stop(self) -> None:
         """
@@ -134,10 +386,25 @@ class Container(ContainerConfig):  # pylint: disable=abstract-method
         self.sshi.close_all()
         self.logging_file.close()
 
-    def _generate_start_cmd(self) -> List[Union[str, Path]]:
+    def exited(self) -> bool:
+        """
+        :return: Whether the QEMU process of the container exited on its own
+        """
+        return self.booter is not None and self.booter.proc.poll() is not None
+
+    def release(self) -> None:
+        """
+        Closes the connections and files of a container whose QEMU process exited.
+        Does not signal the process, as its PID may already belong to another one.
+        """
+        self.sshi.close_all()
+        self.logging_file.close()
+
+    def _generate_start_cmd(self, restore: bool = False) -> List[Union[str, Path]]:
         """
         Build command-line from ContainerConfig file for QEMU system
 
+        :param restore: Start from the state saved by _save_warm_state
         :return: The cmd command to start qemu
         """
 
@@ -193,12 +460,50 @@ class Container(ContainerConfig):  # pylint: disable=abstract-method
             "-smp",
             "1",
             "-monitor",
-            "null",
+            (
+                f"tcp:127.0.0.1:{self.monitor_port},server,nowait"
+                if self.warmstart
+                else "null"
+            ),
             "-net",
             "nic",
             "-nographic",
             "-drive",
-            "file=hdd.qcow2,format=qcow2",
+            # The disk of the image a clone runs on is shared with its other clones
+            "file=hdd.qcow2,format=qcow2"
+            + (",backing.read-only=on" if self.image is not None else ""),
             "-net",
             hostfwd,
+            *(["-loadvm", WARM_SNAPSHOT] if restore else []),
         ]
+
+
+def _read_until(sock: socket.socket, marker: bytes) -> bytes:
+    """
+    Receives from a socket until what was received ends with marker
+
+    :param sock: The socket
+    :param marker: The end of the data
+    :return: The data received, marker included
+    """
+    data = b""
+    while not data.endswith(marker):
+        chunk = sock.recv(4096)
+        if not chunk:
+            raise ConnectionError("The QEMU monitor closed the connection")
+        data += chunk
+    return data
+
+
+def _ssh_answers(port: int) -> bool:
+    """
+    Checks whether an SSH server answers on a local port. Connecting succeeds as
+    soon as QEMU forwards the port, so this waits for the banner of the server.
+
+    :param port: The port
+    """
+    try:
+        with socket.create_connection(("127.0.0.1", port), timeout=1) as sock:
+            return sock.recv(4) == b"SSH-"
+    except OSError:
+        return False
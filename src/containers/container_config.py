@@ -3,10 +3,9 @@ Manages the configuration of the container manager
 """
 
 import re
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional
 
-from src.containers.exceptions import (InvalidConfigError,
-                                       UnsupportedLegacyConfigError)
+from src.containers.exceptions import InvalidConfigError, UnsupportedLegacyConfigError
 from src.globals import MANIFEST_VERSION, SUPPORTED_ARCHS
 
 _LEGACY_CT_CONFIG = {
@@ -27,6 +26,14 @@ class ContainerConfig:
     :param password: The password of root on the container
     :param portfwd: ?
     :param legacy: ?
+    :param warmstart: Whether the state of the machine is saved once it first
+                      booted, and restored by later starts instead of booting.
+                      Restoring it also reverts the disk to that point, so any
+                      change made to the container after its first boot is lost
+                      on the next start.
+    :param image: The container this one was cloned from, if any. Its disk is a
+                  copy-on-write overlay of the disk of the image, created when it
+                  is first started.
     """
 
     arch: str
@@ -37,6 +44,8 @@ class ContainerConfig:
     password: str
     portfwd: List[List[int]]
     legacy: bool
+    warmstart: bool = False
+    image: Optional[str] = None
 
     def __init__(
         self, manifest: dict
@@ -95,6 +104,12 @@ class ContainerConfig:
                 else:
                     htaken.add(hport)
 
+        if not isinstance(manifest.get("warmstart", False), bool):
+            config_errors.append("'warmstart' must be a boolean.")
+
+        if not isinstance(manifest.get("image", ""), str):
+            config_errors.append("'image' must be a string.")
+
         if (pswd := manifest.get("password")) is None:
             config_errors.append("'password' is not an optional field.")
         elif not isinstance(pswd, str):
@@ -116,6 +131,8 @@ class ContainerConfig:
             if isinstance(manifest.get("__legacy"), bool)
             else False
         )
+        self.warmstart = manifest.get("warmstart", False)
+        self.image = manifest.get("image")
 
     @staticmethod
     def _convert_legacy(manifest: dict) -> dict:
@@ -147,6 +164,8 @@ class ContainerConfig:
             "portfwd": self.portfwd,
             "username": self.username,
             "password": self.password,
+            **({"warmstart": True} if self.warmstart else {}),
+            **({"image": self.image} if self.image is not None else {}),
             **({"__legacy": True} if self.legacy else {}),
         }
 
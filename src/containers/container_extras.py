@@ -2,25 +2,161 @@
 Various extra tools used by containers
 """
 
+import json
+import subprocess
 import tarfile
-from os.path import isdir, isfile
+from os import link, remove
+from os.path import getsize, isdir, isfile
 from pathlib import Path
-from shutil import rmtree
-from typing import Union
+from shutil import copyfile, rmtree
+from typing import Any, BinaryIO, Callable, Dict, List, Optional, Union
 
-from src.system.syspath import get_container_config, get_container_dir
+from src.containers.exceptions import BootFailure
+from src.system.syspath import (
+    get_container_config,
+    get_container_dir,
+    get_container_home,
+    get_qemu_bin,
+)
 
+# Files a container boots from besides its disk, which clones share with their image
+BOOT_FILES = ("vmlinuz", "initrd.img")
 
-def install_container(archive_path: Path, container_name: str) -> None:
+
+def install_container(
+    archive_path: Path,
+    container_name: str,
+    callback: Optional[Callable[[int, int], None]] = None,
+) -> None:
     """
-    Installs a container from an archive
+    Installs a container from an archive. If installing fails, or callback raises,
+    the files already extracted are removed.
 
     :param archive_path: The path to the archive
+    :param callback: Called with the bytes of the archive read so far and its size
     """
     if not tarfile.is_tarfile(archive_path):
         raise TypeError(f"'{archive_path}' is not a tar archive")
-    with tarfile.open(archive_path) as tar:
-        tar.extractall(path=get_container_dir(container_name))
+
+    existed = get_container_dir(container_name).is_dir()
+    try:
+        with open(archive_path, "rb") as raw, tarfile.open(
+            fileobj=_ProgressFile(raw, getsize(archive_path), callback)
+        ) as tar:
+            tar.extractall(path=get_container_dir(container_name))
+    except BaseException:
+        if not existed:
+            rmtree(get_container_dir(container_name), ignore_errors=True)
+        raise
+
+
+def clone_container(image: str, container_name: str) -> None:
+    """
+    Creates a container sharing the disk of another, the image. Its own disk only
+    holds what changes, and is created when it is first started (see
+    create_overlay), unless the server hands it a container booted ahead of time.
+    The server refuses to start, modify, rename or delete the image while clones
+    of it exist, see find_clones.
+
+    :param image: The name of the container cloned
+    :param container_name: The name of the new container
+    """
+    if not get_container_config(image).is_file():
+        raise FileNotFoundError(str(get_container_dir(image)))
+    if get_container_dir(container_name).exists():
+        raise FileExistsError(str(get_container_dir(container_name)))
+
+    with open(get_container_config(image), "r", encoding="utf-8") as file:
+        config = json.load(file)
+    # A clone of a clone shares the disk of the first image down the chain
+    config["image"] = config.get("image", image)
+
+    get_container_dir(container_name).mkdir()
+    try:
+        write_clone_files(image, get_container_dir(container_name), config)
+    except BaseException:
+        rmtree(get_container_dir(container_name), ignore_errors=True)
+        raise
+
+
+def get_image(container_name: str) -> Optional[str]:
+    """
+    :param container_name: The name of a container
+    :return: The image the container was cloned from, or None if it is not a
+             clone, or its config cannot be read
+    """
+    try:
+        with open(get_container_config(container_name), "r", encoding="utf-8") as file:
+            config = json.load(file)
+    except (OSError, ValueError):
+        return None
+    return config.get("image") if isinstance(config, dict) else None
+
+
+def find_clones(image: str) -> List[str]:
+    """
+    Finds the containers running on the disk of an image, see clone_container
+
+    :param image: The name of the container cloned
+    :return: The names of its clones, sorted
+    """
+    return sorted(
+        directory.name
+        for directory in get_container_home().iterdir()
+        if not directory.name.startswith(".")
+        and directory.name != image
+        and get_image(directory.name) == image
+    )
+
+
+def write_clone_files(image: str, directory: Path, config: Dict[str, Any]) -> None:
+    """
+    Writes the config of a clone, and links the boot files of its image into it
+
+    :param image: The name of the container cloned
+    :param directory: The folder of the clone
+    :param config: The config of the clone
+    """
+    with open(directory / "config.json", "w", encoding="utf-8") as file:
+        json.dump(config, file)
+    for name in BOOT_FILES:
+        if (get_container_dir(image) / name).is_file():
+            try:
+                link(get_container_dir(image) / name, directory / name)
+            except OSError:
+                copyfile(get_container_dir(image) / name, directory / name)
+
+
+def create_overlay(image: str, directory: Path) -> None:
+    """
+    Creates the disk of a clone, a copy-on-write overlay of the disk of its image.
+    Raises BootFailure if qemu-img fails.
+
+    :param image: The name of the container cloned
+    :param directory: The folder of the clone
+    """
+    backing = (get_container_dir(image) / "hdd.qcow2").absolute()
+    if not backing.is_file():
+        raise FileNotFoundError(str(backing))
+    try:
+        subprocess.run(
+            [
+                get_qemu_bin() / "qemu-img",
+                "create",
+                "-q",
+                "-f",
+                "qcow2",
+                "-F",
+                "qcow2",
+                "-b",
+                str(backing),
+                str(directory / "hdd.qcow2"),
+            ],
+            check=True,
+            capture_output=True,
+        )
+    except subprocess.CalledProcessError as exc:
+        raise BootFailure(exc.stderr.decode("utf-8", "replace").strip()) from exc
 
 
 def delete_container(container_name: Path) -> None:
@@ -37,13 +173,17 @@ def delete_container(container_name: Path) -> None:
 
 
 def archive_container(
-    container_name: str, path_to_destination: Union[str, Path]
+    container_name: str,
+    path_to_destination: Union[str, Path],
+    callback: Optional[Callable[[int, int], None]] = None,
 ) -> None:
     """
     Saves a container as an archive
 
     :param container_name: The name of the container being archived
     :param path_to_destination: The path where the archive will be saved
+    :param callback: Called with the bytes of the container read so far and their
+                     total. If it raises, the archive is removed.
     """
     if isinstance(path_to_destination, Path):
         path_to_destination = str(path_to_destination)
@@ -53,13 +193,59 @@ def archive_container(
     if isfile(path_to_destination):
         raise FileExistsError(str(path_to_destination))
 
-    with tarfile.open(path_to_destination, "w:gz") as tar:
-        tar.add(get_container_config(container_name), arcname="config.json")
-        tar.add(get_container_dir(container_name) / "hdd.qcow2", arcname="hdd.qcow2")
+    container_dir = get_container_dir(container_name)
+    files = [(get_container_config(container_name), "config.json")]
+    files.append((container_dir / "hdd.qcow2", "hdd.qcow2"))
+    for optional in BOOT_FILES:
+        if (container_dir / optional).exists():
+            files.append((container_dir / optional, optional))
+
+    total = sum(getsize(path) for path, _ in files)
+    done = 0
+    try:
+        with tarfile.open(path_to_destination, "w:gz") as tar:
+            for path, arcname in files:
+                with open(path, "rb") as raw:
+                    tar.addfile(
+                        tar.gettarinfo(path, arcname=arcname),
+                        _ProgressFile(raw, total, callback, offset=done),
+                    )
+                done += getsize(path)
+    except BaseException:
+        remove(path_to_destination)
+        raise
+
+
+class _ProgressFile:
+    """
+    Internal class used to report how much of a file was read, as tarfile reads it
+
+    :param raw: The file
+    :param total: The size reported along with the progress
+    :param callback: Called with the bytes read so far and total, if any
+    :param offset: Added to the bytes read, for files read one after the other
+    """
+
+    def __init__(
+        self,
+        raw: BinaryIO,
+        total: int,
+        callback: Optional[Callable[[int, int], None]],
+        offset: int = 0,
+    ) -> None:
+        self.raw = raw
+        self.total = total
+        self.callback = callback
+        self.offset = offset
+
+    def read(self, size: int = -1) -> bytes:
+        """
+        Reads from the file, and reports the progress
+        """
+        data = self.raw.read(size)
+        if self.callback is not None:
+            self.callback(self.offset + self.raw.tell(), self.total)
+        return data
 
-        if (get_container_dir(container_name) / "vmlinuz").exists():
-            tar.add(get_container_dir(container_name) / "vmlinuz", arcname="vmlinuz")
-        if (get_container_dir(container_name) / "initrd.img").exists():
-            tar.add(
-                get_container_dir(container_name) / "initrd.img", arcname="initrd.img"
-            )
+    def __getattr__(self, name: str):
+        return getattr(self.raw, name)
@@ -0,0 +1,260 @@
+"""
+Tracks the lifecycle of the containers managed by the server
+"""
+
+import asyncio
+import logging
+import time
+from contextlib import suppress
+from enum import Enum
+from typing import Any, Awaitable, Callable, List, Optional
+
+from src.containers.container import Container
+from src.containers.exceptions import ImageInUseError
+from src.containers.warm_pool import WarmPool
+from src.system.events import EventBus
+from src.system.metrics import Metrics
+from src.system.operations import report_phase
+from src.system.server_logging import subsystem_logger
+from src.system.tracing import span
+
+
+class ContainerState(Enum):
+    """
+    The states a container goes through on the server:
+    stopped -> booting -> running -> stopping -> stopped
+    """
+
+    STOPPED = "stopped"
+    BOOTING = "booting"
+    RUNNING = "running"
+    STOPPING = "stopping"
+
+
+class ContainerLifecycle:
+    """
+    The state machine of a single container. Transitions of a container are
+    serialized by its own lock, so operations on different containers never
+    contend. Must be used from the server's event loop.
+
+    :param name: The name of the container
+    :param logger: Logger
+    :param offload: Runs a blocking function off the event loop
+    :param metrics: Records how long boots take
+    :param events: Where the transitions of the container are published
+    :param pool: Hands a container booted ahead of time to a clone started for
+                 the first time, if any is ready
+    :param image_users: Finds what runs on the disk of a container, which is then
+                        not booted, see ContainerManagerServer.image_users
+    :param state: The current state of the container
+    :param container: The container, unless it is stopped
+    :param lock: Held for the duration of every transition
+    :param boot: The boot in progress, awaited by every START that arrives during it
+    """
+
+    name: str
+    logger: logging.Logger
+    offload: Callable[..., Awaitable[Any]]
+    metrics: Metrics
+    events: EventBus
+    pool: Optional[WarmPool] = None
+    image_users: Optional[Callable[[str], Awaitable[List[str]]]] = None
+    state: ContainerState = ContainerState.STOPPED
+    container: Optional[Container] = None
+    lock: asyncio.Lock
+    boot: Optional["asyncio.Future[None]"] = None
+    _killed: bool = False
+
+    def __init__(
+        self,
+        name: str,
+        logger: logging.Logger,
+        offload: Callable[..., Awaitable[Any]],
+        metrics: Metrics,
+        events: EventBus,
+        pool: Optional[WarmPool] = None,
+        image_users: Optional[Callable[[str], Awaitable[List[str]]]] = None,
+    ) -> None:
+        self.name = name
+        self.logger = subsystem_logger(logger, "lifecycle")
+        self.offload = offload
+        self.metrics = metrics
+        self.events = events
+        self.pool = pool
+        self.image_users = image_users
+        self.lock = asyncio.Lock()
+
+    @property
+    def running(self) -> Optional[Container]:
+        """
+        The container, if it is running
+        """
+        return self.container if self.state is ContainerState.RUNNING else None
+
+    async def start(self) -> None:
+        """
+        Boots the container, unless it is already running. Concurrent calls are
+        coalesced into a single boot, and all of them raise if it fails.
+        Raises BootFailure, FileNotFoundError, ImageInUseError
+        """
+        if self.boot is None:
+            self.boot = asyncio.ensure_future(self._boot())
+            self.boot.add_done_callback(self._boot_done)
+        # Shielded, so a client hanging up does not cancel a boot others wait on
+        await asyncio.shield(self.boot)
+
+    async def _boot(self) -> None:
+        async with self.lock:
+            if self.state is ContainerState.RUNNING:
+                return
+            # Checked under the lock, which CLONE also takes
+            users = await self.image_users(self.name) if self.image_users else []
+            if users:
+                raise ImageInUseError({"container_name": self.name, "users": users})
+
+            self.logger.debug("Starting container '%s'", self.name)
+            self.container = Container(self.name, logger=self.logger)
+            self.state = ContainerState.BOOTING
+            self.events.publish("booting", self.name)
+            began = time.monotonic()
+            claimed = None
+            try:
+                with span("boot", container=self.name):
+                    if self.pool is not None:
+                        claimed = await self.pool.claim(self.container)
+                    if claimed is not None:
+                        self.container = claimed
+                    else:
+                        await self.offload(self.container.start, self._on_phase)
+            except Exception as exc:  # pylint: disable=broad-except
+                # Includes OperationCancelled, raised by the phase reports of a
+                # START run in the background once it is cancelled
+                self.logger.debug(
+                    "Container %s failed to boot: %s", self.name, repr(exc)
+                )
+                with suppress(OSError, AttributeError):
+                    await self.offload(self.container.kill)
+                self._boot_failed(exc)
+                raise
+            except BaseException as exc:
+                self._boot_failed(exc)
+                raise
+
+            self.state = ContainerState.RUNNING
+            self.metrics.observe_boot(time.monotonic() - began)
+            self.events.publish(
+                "running",
+                self.name,
+                boot_seconds=round(time.monotonic() - began, 3),
+                port=self.container.ex_port,
+                **({"pooled": True} if claimed is not None else {}),
+            )
+            self.logger.debug("Container %s has been started", self.name)
+
+    def _boot_failed(self, exc: BaseException) -> None:
+        killed = self._killed
+        self._stopped()
+        self.events.publish(
+            "killed" if killed else "boot_failed", self.name, error=repr(exc)
+        )
+
+    def _on_phase(self, phase: str) -> None:
+        # Called from the thread booting the container
+        self.events.publish("boot_phase", self.name, phase=phase)
+        report_phase(phase)
+
+    def _boot_done(self, boot: "asyncio.Future[None]") -> None:
+        self.boot = None
+        if not boot.cancelled():
+            boot.exception()  # Retrieved, even if every waiter went away
+
+    async def stop(self) -> bool:
+        """
+        Powers the container off. Waits for a boot in progress to finish first.
+        Raises PoweroffTimeoutExceededError, SSHException
+
+        :return: False if the container was not started
+        """
+        async with self.lock:
+            if self.state is not ContainerState.RUNNING:
+                return False
+
+            self.logger.debug("Stopping container '%s'", self.name)
+            self.state = ContainerState.STOPPING
+            self.events.publish("stopping", self.name)
+            try:
+                with span("stop", container=self.name):
+                    await self.offload(self.container.stop)
+            except BaseException:
+                if self._killed:
+                    self._stopped()
+                    self.events.publish("killed", self.name)
+                else:
+                    # Still up as far as we know, so it can be stopped or killed again
+                    self.state = ContainerState.RUNNING
+                    self.events.publish("running", self.name)
+                raise
+            self._stopped()
+            self.events.publish("stopped", self.name)
+            return True
+
+    async def kill(self) -> bool:
+        """
+        Kills the QEMU process of the container. A boot or a poweroff in progress
+        is cut short rather than waited for.
+        Raises OSError if the process is no longer accessible
+
+        :return: False if the container was not started
+        """
+        interrupted = self.state in (ContainerState.BOOTING, ContainerState.STOPPING)
+        if interrupted:
+            self.logger.debug(
+                "Killing container '%s' while %s", self.name, self.state.value
+            )
+            # The transition in progress fails, and leaves the container stopped
+            self._killed = True
+            with suppress(OSError, AttributeError):
+                await self.offload(self.container.kill)
+
+        async with self.lock:
+            if self.state is not ContainerState.RUNNING:
+                return interrupted
+
+            self.logger.debug("Killing container '%s'", self.name)
+            self.state = ContainerState.STOPPING
+            try:
+                await self.offload(self.container.kill)
+            finally:
+                self._stopped()
+                self.events.publish("killed", self.name)
+            return True
+
+    async def check_crashed(self) -> bool:
+        """
+        Notices a running container whose QEMU process exited on its own, for
+        instance after a kernel panic or a poweroff from within, and marks it as
+        stopped
+
+        :return: Whether the container crashed
+        """
+        if self.state is not ContainerState.RUNNING or self.lock.locked():
+            return False
+        if not self.container.exited():
+            return False
+        async with self.lock:
+            if self.state is not ContainerState.RUNNING:
+                return False
+            self.logger.warning("Container '%s' exited on its own", self.name)
+            container = self.container
+            self._stopped()
+            with suppress(OSError, AttributeError):
+                await self.offload(container.release)
+            self.events.publish(
+                "crashed", self.name, exit_status=container.booter.proc.returncode
+            )
+            return True
+
+    def _stopped(self) -> None:
+        self.state = ContainerState.STOPPED
+        self.container = None
+        self._killed = False
@@ -2,43 +2,61 @@
 The client version of the container manager
 """
 
+import codecs
+import io
+import itertools
 import json
+import os
 import socket
 import subprocess
 import sys
 import threading
 import time
-from os import getcwd, listdir
-from os.path import basename, isdir, isfile
+from os import getcwd, listdir, makedirs
+from os.path import basename, dirname, isdir, isfile
 from os.path import join as joinpath
-from typing import List, Optional, Tuple
+from posixpath import basename as posixbasename
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple
 
 from src.system.filezilla import filezilla, sftp
-from src.system.my_socket import ClientServerSocket
-from src.system.syspath import (get_container_home, get_container_id_rsa,
-                                get_full_path, get_server_info_file)
+from src.system.my_socket import ClientServerSocket, check_response, get_server_error
+from src.system.syspath import get_container_home, get_full_path, get_server_info_file
+from src.system.tracing import traced
 
 if sys.platform == "win32":
     import msvcrt  # pylint: disable=import-error
 else:
     import select
 
+# Stdin of a command is sent to the server in chunks of up to this size
+INPUT_CHUNK_SIZE = 1 << 16
+
 
 class ContainerManagerClient:
     """
-    Sends requests to the ContainerManagerServer
+    Sends requests to the ContainerManagerServer. Requests share a single
+    long-lived connection, which is reopened if the server drops it.
 
     :param server_address: (IP, PORT) of the server.
+    :param server_sock_path: Path to the unix domain socket of the server, if any.
     """
 
     server_address: Tuple[str, int]
+    server_sock_path: Optional[str] = None
+    _connection: Optional["_MultiplexedConnection"] = None
 
-    def __init__(self, in_stream=sys.stdin, out_stream=sys.stdout):
+    def __init__(
+        self, in_stream=sys.stdin, out_stream=sys.stdout, err_stream=sys.stderr
+    ):
         with open(get_server_info_file(), "r", encoding="utf-8") as f:
             info = json.load(f)
             self.server_address = (info["addr"], info["port"])
+            if hasattr(socket, "AF_UNIX"):
+                self.server_sock_path = info.get("sock")
         self.in_stream = in_stream
         self.out_stream = out_stream
+        self.err_stream = err_stream
+        self._connection_mutex = threading.Lock()
 
     def ping(self) -> float:
         """
@@ -47,9 +65,7 @@ class ContainerManagerClient:
         :return: The time it took to send PING and get OK back
         """
         tim = time.time()
-        sock = self._make_connection()
-        sock.send(b"PING")
-        sock.recv_expect(b"OK")
+        self._request("PING")
         return time.time() - tim
 
     def list_containers(self) -> List[str]:
@@ -58,7 +74,7 @@ class ContainerManagerClient:
         """
         return list(
             filter(
-                lambda p: (get_container_home() / p).is_dir(),
+                lambda p: (get_container_home() / p).is_dir() and p[0] != ".",
                 listdir(get_container_home()),
             )
         )
@@ -69,17 +85,7 @@ class ContainerManagerClient:
 
         :param container_name: The name of the container being checked
         """
-        sock = self._make_connection()
-        sock.send(b"STARTED")
-        sock.recv_expect(b"CONT")
-        sock.send(bytes(container_name, "utf-8"))
-        response = sock.recv_expect([b"YES", b"NO"])
-
-        if response == b"YES":
-            return True
-        if response == b"NO":
-            return False
-        raise RuntimeError(f"Invalid server response: {response}")
+        return bool(self._request("STARTED", container_name)["started"])
 
     def view_files(self, container_name: str) -> None:
         """
@@ -106,13 +112,37 @@ class ContainerManagerClient:
         :param container_name: The container whose shell is being used
         :return: The address
         """
-        sock = self._make_connection()
-        sock.send(b"SSH-ADDRESS")
-        sock.recv_expect(b"CONT")
-        sock.send(bytes(container_name, "utf-8"))
-        user, passwd, host, port = sock.recv().decode("utf-8").split(":")
-        sock.close()
-        return (user, passwd, host, port)
+        response = self._request("SSH-ADDRESS", container_name)
+        return (
+            response["user"],
+            response["password"],
+            response["host"],
+            response["port"],
+        )
+
+    def open_session(
+        self, container_name: str, on_boot: Optional[Callable[[], None]] = None
+    ) -> Dict[str, Any]:
+        """
+        Gets a container ready for a session in a single request: boots it if it is
+        not running, and generates its id_rsa if it is missing
+
+        :param container_name: The container
+        :param on_boot: Called if the container has to boot, before it does
+        :return: The state of the container ("running"), whether it was just
+                 booted ("booted"), its SSH address ("user", "password", "host",
+                 "port"), the path to its id_rsa ("key_path"), and its forwarded
+                 ports as [guest, host] pairs ("forwarded_ports")
+        """
+
+        def on_event(_event: Dict[str, Any]) -> None:
+            if on_boot is not None:
+                on_boot()
+
+        resp = self._request("OPEN-SESSION", container_name, on_event=on_event)
+        return {
+            key: value for key, value in resp.items() if key not in ("id", "status")
+        }
 
     def update_hostkey(self, container_name: str) -> None:
         """
@@ -120,24 +150,20 @@ class ContainerManagerClient:
 
         :param container_name: The container to generate the keys for
         """
-        sock = self._make_connection()
-        sock.send(b"UPDATE-HOSTKEY")
-        sock.recv_expect(b"CONT")
-        sock.send(bytes(container_name, "utf-8"))
-        sock.recv_expect(b"OK")
+        self._request("UPDATE-HOSTKEY", container_name)
 
-    def start(self, container_name: str) -> None:
+    def start(self, container_name: str, background: bool = False) -> Optional[str]:
         """
         Starts a container
 
         :param container_name: The container being started
+        :param background: Boot in the background, see submit
+        :return: The ID of the operation, if booting in the background
         """
-        sock = self._make_connection()
-        sock.send(b"START")
-        sock.recv_expect(b"CONT")
-        sock.send(bytes(container_name, "utf-8"))
-        sock.recv_expect(b"OK")
-        sock.close()
+        if background:
+            return self.submit("START", container_name)
+        self._request("START", container_name)
+        return None
 
     def stop(self, container_name: str) -> None:
         """
@@ -145,12 +171,7 @@ class ContainerManagerClient:
 
         :param container_name: The container being stopped
         """
-        sock = self._make_connection()
-        sock.send(b"STOP")
-        sock.recv_expect(b"CONT")
-        sock.send(bytes(container_name, "utf-8"))
-        sock.recv_expect(b"OK")
-        sock.close()
+        self._request("STOP", container_name)
 
     def kill(self, container_name: str) -> None:
         """
@@ -158,23 +179,51 @@ class ContainerManagerClient:
 
         :param container_name: The container being stopped
         """
-        sock = self._make_connection()
-        sock.send(b"KILL")
-        sock.recv_expect(b"CONT")
-        sock.send(bytes(container_name, "utf-8"))
-        sock.recv_expect(b"OK")
-        sock.close()
+        self._request("KILL", container_name)
+
+    def batch(
+        self,
+        action: str,
+        containers: List[str],
+        parallel: Optional[int] = None,
+        on_result: Optional[Callable[[str, str], None]] = None,
+    ) -> Dict[str, str]:
+        """
+        Starts, stops, kills or checks many containers in one request. The server
+        works on several of them at once.
+
+        :param action: "START", "STOP", "KILL" or "STARTED"
+        :param containers: Names of containers, or glob patterns such as "lab_*"
+        :param parallel: Number of containers worked on at once, if not the
+                         server's default
+        :param on_result: Called with the name and the result of each container as
+                          soon as it is done
+        :return: The result of each container: "started", "stopped", "killed",
+                 "not started", "no such container", "image in use", "boot failure"
+                 or "error", or its state for "STARTED"
+        """
+        args: Dict[str, Any] = {"action": action, "containers": containers}
+        if parallel is not None:
+            args["parallel"] = parallel
 
-    def run_shell(self, container_name: str) -> None:
+        def on_event(event: Dict[str, Any]) -> None:
+            if on_result is not None:
+                on_result(event["container"], event["result"])
+
+        return self._request("BATCH", on_event=on_event, **args)["results"]
+
+    def run_shell(
+        self, container_name: str, session: Optional[Dict[str, Any]] = None
+    ) -> None:
         """
         Starts a shell on the container in question
 
         :param container_name: The container whose shell is being used
+        :param session: What open_session returned for the container, if it was
+                        just called
         """
-        if not get_container_id_rsa(container_name).is_file():
-            self.update_hostkey(container_name)
-
-        user, _, host, port = self.ssh_address(container_name)
+        session = session or self.open_session(container_name)
+        user, host, port = session["user"], session["host"], session["port"]
         subprocess.run(
             [
                 "ssh" if sys.platform == "win32" else "/usr/bin/ssh",
@@ -182,7 +231,7 @@ class ContainerManagerClient:
                 "-oStrictHostKeyChecking=no",
                 "-oLogLevel=ERROR",
                 "-oPasswordAuthentication=no",
-                f"-i{get_container_id_rsa(container_name)}",
+                f"-i{session['key_path']}",
                 f"-p{port}",
                 f"{user}@{host}",
             ],
@@ -190,8 +239,12 @@ class ContainerManagerClient:
         )
 
     def get_file(
-        self, container_name: str, remote_file: str, local_file: Optional[str] = None
-    ) -> None:
+        self,
+        container_name: str,
+        remote_file: str,
+        local_file: Optional[str] = None,
+        background: bool = False,
+    ) -> Optional[str]:
 
         """
         Gets a file from a container
@@ -199,48 +252,122 @@ class ContainerManagerClient:
         :param container_name: The container where the file is obtained from
         :param remote_file: The file obtained from the container
         :param local_file: Where the file obtained from the container is placed
+        :param background: Transfer the file in the background, see submit
+        :return: The ID of the operation, if transferring in the background
         """
         if local_file in (None, "."):
             local_file = joinpath(getcwd(), basename(remote_file))
 
         absolute_local_path = get_full_path(local_file)
 
-        sock = self._make_connection()
-        sock.send(b"GET-FILE")
-        sock.recv_expect(b"CONT")
-        sock.send(bytes(container_name, "utf-8"))
-        sock.recv_expect(b"CONT")
-        sock.send(bytes(remote_file, "utf-8"))
-        sock.recv_expect(b"CONT")
-        sock.send(bytes(absolute_local_path, "utf-8"))
-        sock.recv_expect(b"OK")
-        sock.close()
+        if background:
+            if isdir(absolute_local_path):
+                absolute_local_path = joinpath(
+                    absolute_local_path, posixbasename(remote_file)
+                )
+            return self.submit(
+                "GET-FILE",
+                container_name,
+                remote_file=remote_file,
+                local_file=absolute_local_path,
+            )
 
-    def put_file(
-        self, container_name: str, local_file: str, remote_file: Optional[str] = None
+        if self._get_connection().sock.can_pass_fds:
+            self._get_file_fd(container_name, remote_file, absolute_local_path)
+            return None
+
+        self._request(
+            "GET-FILE",
+            container_name,
+            remote_file=remote_file,
+            local_file=absolute_local_path,
+        )
+        return None
+
+    def _get_file_fd(
+        self, container_name: str, remote_file: str, absolute_local_path: str
     ) -> None:
+        """
+        Gets a file from a container by handing the server an open local file
+
+        :param container_name: The container where the file is obtained from
+        :param remote_file: The file obtained from the container
+        :param absolute_local_path: Where the file obtained from the container is placed
+        """
+        if isdir(absolute_local_path):
+            absolute_local_path = joinpath(
+                absolute_local_path, posixbasename(remote_file)
+            )
+        makedirs(dirname(absolute_local_path), exist_ok=True)
+
+        # Not truncated until the transfer succeeds, so a failed GET-FILE leaves
+        # an existing file untouched
+        created = not isfile(absolute_local_path)
+        fd = os.open(absolute_local_path, os.O_WRONLY | os.O_CREAT, 0o666)
+        try:
+            self._request(
+                "GET-FILE",
+                container_name,
+                remote_file=remote_file,
+                local_file=absolute_local_path,
+                fds=[fd],
+            )
+            # The server wrote through a duplicate of fd, which shares its offset
+            os.ftruncate(fd, os.lseek(fd, 0, os.SEEK_CUR))
+        except BaseException:
+            if created:
+                os.remove(absolute_local_path)
+            raise
+        finally:
+            os.close(fd)
+
+    def put_file(
+        self,
+        container_name: str,
+        local_file: str,
+        remote_file: Optional[str] = None,
+        background: bool = False,
+    ) -> Optional[str]:
         """
         Puts a file into a container
 
         :param container_name: The container where the file is placed
         :param local_file: The file being put into the container
         :param remote_file: Where the file will be placed in the container
+        :param background: Transfer the file in the background, see submit
+        :return: The ID of the operation, if transferring in the background
         """
         absolute_local_path = get_full_path(local_file)
 
         if remote_file in (None, ".", "~"):
             remote_file = basename(absolute_local_path)
 
-        sock = self._make_connection()
-        sock.send(b"PUT-FILE")
-        sock.recv_expect(b"CONT")
-        sock.send(bytes(container_name, "utf-8"))
-        sock.recv_expect(b"CONT")
-        sock.send(bytes(absolute_local_path, "utf-8"))
-        sock.recv_expect(b"CONT")
-        sock.send(bytes(remote_file, "utf-8"))
-        sock.recv_expect(b"OK")
-        sock.close()
+        if background:
+            return self.submit(
+                "PUT-FILE",
+                container_name,
+                local_file=absolute_local_path,
+                remote_file=remote_file,
+            )
+
+        if self._get_connection().sock.can_pass_fds and isfile(absolute_local_path):
+            with open(absolute_local_path, "rb") as f:
+                self._request(
+                    "PUT-FILE",
+                    container_name,
+                    local_file=absolute_local_path,
+                    remote_file=remote_file,
+                    fds=[f.fileno()],
+                )
+            return None
+
+        self._request(
+            "PUT-FILE",
+            container_name,
+            local_file=absolute_local_path,
+            remote_file=remote_file,
+        )
+        return None
 
     def run_command(self, container_name: str, cli: List[str]) -> None:
         """
@@ -249,44 +376,125 @@ class ContainerManagerClient:
         :param container_name: The container with the command being run
         :param cmd: The command being run, as a list of arguments
         """
-        sock = self._make_connection()
-        sock.send(b"RUN-COMMAND")
-        sock.recv_expect(b"CONT")
-        sock.send(bytes(container_name, "utf-8"))
-        sock.recv_expect(b"CONT")
-
-        sock.send(bytes(str(len(cli)), "utf-8"))
-        for arg in cli:
-            sock.recv_expect(b"CONT")
-            sock.send(bytes(arg, "utf-8"))
-
-        sock.recv_expect(b"BEGIN")
-        _RunCommandClient(sock, self.in_stream, self.out_stream)
+        with traced("client RUN-COMMAND", container=container_name):
+            # The command's I/O takes over the connection, so it gets its own
+            sock = self._make_connection()
+            try:
+                fds = self._stdio_fds() if sock.can_pass_fds else None
+                sock.request("RUN-COMMAND", container_name, cli=cli, fds=fds)
+                sock.recv_response()
+
+                if fds is None:
+                    _RunCommandClient(
+                        sock, self.in_stream, self.out_stream, self.err_stream
+                    )
+                    return
+
+                # The server reads and writes our stdio directly, and closes the
+                # connection once the command is done
+                while sock.recv():
+                    pass
+            finally:
+                sock.close()
+
+    def capture_command(
+        self,
+        container_name: str,
+        cli: List[str],
+        stdout: Any = None,
+        stderr: Any = None,
+    ) -> Dict[str, Any]:
+        """
+        Runs a command in a container without any interaction: the command gets no
+        input, and its output is written as is to stdout and stderr. Meant for
+        scripts running many commands, so there is a single request per command.
+
+        :param container_name: The running container
+        :param cli: The command being run, as a list of arguments
+        :param stdout: Where the output of the command goes, out_stream by default.
+                       Binary streams get the bytes exactly as the command wrote
+                       them; files are written to by the server directly.
+        :param stderr: Where the errors of the command go, err_stream by default
+        :return: The exit status of the command ("exit_status", None if it did not
+                 exit on its own or was killed by a signal) and the wall time of
+                 the request, in seconds ("seconds")
+        """
+        began = time.monotonic()
+        sinks = {
+            1: _OutputSink(self.out_stream if stdout is None else stdout),
+            2: _OutputSink(self.err_stream if stderr is None else stderr),
+        }
+        exit_status = None
+        with traced("client RUN-COMMAND", container=container_name):
+            sock = self._make_connection()
+            try:
+                fds = _sink_fds(sinks) if sock.can_pass_fds else None
+                sock.request(
+                    "RUN-COMMAND", container_name, cli=cli, capture=True, fds=fds
+                )
+                sock.recv_response()
+                while True:
+                    header, body = sock.recv_msg()
+                    if header.get("stream") in sinks:
+                        sinks[header["stream"]].write(body)
+                    elif "exit_status" in header:
+                        exit_status = header["exit_status"]
+                        break
+            except ConnectionError:
+                pass  # The server went away before the command exited
+            finally:
+                sock.close()
+                for sink in sinks.values():
+                    sink.close()
+        return {"exit_status": exit_status, "seconds": time.monotonic() - began}
+
+    def _stdio_fds(self) -> Optional[List[int]]:
+        """
+        Gets the file descriptors handed to the server for a RUN-COMMAND
 
-    def install(self, archive_path_str: str, container_name: str) -> None:
+        :return: [stdin, stdout, stderr], or None if the streams are not backed by files
+        """
+        try:
+            self.out_stream.flush()
+            self.err_stream.flush()
+            return [
+                self.in_stream.fileno(),
+                self.out_stream.fileno(),
+                self.err_stream.fileno(),
+            ]
+        except (AttributeError, OSError, ValueError):
+            return None
+
+    def install(
+        self, archive_path_str: str, container_name: str, background: bool = False
+    ) -> Optional[str]:
         """
         Installs a new container from a given archive path
 
         :param archive_path_str: The path to the archive
         :param container_name: The name of the container
+        :param background: Install in the background, see submit
+        :return: The ID of the operation, if installing in the background
         """
         absolute_archive_path = get_full_path(archive_path_str)
 
-        sock = self._make_connection()
-        sock.send(b"INSTALL")
-        sock.recv_expect(b"CONT")
-        sock.send(bytes(absolute_archive_path, "utf-8"))
-        sock.recv_expect(b"CONT")
-        sock.send(bytes(container_name, "utf-8"))
-        sock.recv_expect(b"OK")
-        sock.close()
+        if background:
+            return self.submit(
+                "INSTALL", container_name, archive_path=absolute_archive_path
+            )
+        self._request("INSTALL", container_name, archive_path=absolute_archive_path)
+        return None
 
-    def archive(self, container_name: str, path_to_destination: str) -> None:
+    def archive(
+        self, container_name: str, path_to_destination: str, background: bool = False
+    ) -> Optional[str]:
         """
         Archives a container onto the disk
 
         :param container_name: The name of the container
         :param path_to_destination: Path where archive will be saved
+        :param background: Archive in the background, see submit
+        :return: The ID of the operation, if archiving in the background
         """
         absolute_path = get_full_path(path_to_destination)
         if isdir(absolute_path):
@@ -296,14 +504,12 @@ class ContainerManagerClient:
         if not absolute_path.endswith(".tar.gz"):
             absolute_path += ".tar.gz"
 
-        sock = self._make_connection()
-        sock.send(b"ARCHIVE")
-        sock.recv_expect(b"CONT")
-        sock.send(bytes(container_name, "utf-8"))
-        sock.recv_expect(b"CONT")
-        sock.send(bytes(absolute_path, "utf-8"))
-        sock.recv_expect(b"OK")
-        sock.close()
+        if background:
+            return self.submit(
+                "ARCHIVE", container_name, path_to_destination=absolute_path
+            )
+        self._request("ARCHIVE", container_name, path_to_destination=absolute_path)
+        return None
 
     def delete(self, container_name: str) -> None:
         """
@@ -311,12 +517,7 @@ class ContainerManagerClient:
 
         :param container_name: The name of the container to delete
         """
-        sock = self._make_connection()
-        sock.send(b"DELETE")
-        sock.recv_expect(b"CONT")
-        sock.send(bytes(container_name, "utf-8"))
-        sock.recv_expect(b"OK")
-        sock.close()
+        self._request("DELETE", container_name)
 
     def rename(self, old_name: str, new_name: str) -> None:
         """
@@ -325,44 +526,406 @@ class ContainerManagerClient:
         :param old_name: The old name of the container
         :param new_name: The name that the container will be renamed to
         """
+        self._request("RENAME", old_name, new_name=new_name)
+
+    def clone(self, image: str, new_name: str) -> None:
+        """
+        Creates a container sharing the disk of another. Its first start is
+        instant if the server keeps containers of the image ready, see pool.
+
+        :param image: The name of the container cloned
+        :param new_name: The name of the new container
+        """
+        self._request("CLONE", image, new_name=new_name)
+
+    def pool(self, sizes: Optional[Dict[str, int]] = None) -> Dict[str, Any]:
+        """
+        Gets the state of the warm pool of the server, once resized if sizes are
+        given
+
+        :param sizes: The number of containers to keep ready for some images. 0
+                      empties the pool of an image.
+        :return: The size of the pool of each image, and how many of its containers
+                 are ready and booting
+        """
+        if sizes is None:
+            return self._request("POOL")["pool"]
+        return self._request("POOL", sizes=sizes)["pool"]
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Gets the metrics of the server
+
+        :return: Counters, latency histograms and gauges of the server, see
+                 src.system.metrics.Metrics.snapshot
+        """
+        resp = self._request("STATS")
+        return {
+            key: value for key, value in resp.items() if key not in ("id", "status")
+        }
+
+    def profile(self, mode: str = "cpu", seconds: float = 10) -> List[str]:
+        """
+        Profiles the server. Blocks for the duration of the profile.
+
+        :param mode: "cpu" (cProfile of the event loop and stack samples of all
+                     threads) or "memory" (tracemalloc snapshots)
+        :param seconds: The duration of the profile
+        :return: The paths of the results, next to the server log
+        """
+        return self._request("PROFILE", mode=mode, seconds=seconds)["files"]
+
+    def trace(self, trace_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Gets the spans recorded by the server
+
+        :param trace_id: Only get the spans of this trace, if given
+        :return: The spans, as Chrome trace events
+        """
+        return self._request("TRACE", trace_id=trace_id)["events"]
+
+    def submit(self, op: str, container_name: Optional[str] = None, **args: Any) -> str:
+        """
+        Runs a long request in the background on the server. It keeps running if
+        the client goes away.
+
+        :param op: "INSTALL", "ARCHIVE", "START", "GET-FILE" or "PUT-FILE"
+        :param container_name: The container the request applies to
+        :param args: The arguments of the request. Local files are passed by path.
+        :return: The ID of the operation running the request
+        """
+        return self._request("SUBMIT", container_name, background_op=op, args=args)[
+            "operation"
+        ]
+
+    def operation(self, operation_id: str) -> Dict[str, Any]:
+        """
+        Gets the state of an operation
+
+        :param operation_id: The ID of the operation
+        :return: See src.system.operations.Operation.snapshot
+        """
+        return self._request("OPERATION", operation_id=operation_id)["operation"]
+
+    def operations(self) -> List[Dict[str, Any]]:
+        """
+        Gets the state of the operations running or recently finished
+
+        :return: See src.system.operations.Operation.snapshot
+        """
+        return self._request("OPERATION")["operations"]
+
+    def wait_operation(
+        self, operation_id: str, timeout: Optional[float] = None
+    ) -> Dict[str, Any]:
+        """
+        Waits for an operation to end
+
+        :param operation_id: The ID of the operation
+        :param timeout: Seconds to wait for at most, forever if not given
+        :return: The state of the operation, which may still be running once the
+                 timeout is over
+        """
+        return self._request("WAIT", operation_id=operation_id, timeout=timeout)[
+            "operation"
+        ]
+
+    def cancel_operation(self, operation_id: str) -> Dict[str, Any]:
+        """
+        Asks an operation to stop. It ends as "cancelled" once it did.
+
+        :param operation_id: The ID of the operation
+        :return: The state of the operation
+        """
+        return self._request("CANCEL", operation_id=operation_id)["operation"]
+
+    def follow_operation(
+        self,
+        operation_id: str,
+        on_progress: Optional[Callable[[Dict[str, Any]], None]] = None,
+        interval: float = 0.25,
+    ) -> Dict[str, Any]:
+        """
+        Waits for an operation to end, and raises its error if it failed or was
+        cancelled
+
+        :param operation_id: The ID of the operation
+        :param on_progress: Called with the state of the operation every interval
+                            seconds until it ends
+        :param interval: Seconds between two calls to on_progress
+        :return: The final state of the operation
+        """
+        while True:
+            snapshot = self.wait_operation(operation_id, interval)
+            if snapshot["state"] != "running":
+                break
+            if on_progress is not None:
+                on_progress(snapshot)
+        if "error" in snapshot:
+            get_server_error(snapshot["error"], snapshot["error_args"])
+        return snapshot
+
+    def subscribe(
+        self,
+        containers: Optional[List[str]] = None,
+        events: Optional[List[str]] = None,
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Streams the events of the server as they happen, over a connection of its
+        own which is closed once the generator is
+
+        :param containers: Glob patterns of the containers whose events are wanted,
+                           all events if not given
+        :param events: The kinds of events wanted, all of them if not given:
+                       "booting", "boot_phase", "running", "boot_failed",
+                       "stopping", "stopped", "killed", "crashed",
+                       "session_opened", "session_closed", "transfer"
+        :return: The events, each with its kind ("event"), its time ("time"), its
+                 container ("container") if any, and its details. "dropped" is set
+                 on the first event after events were dropped because the client
+                 fell behind.
+        """
         sock = self._make_connection()
-        sock.send(b"RENAME")
-        sock.recv_expect(b"CONT")
-        sock.send(bytes(old_name, "utf-8"))
-        sock.recv_expect(b"CONT")
-        sock.send(bytes(new_name, "utf-8"))
-        sock.recv_expect(b"OK")
-        sock.close()
+        try:
+            sock.request("SUBSCRIBE", containers=containers, events=events)
+            while True:
+                header = check_response(sock.recv_msg()[0])
+                if header.get("event") == "subscribed":
+                    continue
+                yield {key: value for key, value in header.items() if key != "status"}
+        finally:
+            sock.close()
 
-    def server_halt(self) -> None:
+    def server_halt(self) -> Dict[str, str]:
         """
-        Tells the server to halt
+        Tells the server to halt, and waits for it to stop its containers
+
+        :return: What happened to each container that was running:
+                 "stopped", "killed" or "unresponsive"
         """
         sock = self._make_connection()
-        sock.send(b"HALT")
-        sock.close()
+        try:
+            sock.request("HALT")
+            return sock.recv_response().get("results", {})
+        except ConnectionError:
+            return {}  # The server went away before it could report
+        finally:
+            sock.close()
 
     def server_panic(self) -> None:
         """
         Tells the server to PANIC!
         """
         sock = self._make_connection()
-        sock.send(b"PANIC")
+        sock.request("PANIC")
         sock.close()
 
+    def close(self) -> None:
+        """
+        Closes the connection to the server, if one is open
+        """
+        with self._connection_mutex:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
     def _make_connection(self) -> ClientServerSocket:
         """
-        Creates a connection to the server.
+        Creates a dedicated connection to the server.
 
         :return: The socket connection to the server.
         """
+        return ClientServerSocket(self._connect())
+
+    def _request(
+        self,
+        op: str,
+        container_name: Optional[str] = None,
+        on_event: Optional[Callable[[Dict[str, Any]], None]] = None,
+        **args: Any,
+    ) -> Dict[str, Any]:
+        """
+        Sends a single request to the server over the shared connection and waits
+        for its response. Safe to call from several threads at once.
+
+        :param op: The operation requested
+        :param container_name: The container the operation applies to, if any
+        :param on_event: Called with each event the server sends before responding
+        :param args: The arguments of the operation
+        :return: The response of the server
+        """
+        with traced(f"client {op}", container=container_name):
+            try:
+                return self._get_connection().request(
+                    op, container_name, on_event, **args
+                )
+            except _StaleConnectionError:
+                # The request never reached the server, so it is safe to resend it
+                return self._get_connection().request(
+                    op, container_name, on_event, **args
+                )
+
+    def _get_connection(self) -> "_MultiplexedConnection":
+        """
+        Gets the shared connection to the server, reconnecting if it was lost.
+
+        :return: The shared connection
+        """
+        with self._connection_mutex:
+            if self._connection is None or self._connection.closed:
+                self._connection = _MultiplexedConnection(
+                    ClientServerSocket(self._connect())
+                )
+            return self._connection
+
+    def _connect(self) -> socket.socket:
+        """
+        Opens a socket to the server, preferring its unix domain socket.
+
+        :return: The connected socket
+        """
+        if self.server_sock_path is not None:
+            sock = socket.socket(  # pylint: disable=not-callable
+                socket.AF_UNIX, socket.SOCK_STREAM  # pylint: disable=no-member
+            )
+            try:
+                sock.connect(self.server_sock_path)
+                return sock
+            except OSError:
+                sock.close()
+
         sock = socket.socket(  # pylint: disable=not-callable
             socket.AF_INET, socket.SOCK_STREAM  # pylint: disable=no-member
         )
         sock.connect(self.server_address)
-        my_sock = ClientServerSocket(sock)
-        my_sock.recv_expect(b"READY")
-        return my_sock
+        return sock
+
+
+class _StaleConnectionError(ConnectionError):
+    """
+    Raised when a request could not be sent because the connection was lost
+    """
+
+
+class _MultiplexedConnection:
+    """
+    Internal class used by ContainerManagerClient to send many concurrent requests
+    over one connection. Responses are matched to requests by their ID.
+
+    :param sock: The connection to the server
+    :param closed: Whether the connection was lost
+    """
+
+    sock: ClientServerSocket
+    closed: bool
+
+    def __init__(self, sock: ClientServerSocket) -> None:
+        self.sock = sock
+        self.closed = False
+        self._ids = itertools.count(1)
+        self._pending: Dict[int, "_PendingRequest"] = {}
+        self._mutex = threading.Lock()
+        threading.Thread(target=self._recv, daemon=True).start()
+
+    def request(
+        self,
+        op: str,
+        container_name: Optional[str] = None,
+        on_event: Optional[Callable[[Dict[str, Any]], None]] = None,
+        **args: Any,
+    ) -> Dict[str, Any]:
+        """
+        Sends a request and waits for its response. Blocking function.
+
+        :param op: The operation requested
+        :param container_name: The container the operation applies to, if any
+        :param on_event: Called with each event the server sends before responding,
+                         from the thread receiving responses
+        :param args: The arguments of the operation
+        :return: The response of the server
+        """
+        pending = _PendingRequest(on_event)
+        with self._mutex:
+            if self.closed:
+                raise _StaleConnectionError("Connection to the server was lost")
+            request_id = next(self._ids)
+            self._pending[request_id] = pending
+
+        try:
+            self.sock.request(op, container_name, request_id=request_id, **args)
+        except OSError as ex:
+            self._fail()
+            raise _StaleConnectionError("Connection to the server was lost") from ex
+
+        pending.event.wait()
+        if pending.response is None:
+            raise ConnectionError("Connection to the server was lost")
+        return check_response(pending.response)
+
+    def close(self) -> None:
+        """
+        Closes the connection
+        """
+        self.sock.close()
+        self._fail()
+
+    def _recv(self) -> None:
+        """
+        Receives responses and hands them to the requests waiting for them.
+        """
+        try:
+            while True:
+                header, _ = self.sock.recv_msg()
+                # Events precede the response, and leave the request pending
+                is_event = header.get("status") == "EVENT"
+                with self._mutex:
+                    if is_event:
+                        pending = self._pending.get(header.get("id"))
+                    else:
+                        pending = self._pending.pop(header.get("id"), None)
+                if pending is None:
+                    continue
+                if is_event:
+                    if pending.on_event is not None:
+                        pending.on_event(header)
+                else:
+                    pending.response = header
+                    pending.event.set()
+        except (ConnectionError, OSError, ValueError):
+            pass
+        finally:
+            self._fail()
+
+    def _fail(self) -> None:
+        """
+        Marks the connection as lost and wakes up every waiting request.
+        """
+        with self._mutex:
+            self.closed = True
+            pending, self._pending = self._pending, {}
+        for request in pending.values():
+            request.event.set()
+
+
+class _PendingRequest:
+    """
+    Internal class used by _MultiplexedConnection for a request awaiting a response.
+
+    :param event: Set once the response arrives or the connection is lost
+    :param response: The header of the response, if one arrived
+    :param on_event: Called with the events sent before the response, if any
+    """
+
+    event: threading.Event
+    response: Optional[Dict[str, Any]]
+    on_event: Optional[Callable[[Dict[str, Any]], None]]
+
+    def __init__(
+        self, on_event: Optional[Callable[[Dict[str, Any]], None]] = None
+    ) -> None:
+        self.event = threading.Event()
+        self.response = None
+        self.on_event = on_event
 
 
 class _RunCommandClient:
@@ -376,52 +939,82 @@ class _RunCommandClient:
     sock: ClientServerSocket
     recv_closed: bool
 
-    def __init__(self, sock: socket.socket, in_stream=sys.stdin, out_stream=sys.stdout):
+    def __init__(
+        self,
+        sock: ClientServerSocket,
+        in_stream=sys.stdin,
+        out_stream=sys.stdout,
+        err_stream=sys.stderr,
+    ):
         self.sock = sock
         self.recv_closed = False
         self.in_stream = in_stream
         self.out_stream = out_stream
+        self.err_stream = err_stream
 
         t_recv = threading.Thread(target=self._recv)
-        t_send = threading.Thread(
-            target=self._send_msvcrt if sys.platform == "win32" else self._send_select
-        )
+        # The session is over as soon as the server closes the connection; the
+        # sender notices recv_closed on its own and is not waited for
+        t_send = threading.Thread(target=self._sender(), daemon=True)
         t_recv.start()
         t_send.start()
         t_recv.join()
-        t_send.join()
+
+    def _sender(self) -> Callable[[], None]:
+        """
+        Picks how stdin is read, depending on the platform and on the stream.
+
+        :return: The function that sends stdin to the server
+        """
+        if sys.platform == "win32":
+            return self._send_msvcrt if self.in_stream.isatty() else self._send_blocking
+        try:
+            self.in_stream.fileno()
+        except (AttributeError, OSError, ValueError):
+            return self._send_blocking
+        return self._send_select
 
     def _send_select(self) -> None:
         """
-        Sends data read from stdin to the sever. POSIX only.
+        Sends data read from stdin to the sever, in large binary chunks. POSIX only.
         """
         try:
-            last_send = time.time()
+            fd = self.in_stream.fileno()
             while not self.recv_closed:
-                if select.select([self.in_stream], [], [], 0) == (
-                    [self.in_stream],
-                    [],
-                    [],
-                ):
-                    buffer = bytes(self.in_stream.readline(), "utf-8")
-                    while buffer:
-                        msg = buffer[:255]
-                        self.sock.send(bytes([len(msg)]) + msg)
-                        buffer = buffer[255:]
-                    last_send = time.time()
-                elif time.time() - last_send > 1:
-                    self.sock.send(b"\x00")
-                time.sleep(0.1)
+                # Wakes up every now and then to notice the end of the session
+                if not select.select([fd], [], [], 0.5)[0]:
+                    continue
+                data = os.read(fd, INPUT_CHUNK_SIZE)
+                if not data:
+                    self.sock.send_msg({"stream": 0, "eof": True})
+                    return
+                self.sock.send_msg({"stream": 0}, data)
         except (ConnectionError, OSError):
             pass
-        finally:
-            self.sock.close()
+
+    def _send_blocking(self) -> None:
+        """
+        Sends data read from stdin to the sever, for streams that cannot be polled.
+        """
+        stream = getattr(self.in_stream, "buffer", self.in_stream)
+        read = getattr(stream, "read1", stream.read)
+        try:
+            while not self.recv_closed:
+                data = read(INPUT_CHUNK_SIZE)
+                if not data:
+                    self.sock.send_msg({"stream": 0, "eof": True})
+                    return
+                if isinstance(data, str):
+                    data = data.encode("utf-8")
+                self.sock.send_msg({"stream": 0}, data)
+        except (ConnectionError, OSError, ValueError):
+            pass
 
     def _send_msvcrt(self) -> None:
         """
-        Sends data read from stdin to the sever. Windows only.
+        Sends lines typed into the console to the sever. Windows only.
         """
-        try:  # pylint: disable=too-many-nested-blocks
+        try:
             msg = ""
             while not self.recv_closed:
                 while msvcrt.kbhit():
@@ -429,11 +1022,7 @@ class _RunCommandClient:
 
                     if char == "\r":
                         print(end="\n")
-                        buffer = bytes(msg + "\n", "utf-8")
-                        while buffer:
-                            msg = buffer[:255]
-                            self.sock.send(bytes([len(msg)]) + msg)
-                            buffer = buffer[255:]
+                        self.sock.send_msg({"stream": 0}, bytes(msg + "\n", "utf-8"))
                         msg = ""
 
                     elif char == "\b":
@@ -446,32 +1035,103 @@ class _RunCommandClient:
                 time.sleep(0.1)
         except (ConnectionError, OSError):
             pass
-        finally:
-            self.sock.close()
 
     def _recv(self) -> None:
         """
         Receives and outputs data read from the server.
         """
+        sinks = {1: _OutputSink(self.out_stream), 2: _OutputSink(self.err_stream)}
         try:
-            while msg := self.sock.recv():
-                i = 0
-                while i < len(msg):
-                    stream = msg[i]
-                    mybyte = msg[i + 1]
-                    i += 2
-                    if stream == 0:
-                        pass
-                    elif stream == 1:
-                        self.out_stream.write(bytes((mybyte,)).decode("utf-8"))
-                        self.out_stream.flush()
-                    elif stream == 2:
-                        self.out_stream.write(bytes((mybyte,)).decode("utf-8"))
-                        self.out_stream.flush()
-                    else:
-                        raise RuntimeError("recv'd bad data")
+            while True:
+                header, body = self.sock.recv_msg()
+                stream = header.get("stream")
+                if stream in sinks:
+                    sinks[stream].write(body)
+                elif stream != 0:
+                    raise RuntimeError("recv'd bad data")
+                # Output is only flushed once the server has nothing more queued
+                if not self.sock.readable():
+                    for sink in sinks.values():
+                        sink.flush()
         except (ConnectionError, OSError):
             pass
         finally:
+            for sink in sinks.values():
+                sink.close()
             self.sock.close()
             self.recv_closed = True
+
+
+def _sink_fds(sinks: Dict[int, "_OutputSink"]) -> Optional[List[int]]:
+    """
+    Gets the file descriptors handed to the server for a captured RUN-COMMAND
+
+    :param sinks: Where stdout (1) and stderr (2) go
+    :return: [stdout, stderr], or None if the sinks are not backed by files
+    """
+    try:
+        for sink in sinks.values():
+            sink.flush()
+        return [
+            (sinks[stream].binary or sinks[stream].stream).fileno() for stream in (1, 2)
+        ]
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+class _OutputSink:
+    """
+    Internal class used by run_command and capture_command. Writes one stream of a command's
+    output. Raw bytes go to binary streams, and to the binary buffer underneath
+    text streams that have one; other text streams get incrementally decoded text.
+
+    :param stream: The stream written to
+    :param binary: The binary stream written to, if any
+    :param decoder: The decoder for text streams without a binary buffer
+    """
+
+    stream: Any
+    binary: Optional[BinaryIO] = None
+    decoder: Optional[codecs.IncrementalDecoder] = None
+
+    def __init__(self, stream) -> None:
+        self.stream = stream
+        if isinstance(stream, (io.RawIOBase, io.BufferedIOBase)):
+            self.binary = stream
+        else:
+            self.binary = getattr(stream, "buffer", None)
+            if self.binary is not None:
+                stream.flush()  # Keep text written earlier ahead of the output
+
+        if self.binary is None:
+            self.decoder = codecs.getincrementaldecoder(
+                getattr(stream, "encoding", None) or "utf-8"
+            )(errors="replace")
+
+    def write(self, data: bytes) -> None:
+        """
+        Writes output, without flushing it
+
+        :param data: The output
+        """
+        if self.binary is not None:
+            self.binary.write(data)
+        else:
+            self.stream.write(self.decoder.decode(data))
+
+    def flush(self) -> None:
+        """
+        Flushes the output written so far
+        """
+        (self.binary if self.binary is not None else self.stream).flush()
+
+    def close(self) -> None:
+        """
+        Writes out anything left in the decoder and flushes. Does not close the stream.
+        """
+        try:
+            if self.decoder is not None:
+                self.stream.write(self.decoder.decode(b"", final=True))
+            self.flush()
+        except (ValueError, OSError):
+            pass
@@ -2,70 +2,242 @@
 The server version of the container manager
 """
 
+import asyncio
+import contextvars
+import cProfile
+import fnmatch
+import functools
 import json
 import logging
 import os
 import shutil
 import socket
 import sys
-import threading
 import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AsyncExitStack, asynccontextmanager, suppress
 from pathlib import Path
 from signal import SIGABRT
-from typing import Dict, Optional, Tuple
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+)
 
 import psutil
-from paramiko import SSHException
 from paramiko.channel import ChannelFile, ChannelStderrFile, ChannelStdinFile
 
 from src.containers.container import Container
-from src.containers.container_extras import (archive_container,
-                                             install_container)
-from src.containers.exceptions import BootFailure, PoweroffTimeoutExceededError
-from src.containers.port_allocation import allocate_port
-from src.system.my_socket import ClientServerSocket
-from src.system.syspath import get_container_dir, get_server_info_file
+from src.containers.container_extras import (
+    archive_container,
+    clone_container,
+    find_clones,
+    get_image,
+    install_container,
+)
+from src.containers.container_lifecycle import ContainerLifecycle, ContainerState
+from src.containers.exceptions import (
+    BootFailure,
+    ImageInUseError,
+    InvalidConfigError,
+)
+from src.containers.session_workers import SessionWorkerPool
+from src.containers.warm_pool import (
+    POOL_PARALLELISM,
+    WarmPool,
+    load_pool_sizes,
+    save_pool_sizes,
+)
+from src.system.async_socket import AsyncClientServerSocket, Responder, wait_readable
+from src.system.events import EventBus
+from src.system.metrics import Metrics
+from src.system.operations import (
+    Operation,
+    OperationCancelled,
+    Operations,
+    current_operation,
+    report_progress,
+)
+from src.system.profiling import StackSampler, write_cpu_profile, write_memory_report
+from src.system.readiness import notify_ready
+from src.system.server_logging import stop_server_logging
+from src.system.syspath import (
+    get_container_dir,
+    get_container_home,
+    get_container_id_rsa,
+    get_server_info_file,
+    get_server_log_file,
+    get_server_socket_file,
+)
+from src.system.tracing import current_trace, span, tracer
+
+T = TypeVar("T")
+
+# Output of a run session is read and sent in chunks of up to this size
+OUTPUT_CHUNK_SIZE = 1 << 18
+# Number of chunks a run session buffers before it stops reading the channel
+OUTPUT_QUEUE_SIZE = 16
+# Input of a run session is read from the client's stdin in chunks of this size
+INPUT_CHUNK_SIZE = 1 << 16
+# Seconds a run session may be idle before a keepalive is sent to the client
+KEEPALIVE_INTERVAL = 1.0
+# Seconds to wait for the exit status of a command once its output ended
+EXIT_STATUS_WAIT = 1.0
+# Seconds containers get to power off when the server halts, before being killed
+HALT_DEADLINE = 20.0
+# Seconds a container gets to die once it is killed
+KILL_TIMEOUT = 10.0
+# Number of containers a BATCH request works on at once, unless it says otherwise
+BATCH_PARALLELISM = 8
+# Seconds between two checks for containers whose QEMU process exited on its own
+CRASH_CHECK_INTERVAL = 1.0
+# Requests that SUBMIT may run in the background
+BACKGROUND_OPS = ("INSTALL", "ARCHIVE", "START", "GET-FILE", "PUT-FILE")
 
 
 class ContainerManagerServer:
     """
     Class for managing container objects. Accessed by ContainerManagerClient.
 
+    All connections and sessions are served by a single asyncio event loop. Blocking
+    work (paramiko, QEMU, file system) is offloaded to a bounded thread pool.
+
     :param backlog: Amount of socket connections the server will accept simultaneously.
+    :param max_workers: Maximum number of threads used for blocking work.
     :param address: (IP, PORT) of the server.
     :param server_sock: Socket of the server.
-    :param containers: A dictionary for all of the containers
+    :param unix_sock: Unix domain socket of the server, on platforms supporting it.
+    :param containers: The lifecycle of every container the server has dealt with
     :param logger: Logger
+    :param metrics: Metrics of the server, reported by STATS
+    :param events: Events of the server, streamed to SUBSCRIBE requests
+    :param operations: Requests running in the background, see SUBMIT
+    :param metrics_port: Port of the localhost endpoint serving metrics in the
+                         Prometheus text format, if enabled. 0 picks a free port.
+    :param session_workers: Number of worker processes streaming run sessions and
+                            file transfers, see SessionWorkerPool. 0 keeps them in
+                            the server process. Ignored without unix sockets.
+    :param workers: The worker processes, if enabled
+    :param pool_parallelism: Number of containers of the warm pool booted at once
+    :param pool: Containers booted ahead of time for the images in pool.json, see
+                 WarmPool
     """
 
     backlog: int = 20
+    max_workers: int = 16
     address: Tuple[str, int]
     server_sock: Optional[socket.socket] = None
-    containers: Dict[str, Container] = {}
+    unix_sock: Optional[socket.socket] = None
+    containers: Dict[str, ContainerLifecycle] = {}
     logger: logging.Logger
-    startup_mutex: threading.Lock = threading.Lock()
-    halt_event: threading.Event = threading.Event()
+    metrics: Metrics
+    events: EventBus
+    operations: Operations
+    metrics_port: Optional[int] = None
+    session_workers: int = 0
+    workers: Optional[SessionWorkerPool] = None
+    pool_parallelism: int = POOL_PARALLELISM
+    pool: WarmPool
+    loop: asyncio.AbstractEventLoop
+    executor: ThreadPoolExecutor
+    halt_event: asyncio.Event
+    halted: "asyncio.Future[Dict[str, str]]"
+    profile_lock: asyncio.Lock
 
-    def __init__(self, logger: logging.Logger):
+    def __init__(
+        self,
+        logger: logging.Logger,
+        metrics_port: Optional[int] = None,
+        session_workers: int = 0,
+        pool_parallelism: int = POOL_PARALLELISM,
+    ):
         self.logger = logger
+        self.metrics_port = metrics_port
+        self.session_workers = session_workers
+        self.pool_parallelism = pool_parallelism
+        self.metrics = Metrics()
+        self.events = EventBus()
+        try:
+            pool_sizes = load_pool_sizes()
+        except (InvalidConfigError, ValueError) as exc:
+            self.logger.warning("MAIN THREAD: Ignoring the warm pool: %s", exc)
+            pool_sizes = {}
+        self.pool = WarmPool(
+            pool_sizes,
+            self.pool_parallelism,
+            self.logger,
+            self.offload,
+            self.spawn,
+            self.events,
+            self._image_busy,
+        )
+        self.metrics.gauges["containers_booting"] = lambda: self._count_containers(
+            ContainerState.BOOTING
+        )
+        self.metrics.gauges["containers_running"] = lambda: self._count_containers(
+            ContainerState.RUNNING
+        )
+        self.metrics.gauges["containers_pooled"] = self.pool.count_ready
+        tracer.process_name = "jabberwocky server"
+        self.halt_requests: Set[asyncio.Task] = set()
+        self._tasks: Set[asyncio.Task] = set()
 
     def listen(self) -> None:
         """
         Listens for incoming connections. Blocking function.
         """
+        if sys.platform == "win32":
+            # paramiko's channel notification pipes are sockets on Windows, which
+            # only the selector event loop can watch.
+            asyncio.set_event_loop_policy(
+                asyncio.WindowsSelectorEventLoopPolicy()  # pylint: disable=no-member
+            )
+        asyncio.run(self._serve())
+        self.logger.debug("MAIN THREAD: Exiting NOW.")
+        sys.exit()
 
-        self.address = (
-            socket.gethostbyname("127.0.0.1"),  # pylint: disable=no-member
-            allocate_port(22300),
-        )
-        self.logger.debug(
-            "MAIN THREAD: Starting Container Manager Server @ %s", self.address
+    async def _serve(self) -> None:
+        """
+        Runs the server until a HALT is requested.
+        """
+        self.loop = asyncio.get_running_loop()
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="jab-worker"
         )
+        self.loop.set_default_executor(self.executor)
+        self.halt_event = asyncio.Event()
+        self.halted = self.loop.create_future()
+        self.profile_lock = asyncio.Lock()
+        self.operations = Operations()
+        if self.session_workers and self.unix_sock_supported():
+            # Started first, so that they are up by the time the CLI connects
+            self.workers = SessionWorkerPool(self.session_workers, self.logger)
+            self.workers.start()
+            self.logger.debug(
+                "MAIN THREAD: Started %d session workers", self.session_workers
+            )
+
+        # Port 0 lets the OS pick a free port, so there is no need to scan for one
         self.server_sock = socket.socket(  # pylint: disable=not-callable
             socket.AF_INET, socket.SOCK_STREAM  # pylint: disable=no-member
         )
-        self.server_sock.bind(self.address)
+        self.server_sock.bind(
+            (socket.gethostbyname("127.0.0.1"), 0)  # pylint: disable=no-member
+        )
         self.server_sock.listen(self.backlog)
+        self.server_sock.setblocking(False)
+        self.address = self.server_sock.getsockname()
+        self.logger.debug(
+            "MAIN THREAD: Starting Container Manager Server @ %s", self.address
+        )
 
         server_info = {
             "addr": self.address[0],
@@ -74,81 +246,360 @@ class ContainerManagerServer:
             "boot": time.time(),
         }
 
+        listeners = [self.server_sock]
+        if self.unix_sock_supported():
+            self.unix_sock = self._bind_unix_socket()
+            listeners.append(self.unix_sock)
+            server_info["sock"] = str(get_server_socket_file())
+            self.logger.debug("MAIN THREAD: Listening on %s", get_server_socket_file())
+
+        metrics_server = None
+        if self.metrics_port is not None:
+            metrics_server = await asyncio.start_server(
+                self._serve_metrics, "127.0.0.1", self.metrics_port
+            )
+            self.metrics_port = metrics_server.sockets[0].getsockname()[1]
+            server_info["metrics_port"] = self.metrics_port
+            self.logger.debug(
+                "MAIN THREAD: Serving metrics @ http://127.0.0.1:%d/metrics",
+                self.metrics_port,
+            )
+
         with open(get_server_info_file(), "w", encoding="utf-8") as f:
             json.dump(server_info, f)
+        notify_ready(server_info)
 
-        threading.Thread(target=self._listen, daemon=True).start()
-        self.halt_event.wait()
+        tasks = [self.spawn(self._listen(sock)) for sock in listeners]
+        tasks.append(self.spawn(self._watch_crashes()))
+        self.spawn(self.pool.start())
+        await self.halt_event.wait()
         self.logger.debug("MAIN THREAD: HALT event reached. Stopping.")
-        self.server_sock.close()
-        self.stop()
-        self.logger.debug("MAIN THREAD: Exiting NOW.")
-        sys.exit()
+        for task in tasks:
+            task.cancel()
+        for sock in listeners:
+            sock.close()
+        if metrics_server is not None:
+            metrics_server.close()
+        self.halted.set_result(await self.stop())
+        if self.workers is not None:
+            self.workers.stop()
+        # Give HALT requests the chance to report the results before exiting
+        if self.halt_requests:
+            await asyncio.wait(self.halt_requests, timeout=1)
+        self.executor.shutdown(wait=False)
+
+    @staticmethod
+    def unix_sock_supported() -> bool:
+        """
+        Determines whether the server listens on a unix domain socket
+
+        :return: True if unix domain sockets are supported on this platform
+        """
+        return sys.platform != "win32" and hasattr(socket, "AF_UNIX")
+
+    def _bind_unix_socket(self) -> socket.socket:
+        """
+        Binds the unix domain socket. Only the current user may connect to it.
+
+        :return: The listening socket
+        """
+        path = get_server_socket_file()
+        if path.exists():
+            path.unlink()
 
-    def _listen(self):
+        sock = socket.socket(  # pylint: disable=not-callable
+            socket.AF_UNIX, socket.SOCK_STREAM  # pylint: disable=no-member
+        )
+        old_umask = os.umask(0o177)
+        try:
+            sock.bind(str(path))
+        finally:
+            os.umask(old_umask)
+        sock.listen(self.backlog)
+        sock.setblocking(False)
+        return sock
+
+    async def _listen(self, server_sock: socket.socket) -> None:
         try:
             while True:
-                client_sock, client_addr = self.server_sock.accept()
+                client_sock, client_addr = await self.loop.sock_accept(server_sock)
                 self.logger.debug(
-                    "MAIN THREAD: Accepted connection from %s", client_addr
+                    "MAIN THREAD: Accepted connection from %s", client_addr or "unix"
+                )
+                self.spawn(
+                    _SocketConnection(client_sock, client_addr, self).start_connection()
                 )
-                threading.Thread(
-                    target=_SocketConnection(
-                        client_sock, client_addr, self
-                    ).start_connection,
-                    daemon=True,
-                ).start()
+        except asyncio.CancelledError:
+            raise
         except Exception as ex:  # pylint: disable=broad-except
             self.logger.exception(ex)
             self.halt_event.set()
 
-    def stop(self) -> None:
+    async def _watch_crashes(self) -> None:
         """
-        Stops the container manager server
+        Periodically notices the running containers that exited on their own
         """
-        for name, container in self.containers.items():
-            self.logger.debug("STOP: Closing %s", name)
-            try:
-                container.stop()
-                self.logger.debug(
-                    f"STOP: Poweroff'd {name} (PID={container.booter.pid})."
-                )
-            except (PoweroffTimeoutExceededError, SSHException, AttributeError):
+        while True:
+            await asyncio.sleep(CRASH_CHECK_INTERVAL)
+            self.pool.prune()
+            for lifecycle in list(self.containers.values()):
                 try:
-                    self.logger.error(
-                        f"STOP: POWEROFF FAILED. Killing {name} (PID="
-                        f"{container.booter.pid})."
-                    )
-                    container.kill()
-                except (PermissionError, AttributeError) as exc:
-                    msg = (
-                        f"STOP: COULD NOT KILL {name} (PID={container.booter.pid}). "
-                        f"Reason: {type(exc).__name__}. (The process is probably dead.)"
-                    )
-                    self.logger.error(msg)
-                else:
-                    self.logger.info(f"STOP: Killed {name}@{container.booter.pid}.")
+                    await lifecycle.check_crashed()
+                except Exception as ex:  # pylint: disable=broad-except
+                    self.logger.exception(ex)
 
-        os.remove(get_server_info_file())
+    async def _serve_metrics(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        """
+        Answers an HTTP request with the metrics in the Prometheus text format,
+        whatever the path.
+        """
+        try:
+            await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=5)
+            body = self.metrics.prometheus().encode("utf-8")
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                + f"Content-Length: {len(body)}\r\n".encode("ascii")
+                + b"Connection: close\r\n\r\n"
+                + body
+            )
+            await writer.drain()
+        except (
+            asyncio.TimeoutError,
+            asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError,
+            OSError,
+        ):
+            pass
+        finally:
+            writer.close()
+
+    def _count_containers(self, state: ContainerState) -> int:
+        """
+        :param state: A state of containers
+        :return: The number of containers in that state
+        """
+        return sum(lifecycle.state is state for lifecycle in self.containers.values())
+
+    def _image_busy(self, image: str) -> bool:
+        """
+        :param image: The name of a container
+        :return: Whether the container is running, or its files are being modified
+        """
+        lifecycle = self.containers.get(image)
+        return lifecycle is not None and (
+            lifecycle.state is not ContainerState.STOPPED or lifecycle.lock.locked()
+        )
+
+    async def image_users(self, image: str) -> List[str]:
+        """
+        Finds what runs on the disk of a container, which must then neither be
+        started nor modified
+
+        :param image: The name of the container
+        :return: The names of its clones, and "its warm pool" if it has one
+        """
+        users = await self.offload(find_clones, image)
+        if self.pool.holds(image):
+            users.append("its warm pool")
+        return users
+
+    def spawn(self, coro: Awaitable[T]) -> "asyncio.Task[T]":
+        """
+        Runs a coroutine in the background, keeping a reference to it until it is
+        done.
+
+        :param coro: The coroutine to run
+        :return: The task running the coroutine
+        """
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def offload(self, func: Callable[..., T], *args: Any) -> T:
+        """
+        Runs a blocking function in the worker thread pool. The function runs in a
+        copy of the current context, so it is traced as part of the same request.
+
+        :param func: The function to run
+        :param args: The arguments passed to the function
+        :return: The return value of the function
+        """
+        context = contextvars.copy_context()
+        return await self.loop.run_in_executor(
+            self.executor, functools.partial(context.run, func, *args)
+        )
+
+    def match_containers(self, patterns: List[str]) -> List[str]:
+        """
+        Finds the containers matching names or glob patterns. Patterns only match
+        installed containers; plain names are kept even if nothing matches them.
+
+        :param patterns: Names of containers, or glob patterns such as "lab_*"
+        :return: The names of the matching containers, sorted and without duplicates
+        """
+        installed = [path.name for path in get_container_home().iterdir()]
+        installed = [
+            name
+            for name in installed
+            if get_container_dir(name).is_dir() and not name.startswith(".")
+        ]
+        names: Set[str] = set()
+        for pattern in patterns:
+            if any(char in pattern for char in "*?["):
+                names.update(fnmatch.filter(installed, pattern))
+            else:
+                names.add(pattern)
+        return sorted(names)
+
+    def lifecycle(self, container_name: str) -> ContainerLifecycle:
+        """
+        Gets the lifecycle of a container, tracking it from now on if needed
+
+        :param container_name: The name of the container
+        :return: The lifecycle of the container
+        """
+        if container_name not in self.containers:
+            self.containers[container_name] = ContainerLifecycle(
+                container_name,
+                self.logger,
+                self.offload,
+                self.metrics,
+                self.events,
+                self.pool,
+                self.image_users,
+            )
+        return self.containers[container_name]
+
+    def running(self, container_name: str) -> Optional[Container]:
+        """
+        Gets a container, if it is running
+
+        :param container_name: The name of the container
+        :return: The container, or None if it is not running
+        """
+        if container_name not in self.containers:
+            return None
+        return self.containers[container_name].running
+
+    @asynccontextmanager
+    async def modifying(self, *container_names: str) -> AsyncIterator[bool]:
+        """
+        Holds the locks of containers while their files are being modified, so
+        that none of them can be started meanwhile. Locks are taken in a fixed order.
+
+        :param container_names: The names of the containers
+        :return: Yields whether all of the containers are stopped
+        """
+        lifecycles = [self.lifecycle(name) for name in sorted(set(container_names))]
+        async with AsyncExitStack() as stack:
+            for lifecycle in lifecycles:
+                await stack.enter_async_context(lifecycle.lock)
+            yield all(
+                lifecycle.state is ContainerState.STOPPED for lifecycle in lifecycles
+            )
+
+    async def stop(self) -> Dict[str, str]:
+        """
+        Stops the container manager server. All containers are powered off at once;
+        any container still up at the HALT_DEADLINE is killed.
+
+        :return: What happened to each container that was not stopped
+        """
+        # Containers of the pool are disposable, so they are killed right away
+        await self.pool.stop()
+        lifecycles = [
+            lifecycle
+            for lifecycle in self.containers.values()
+            if lifecycle.state is not ContainerState.STOPPED
+        ]
+        # Every poweroff blocks a thread while it waits, so they get a pool of their
+        # own, big enough for all of them to wait at the same time
+        self.executor.shutdown(wait=False)
+        self.executor = ThreadPoolExecutor(
+            max_workers=max(len(lifecycles), 1), thread_name_prefix="jab-halt"
+        )
+
+        deadline = self.loop.time() + HALT_DEADLINE
+        results = await asyncio.gather(
+            *(self._stop_container(lifecycle, deadline) for lifecycle in lifecycles)
+        )
+
+        self._remove_server_files()
         self.logger.debug("STOP: STOP complete.")
+        return {
+            lifecycle.name: result for lifecycle, result in zip(lifecycles, results)
+        }
+
+    async def _stop_container(
+        self, lifecycle: ContainerLifecycle, deadline: float
+    ) -> str:
+        """
+        Powers a container off, killing it if that fails or misses the deadline
+
+        :param lifecycle: The lifecycle of the container
+        :param deadline: Event loop time by which the container must be powered off
+        :return: "stopped", "killed" or "unresponsive"
+        """
+        name = lifecycle.name
+        self.logger.debug("STOP: Closing %s", name)
+
+        poweroff = self.spawn(lifecycle.stop())
+        await asyncio.wait([poweroff], timeout=max(deadline - self.loop.time(), 0))
+        if poweroff.done() and not poweroff.exception():
+            self.logger.debug("STOP: Poweroff'd %s.", name)
+            return "stopped"
+
+        if poweroff.done():
+            reason = type(poweroff.exception()).__name__
+        else:
+            reason = "deadline exceeded"
+        self.logger.error("STOP: POWEROFF FAILED (%s). Killing %s.", reason, name)
+        try:
+            await asyncio.wait_for(lifecycle.kill(), KILL_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.logger.error("STOP: COULD NOT KILL %s in time.", name)
+            return "unresponsive"
+        except OSError as exc:
+            self.logger.error(
+                "STOP: COULD NOT KILL %s. Reason: %s. (The process is probably dead.)",
+                name,
+                type(exc).__name__,
+            )
+        else:
+            self.logger.info("STOP: Killed %s.", name)
+        return "killed"
 
     def panic(self, reason: Optional[str] = None) -> None:
         """
         Kills indiscriminately all QEMU processes on the system, then calls stop()
         """
-        self.logger.error(f"PANICKING!!! Reason given: {reason}")
+        self.logger.error("PANICKING!!! Reason given: %s", reason)
         for proc in psutil.process_iter():
             if "qemu-system-" in proc.name().lower():
                 proc.kill()
-                self.logger.error(f"PANIC: KILLED {proc.pid}!")
-        os.remove(get_server_info_file())
+                self.logger.error("PANIC: KILLED %d!", proc.pid)
+        self._remove_server_files()
         self.logger.debug("PANIC: Server will ABORT now.")
+        stop_server_logging()
         os.kill(os.getpid(), SIGABRT)
 
+    def _remove_server_files(self) -> None:
+        """
+        Removes the files advertising the server to clients
+        """
+        os.remove(get_server_info_file())
+        if self.unix_sock is not None and get_server_socket_file().exists():
+            os.remove(get_server_socket_file())
+
 
 class _SocketConnection:
     """
     Internal class used by ContaienrManagerServer to handle an individual connection.
+    A connection carries many requests, each tagged with an ID chosen by the client.
 
     :param manager: The parent ContainerManagerServer object
     :param client_sock: Client socket
@@ -156,7 +607,7 @@ class _SocketConnection:
     """
 
     manager: ContainerManagerServer
-    sock: ClientServerSocket
+    sock: AsyncClientServerSocket
     client_addr: Tuple[str, int]
 
     def __init__(
@@ -165,437 +616,1030 @@ class _SocketConnection:
         client_addr: Tuple[str, int],
         manager: ContainerManagerServer,
     ):
-        self.sock = ClientServerSocket(client_sock)
+        self.sock = AsyncClientServerSocket(client_sock)
         self.client_addr = client_addr
         self.manager = manager
 
-    def start_connection(self) -> None:
+    async def start_connection(self) -> None:
         """
         Facilitates the communication between the server and the inidivual client.
-        Blocking function.
+        Reads requests until the client hangs up, handling each one concurrently.
         """
+        self.manager.metrics.add_connections(1)
+        try:
+            while True:
+                request, _ = await self.sock.recv_msg()
+                fds = self.sock.take_fds(request.get("fds", 0))
+                handler = _RequestHandler(Responder(self.sock, request.get("id")), self)
 
-        self.sock.send(b"READY")
+                if request.get("op") in ("RUN-COMMAND", "SUBSCRIBE"):
+                    # The rest of the connection is the command's I/O stream, or
+                    # the event stream
+                    await handler.handle(request, fds)
+                    return
 
-        try:
-            msg = self.sock.recv(1024)
-            self.manager.logger.debug("Recieved %s from the client", msg)
+                self.manager.spawn(handler.handle(request, fds))
+        except (ConnectionError, OSError):
+            pass
+        except Exception as ex:  # pylint: disable=broad-except
+            self.manager.logger.exception(ex)
+        finally:
+            self.sock.close()
+            self.manager.metrics.add_connections(-1)
 
-            if msg == b"HALT":
-                self.manager.halt_event.set()
-                return
-            if msg == b"PANIC":
-                self.manager.panic("Received PANIC command.")
-                return
 
-            {
-                b"UPDATE-HOSTKEY": self._update_hostkey,
-                b"RUN-COMMAND": self._run_command,
-                b"SSH-ADDRESS": self._address,
-                b"GET-FILE": self._get,
-                b"PUT-FILE": self._put,
-                b"START": self._start,
-                b"STOP": self._stop,
-                b"KILL": self._kill,
-                b"PING": self._ping,
-                b"INSTALL": self._install,
-                b"DELETE": self._delete,
-                b"RENAME": self._rename,
-                b"STARTED": self._started,
-                b"ARCHIVE": self._archive,
-            }[msg]()
-
-        except KeyError:
-            self.sock.raise_unknown_request(msg)
+class _OperationResponder(Responder):
+    """
+    Internal class used by _RequestHandler in place of the Responder of a request
+    run in the background. Records the outcome of the request in its operation
+    instead of sending it.
+
+    :param operation: The operation of the request
+    """
+
+    operation: Operation
+
+    def __init__(self, operation: Operation) -> None:
+        super().__init__(None, None)
+        self.operation = operation
+
+    async def send_msg(self, header: Dict[str, Any], body: bytes = b"") -> None:
+        self.status = header.get("status", self.status)
+        if self.status == "OK":
+            self.operation.end()
+        elif self.status == "ERROR":
+            self.operation.end(header["error"], **header.get("args", {}))
+
+
+class _RequestHandler:
+    """
+    Internal class used by _SocketConnection to handle a single request.
+
+    :param sock: Sends the response to the request
+    :param connection: The connection the request came from
+    :param manager: The parent ContainerManagerServer object
+    """
+
+    sock: Responder
+    connection: _SocketConnection
+    manager: ContainerManagerServer
+
+    def __init__(self, sock: Responder, connection: _SocketConnection):
+        self.sock = sock
+        self.connection = connection
+        self.manager = connection.manager
+
+    async def handle(self, request: Dict[str, Any], fds: List[int]) -> None:
+        """
+        Dispatches a request and sends its response.
+
+        :param request: The header of the request frame
+        :param fds: File descriptors sent along with the request. Closed once the
+                    request has been handled.
+        """
+
+        op = request.get("op")
+        handlers = {
+            "UPDATE-HOSTKEY": self._update_hostkey,
+            "RUN-COMMAND": self._run_command,
+            "SSH-ADDRESS": self._address,
+            "GET-FILE": self._get,
+            "PUT-FILE": self._put,
+            "START": self._start,
+            "STOP": self._stop,
+            "KILL": self._kill,
+            "PING": self._ping,
+            "INSTALL": self._install,
+            "DELETE": self._delete,
+            "RENAME": self._rename,
+            "CLONE": self._clone,
+            "POOL": self._pool,
+            "STARTED": self._started,
+            "ARCHIVE": self._archive,
+            "STATS": self._stats,
+            "PROFILE": self._profile,
+            "TRACE": self._trace,
+            "BATCH": self._batch,
+            "OPEN-SESSION": self._open_session,
+            "SUBSCRIBE": self._subscribe,
+            "SUBMIT": self._submit,
+            "OPERATION": self._operation,
+            "WAIT": self._wait,
+            "CANCEL": self._cancel,
+        }
+        # Looked up apart from the call, so that a KeyError raised by a handler is
+        # not mistaken for an unknown request
+        handler = handlers.get(op) if isinstance(op, str) else None
+        began = time.monotonic()
+        trace = current_trace.set(request.get("trace"))
+        try:
+            args = dict(request.get("args", {}))
+            if "container" in request:
+                args["container_name"] = request["container"]
+            if fds:
+                args["fds"] = fds
+            self.manager.logger.debug("Recieved %s from the client", op)
+
+            with span(str(op), container=request.get("container")):
+                if op == "HALT":
+                    await self._halt()
+                    return
+                if op == "PANIC":
+                    self.manager.panic("Received PANIC command.")
+                    return
+
+                if handler is None:
+                    await self.sock.raise_unknown_request(str(op))
+                    return
+                await handler(**args)
+
+        except OperationCancelled as ex:
+            await self.sock.raise_operation_cancelled(str(ex))
         except (ConnectionError, OSError) as ex:
             self.manager.logger.exception(ex)
-            self.sock.raise_exception()
+            await self.sock.raise_exception()
         except Exception as ex:  # pylint: disable=broad-except
             self.manager.logger.exception(ex)
-            self.sock.raise_exception()
+            await self.sock.raise_exception()
         finally:
-            self.sock.close()
+            current_trace.reset(trace)
+            for fd in fds:
+                os.close(fd)
+            # Unknown ops are counted together, so clients cannot add metrics
+            self.manager.metrics.observe_request(
+                op if handler is not None or op == "HALT" else "UNKNOWN",
+                time.monotonic() - began,
+                self.sock.status == "ERROR",
+            )
 
-    def _ping(self) -> None:
+    async def _halt(self) -> None:
+        """
+        Halts the server, and reports what happened to each container
+        """
+        self.manager.halt_requests.add(asyncio.current_task())
+        self.manager.halt_event.set()
+        await self.sock.ok(results=await asyncio.shield(self.manager.halted))
+
+    async def _stats(self) -> None:
+        """
+        Sends the metrics of the server
+        """
+        await self.sock.ok(**self.manager.metrics.snapshot())
+
+    async def _submit(
+        self,
+        background_op: str,
+        args: Optional[Dict[str, Any]] = None,
+        container_name: Optional[str] = None,
+    ) -> None:
+        """
+        Runs a long request in the background, and sends the ID of its operation
+        right away. Its progress is then polled with OPERATION, awaited with WAIT
+        and cut short with CANCEL, from any connection. Files are transferred from
+        and to paths, as the client may be gone by the time they are.
+
+        :param background_op: The request, one of BACKGROUND_OPS
+        :param args: The arguments of the request
+        :param container_name: The container the request applies to
+        """
+        if background_op not in BACKGROUND_OPS:
+            await self.sock.raise_unknown_request(f"SUBMIT {background_op}")
+            return
+
+        request: Dict[str, Any] = {"op": background_op, "args": args or {}}
+        if container_name is not None:
+            request["container"] = container_name
+        if current_trace.get() is not None:
+            request["trace"] = current_trace.get()
+
+        operation = self.manager.operations.create(background_op, container_name)
+        self.manager.spawn(self._run_operation(operation, request))
+        self.manager.logger.debug("Submitted %s as %s", background_op, operation.id)
+        await self.sock.ok(operation=operation.id)
+
+    async def _run_operation(
+        self, operation: Operation, request: Dict[str, Any]
+    ) -> None:
+        """
+        Handles a request in the background, recording its outcome in its operation
+        """
+        current_operation.set(operation)  # The task runs in a context of its own
+        try:
+            await _RequestHandler(
+                _OperationResponder(operation), self.connection
+            ).handle(request, [])
+        finally:
+            operation.end("EXCEPTION_OCCURED")  # Unless it ended already
+
+    async def _operation(self, operation_id: Optional[str] = None) -> None:
+        """
+        Sends the state of an operation, or of every operation if none is given
+        """
+        if operation_id is None:
+            await self.sock.ok(operations=self.manager.operations.snapshot())
+            return
+
+        operation = self.manager.operations.get(operation_id)
+        if operation is None:
+            await self.sock.raise_no_such_operation(operation_id)
+        else:
+            await self.sock.ok(operation=operation.snapshot())
+
+    async def _wait(self, operation_id: str, timeout: Optional[float] = None) -> None:
+        """
+        Waits for an operation to end, for at most timeout seconds, then sends its
+        state
+        """
+        operation = self.manager.operations.get(operation_id)
+        if operation is None:
+            await self.sock.raise_no_such_operation(operation_id)
+            return
+
+        with suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(operation.finished.wait(), timeout)
+        await self.sock.ok(operation=operation.snapshot())
+
+    async def _cancel(self, operation_id: str) -> None:
+        """
+        Asks an operation to stop, and sends its state. The operation stops at its
+        next progress report; a boot is cut short by killing the container.
+        """
+        operation = self.manager.operations.get(operation_id)
+        if operation is None:
+            await self.sock.raise_no_such_operation(operation_id)
+            return
+
+        if operation.state == "running":
+            self.manager.logger.debug("Cancelling %s", operation_id)
+            operation.cancel_requested = True
+            if operation.op == "START":
+                self.manager.spawn(self._kill_one(operation.container))
+        await self.sock.ok(operation=operation.snapshot())
+
+    async def _trace(self, trace_id: Optional[str] = None) -> None:
+        """
+        Sends the spans recorded by the server, as Chrome trace events
+
+        :param trace_id: Only send the spans of this trace, if given
+        """
+        await self.sock.ok(events=tracer.export(trace_id))
+
+    async def _profile(self, mode: str = "cpu", seconds: float = 10) -> None:
+        """
+        Profiles the server for some seconds, and sends the paths of the results,
+        which are written next to server.log. In "cpu" mode, the event loop thread
+        runs under cProfile while the stacks of all threads are sampled. In "memory"
+        mode, tracemalloc snapshots are taken at the start and at the end.
+        """
+        if mode not in ("cpu", "memory"):
+            await self.sock.raise_unknown_request(f"PROFILE {mode}")
+            return
+
+        directory = get_server_log_file().parent
+        async with self.manager.profile_lock:
+            self.manager.logger.debug("Profiling (%s) for %s seconds", mode, seconds)
+
+            if mode == "cpu":
+                profile = cProfile.Profile()
+                sampler = StackSampler()
+                sampler.start()
+                profile.enable()  # Only sees the thread calling it: the event loop
+                try:
+                    await asyncio.sleep(seconds)
+                finally:
+                    profile.disable()
+                    samples = sampler.stop()
+                files = await self.manager.offload(
+                    write_cpu_profile, directory, profile, samples
+                )
+            else:
+                started = not tracemalloc.is_tracing()
+                if started:
+                    tracemalloc.start()
+                try:
+                    baseline = tracemalloc.take_snapshot()
+                    await asyncio.sleep(seconds)
+                    snapshot = tracemalloc.take_snapshot()
+                    files = await self.manager.offload(
+                        write_memory_report, directory, snapshot, baseline
+                    )
+                finally:
+                    if started:
+                        tracemalloc.stop()
+
+        self.manager.logger.debug("Profile written to %s", [str(f) for f in files])
+        await self.sock.ok(files=[str(f) for f in files])
+
+    async def _ping(self) -> None:
         """
         Pong!
         """
         self.manager.logger.debug("Responding to ping.")
-        self.sock.ok()
+        await self.sock.ok()
 
-    def _started(self) -> None:
-        self.sock.cont()
-        container_name = self.sock.recv().decode("utf-8")
+    async def _started(self, container_name: str) -> None:
         self.manager.logger.debug("Checking if container %s is started", container_name)
+        await self.sock.ok(started=self.manager.running(container_name) is not None)
 
-        if container_name in self.manager.containers:
-            self.sock.yes()
-        else:
-            self.sock.no()
-
-    def _address(self) -> None:
+    async def _address(self, container_name: str) -> None:
         """
         Sends the information necessary to SSH into the container's shell
-        in the form of "HOSTNAME:PORT:USERNAME"
         """
-        self.sock.cont()
-        container_name = self.sock.recv().decode("utf-8")
-
-        if container_name not in self.manager.containers:
+        container = self.manager.running(container_name)
+        if container is None:
             self.manager.logger.debug(
                 "Attempt to get SSH info for container %s, but it was not started",
                 container_name,
             )
-            self.sock.raise_container_not_started(container_name)
+            await self.sock.raise_container_not_started(container_name)
         else:
             host = "127.0.0.1"
-            pswd = self.manager.containers[container_name].password
-            port = self.manager.containers[container_name].ex_port
-            user = self.manager.containers[container_name].username
+            pswd = container.password
+            port = container.ex_port
+            user = container.username
+            # The password is sent to the client, but never written to the log
             self.manager.logger.debug(
-                f"Container {container_name} SSH info: ({user}:{pswd}@{host}:{port})"
+                "Container %s SSH info: (%s@%s:%s)", container_name, user, host, port
             )
-            self.sock.send(f"{user}:{pswd}:{host}:{port}".encode("utf-8"))
+            await self.sock.ok(user=user, password=pswd, host=host, port=str(port))
+
+    async def _open_session(self, container_name: str) -> None:
+        """
+        Gets a container ready for a session in a single round trip: boots it if
+        needed, generates its id_rsa if missing, and sends everything needed to
+        connect to it. An event is sent first if the container has to boot.
+        """
+        if not get_container_dir(container_name).is_dir():
+            await self.sock.raise_no_such_container(container_name)
+            return
+
+        booted = self.manager.running(container_name) is None
+        if booted:
+            await self.sock.event(state=ContainerState.BOOTING.value)
+            try:
+                await self.manager.lifecycle(container_name).start()
+            except BootFailure:
+                await self.sock.raise_boot_error()
+                return
+            except ImageInUseError as ex:
+                await self.sock.raise_image_in_use(ex.container_name, ex.users)
+                return
+
+        container = self.manager.running(container_name)
+        if container is None:  # Stopped by someone else in the meantime
+            await self.sock.raise_container_not_started(container_name)
+            return
+        if not get_container_id_rsa(container_name).is_file():
+            self.manager.logger.debug("Generating missing id_rsa of %s", container_name)
+            await self.manager.offload(container.sshi.update_hostkey)
+
+        await self.sock.ok(
+            state=ContainerState.RUNNING.value,
+            booted=booted,
+            user=container.username,
+            password=container.password,
+            host="127.0.0.1",
+            port=str(container.ex_port),
+            key_path=str(get_container_id_rsa(container_name)),
+            forwarded_ports=container.portfwd,
+        )
+
+    async def _subscribe(
+        self, containers: Optional[List[str]] = None, events: Optional[List[str]] = None
+    ) -> None:
+        """
+        Streams events to the client as they happen, as EVENT frames, until the
+        client hangs up. Takes over the connection, like RUN-COMMAND.
 
-    def _update_hostkey(self) -> None:
+        :param containers: Glob patterns of the containers whose events are wanted.
+                           Events about no container in particular are only sent
+                           if no patterns are given.
+        :param events: The kinds of events wanted, all of them if not given
+        """
+        subscription = self.manager.events.subscribe(containers, events)
+        # Nothing else is sent on the connection, so it only reads as the client
+        # hanging up
+        hangup = self.manager.spawn(self.connection.sock.recv())
+        try:
+            await self.sock.event(event="subscribed")
+            while True:
+                get = self.manager.spawn(subscription.queue.get())
+                await asyncio.wait((get, hangup), return_when=asyncio.FIRST_COMPLETED)
+                if not get.done():
+                    get.cancel()
+                    return
+                await self.sock.event(**get.result())
+        finally:
+            hangup.cancel()
+            self.manager.events.unsubscribe(subscription)
+
+    async def _update_hostkey(self, container_name: str) -> None:
         """
         Generates a new id_rsa and updates the container
         """
-        self.sock.cont()
-        container_name = self.sock.recv()
         self.manager.logger.debug("Updating hostkey of container %s", container_name)
 
-        if container_name not in self.manager.containers:
-            self.sock.raise_container_not_started(container_name)
+        container = self.manager.running(container_name)
+        if container is None:
+            await self.sock.raise_container_not_started(container_name)
         else:
-            self.manager.containers[container_name].sshi.update_hostkey()
-            self.sock.ok()
+            await self.manager.offload(container.sshi.update_hostkey)
+            await self.sock.ok()
 
-    def _run_command(self) -> None:
+    async def _run_command(
+        self,
+        container_name: str,
+        cli: List[str],
+        fds: Optional[List[int]] = None,
+        capture: bool = False,
+    ) -> None:
         """
-        Runs a command in a contianer
+        Runs a command in a contianer. If the client passed its (stdin, stdout,
+        stderr) file descriptors, the command's I/O goes through them directly.
+
+        A captured command gets no input, and its exit status is sent once it
+        exited. The client passes only (stdout, stderr) then, if anything.
         """
-        self.sock.cont()
-        container_name = self.sock.recv().decode("utf-8")
-        self.sock.cont()
-        cli_len = int(self.sock.recv())
+        container = self.manager.running(container_name)
+        if container is None:
+            await self.sock.raise_container_not_started(container_name)
+            return
 
-        cli = []
-        for _ in range(cli_len):
-            self.sock.cont()
-            cli.append(self.sock.recv().decode("utf-8"))
+        self.manager.logger.debug(
+            "On container %s, running %s", container_name, " ".join(cli)
+        )
 
-        if container_name not in self.manager.containers:
-            self.sock.raise_container_not_started(container_name)
+        await self.sock.begin()
+
+        if self.manager.workers is not None:
+            await self._run_command_on_worker(container, cli, fds, capture)
             return
 
+        stdin, stdout, stderr, pid = await self.manager.offload(container.run, cli)
+        self.manager.events.publish(
+            "session_opened", container_name, pid=pid, command=cli
+        )
+        try:
+            await _RunCommandHandler(
+                client_sock=self.connection.sock,
+                client_addr=self.connection.client_addr,
+                manager=self.manager,
+                stdin=stdin,
+                stdout=stdout,
+                stderr=stderr,
+                pid=pid,
+                container=container,
+                fds=fds,
+                capture=capture,
+            ).send_and_recv()
+        finally:
+            channel = stdout.channel
+            self.manager.events.publish(
+                "session_closed",
+                container_name,
+                pid=pid,
+                exit_status=(
+                    channel.exit_status if channel.exit_status_ready() else None
+                ),
+            )
+
+    async def _run_command_on_worker(
+        self,
+        container: Container,
+        cli: List[str],
+        fds: Optional[List[int]],
+        capture: bool,
+    ) -> None:
+        """
+        Runs a command on a session worker, handing the connection over to it. The
+        connection is closed here once handed over.
+        """
+        client_sock, buffered = self.connection.sock.detach()
+        exit_status = None
+
+        def on_start(pid: int) -> None:
+            self.manager.events.publish(
+                "session_opened", container.name, pid=pid, command=cli
+            )
+
+        self.manager.metrics.add_sessions(1)
+        try:
+            result = await self.manager.workers.run_command(
+                container, cli, client_sock, buffered, fds, capture, on_start
+            )
+            exit_status = result["exit_status"]
+            for direction, size in result["bytes"].items():
+                self.manager.metrics.add_bytes(direction, size)
+        finally:
+            client_sock.close()
+            self.manager.metrics.add_sessions(-1)
+            self.manager.events.publish(
+                "session_closed", container.name, exit_status=exit_status
+            )
         self.manager.logger.debug(
-            "On container %s, running %s", container_name, " ".join(cli)
+            "Command on %s exited with status %s", container.name, exit_status
         )
 
-        self.sock.send(b"BEGIN")
+    async def _start(self, container_name: str) -> None:
+        """
+        Starts a container
+        """
+        try:
+            result = await self._start_one(container_name)
+        except ImageInUseError as ex:
+            await self.sock.raise_image_in_use(ex.container_name, ex.users)
+            return
+        if result == "no such container":
+            await self.sock.raise_no_such_container(container_name)
+        elif result == "boot failure":
+            await self.sock.raise_boot_error()
+        else:
+            await self.sock.ok()
+
+    async def _stop(self, container_name: str) -> None:
+        """
+        Stops a container
+        """
+        if await self._stop_one(container_name) == "not started":
+            await self.sock.raise_container_not_started(container_name)
+        else:
+            await self.sock.ok()
+
+    async def _kill(self, container_name: str) -> None:
+        """
+        Kills the QEMU process of the container.
+        This is like yanking the power cord. Only use when you have no other choice.
+        """
+        if await self._kill_one(container_name) == "not started":
+            await self.sock.raise_container_not_started(container_name)
+        else:
+            await self.sock.ok()
+
+    async def _batch(
+        self,
+        action: str,
+        containers: List[str],
+        parallel: int = BATCH_PARALLELISM,
+    ) -> None:
+        """
+        Starts, stops, kills or checks many containers at once. Each container's
+        result is sent as an event as soon as it is known, and all of them are sent
+        again with the final OK.
+
+        :param action: "START", "STOP", "KILL" or "STARTED"
+        :param containers: Names of containers, or glob patterns matching them
+        :param parallel: Number of containers worked on at once
+        """
+        actions = {
+            "START": self._start_one,
+            "STOP": self._stop_one,
+            "KILL": self._kill_one,
+            "STARTED": self._state_one,
+        }
+        if action not in actions:
+            await self.sock.raise_unknown_request(f"BATCH {action}")
+            return
 
-        stdin, stdout, stderr, pid = self.manager.containers[container_name].run(cli)
-        _RunCommandHandler(
-            client_sock=self.sock,
-            client_addr=self.client_addr,
-            manager=self.manager,
-            stdin=stdin,
-            stdout=stdout,
-            stderr=stderr,
-            pid=pid,
-            container=self.manager.containers[container_name],
-        ).send_and_recv()
+        names = self.manager.match_containers(containers)
+        self.manager.logger.debug("BATCH %s on %s", action, ", ".join(names))
 
-    def _start(self) -> None:
+        limit = asyncio.Semaphore(max(parallel, 1))
+        results: Dict[str, str] = {}
+
+        async def run(name: str) -> None:
+            async with limit:
+                try:
+                    results[name] = await actions[action](name)
+                except ImageInUseError:
+                    results[name] = "image in use"
+                except Exception as ex:  # pylint: disable=broad-except
+                    self.manager.logger.exception(ex)
+                    results[name] = "error"
+            await self.sock.event(container=name, result=results[name])
+
+        await asyncio.gather(*(run(name) for name in names))
+        await self.sock.ok(results=results)
+
+    async def _start_one(self, container_name: str) -> str:
         """
         Starts a container
+
+        Raises ImageInUseError if other containers run on its disk
+
+        :return: "started", "no such container" or "boot failure"
         """
-        self.sock.cont()
-        container_name = self.sock.recv().decode("utf-8")
         self.manager.logger.debug("Attempting to start container %s", container_name)
 
         if not get_container_dir(container_name).is_dir():
             self.manager.logger.debug("Container %s does not exist", container_name)
-            self.sock.raise_no_such_container(container_name)
+            return "no such container"
 
-        self.manager.startup_mutex.acquire()
         try:
-            if container_name not in self.manager.containers:
-                try:
-                    self.manager.logger.debug("Starting container '%s'", container_name)
-                    self.manager.containers[container_name] = Container(
-                        container_name, logger=self.manager.logger
-                    )
-                    self.manager.containers[container_name].start()
-                    self.manager.logger.debug(
-                        "Container %s has been started", container_name
-                    )
-                except BootFailure as exc:
-                    self.manager.logger.debug(
-                        "Container %s failed to boot: %s", container_name, repr(exc)
-                    )
-                    self.manager.containers[container_name].kill()
-                    del self.manager.containers[container_name]
-                    self.sock.raise_boot_error()
-                else:
-                    self.sock.ok()
-            else:
-                self.sock.ok()
-        except Exception as exc:  # pylint: disable=broad-except
-            self.manager.startup_mutex.release()
-            raise exc
-        self.manager.startup_mutex.release()
+            await self.manager.lifecycle(container_name).start()
+        except BootFailure:
+            return "boot failure"
+        return "started"
 
-    def _stop(self) -> None:
+    async def _stop_one(self, container_name: str) -> str:
         """
         Stops a container
-        """
-        self.sock.cont()
-        container_name = self.sock.recv().decode("utf-8")
 
-        if container_name not in self.manager.containers:
+        :return: "stopped" or "not started"
+        """
+        if not await self.manager.lifecycle(container_name).stop():
             self.manager.logger.debug(
                 "Attempt to stop nonexistent container %s", container_name
             )
-            self.sock.raise_container_not_started(container_name)
-            return
+            return "not started"
 
-        self.manager.logger.debug("Stopping container '%s'", container_name)
-        self.manager.containers[container_name].stop()
-        del self.manager.containers[container_name]
-        self.sock.ok()
         self.manager.logger.debug("Container %s successfully stopped", container_name)
+        return "stopped"
 
-    def _kill(self) -> None:
-        """
-        Kills the QEMU process of the container.
-        This is like yanking the power cord. Only use when you have no other choice.
+    async def _kill_one(self, container_name: str) -> str:
         """
-        self.sock.cont()
-        container_name = self.sock.recv().decode("utf-8")
-
-        if container_name not in self.manager.containers:
-            self.manager.logger.debug(
-                "Attempt to kill nonexistent container %s", container_name
-            )
-            self.sock.raise_container_not_started(container_name)
-            return
-
-        self.manager.logger.debug("Killing container '%s'", container_name)
+        Kills the QEMU process of the container
 
+        :return: "killed" or "not started"
+        """
         try:
-            self.manager.containers[container_name].kill()
+            killed = await self.manager.lifecycle(container_name).kill()
         except OSError:
             self.manager.logger.debug(
-                "Attempted to kill %s (PID=%d), but the process is no longer "
-                "accessible.",
+                "Attempted to kill %s, but the process is no longer accessible.",
                 container_name,
-                self.manager.containers[container_name].booter.pid,
             )
-        else:
+            return "killed"
+
+        if not killed:
             self.manager.logger.debug(
-                "Container %s successfully killed", container_name
+                "Attempt to kill nonexistent container %s", container_name
             )
-        finally:
-            del self.manager.containers[container_name]
-            self.sock.ok()
+            return "not started"
+        self.manager.logger.debug("Container %s successfully killed", container_name)
+        return "killed"
+
+    async def _state_one(self, container_name: str) -> str:
+        """
+        Checks on a container
+
+        :return: The state of the container, see ContainerState
+        """
+        if container_name not in self.manager.containers:
+            return ContainerState.STOPPED.value
+        return self.manager.containers[container_name].state.value
 
-    def _get(self) -> None:
+    def _transfer_callback(
+        self, direction: str, container_name: str, path: str
+    ) -> Callable[[int, int], None]:
         """
-        Gets a file from a container
+        Makes a progress callback for an SFTP transfer, which records it in the
+        metrics, publishes its progress, and reports it to the operation running
+        the transfer, if any
+
+        :param direction: "get" or "put"
+        :param container_name: The container files are transferred to or from
+        :param path: The path of the file in the container
+        :return: The callback, taking the bytes transferred so far and the total
         """
-        self.sock.cont()
-        container_name = self.sock.recv().decode("utf-8")
-        self.sock.cont()
-        remote_file = self.sock.recv().decode("utf-8")
-        self.sock.cont()
-        local_file = self.sock.recv().decode("utf-8")
+        record = self.manager.metrics.transfer_callback(direction)
+        publish = self.manager.events.transfer_callback(direction, container_name, path)
+        operation = current_operation.get()
 
+        def callback(done: int, total: int) -> None:
+            record(done, total)
+            publish(done, total)
+            if operation is not None:
+                operation.progress(done, total)  # Raises once cancelled
+
+        return callback
+
+    async def _get(
+        self,
+        container_name: str,
+        remote_file: str,
+        local_file: str,
+        fds: Optional[List[int]] = None,
+    ) -> None:
+        """
+        Gets a file from a container. If the client passed an open destination file
+        descriptor, the file is written to it instead of to local_file.
+        """
         self.manager.logger.debug(
             "Getting file '%s' to '%s' in '%s'", remote_file, local_file, container_name
         )
 
-        if container_name not in self.manager.containers:
+        container = self.manager.running(container_name)
+        if container is None:
             self.manager.logger.debug(
                 "Attempt to get file from nonexistent container %s", container_name
             )
-            self.sock.raise_container_not_started(container_name)
+            await self.sock.raise_container_not_started(container_name)
             return
 
-        p = Path(local_file)
-        if not p.parent.exists():
-            os.makedirs(p.parent)
+        if not fds and not Path(local_file).parent.exists():
+            os.makedirs(Path(local_file).parent)
 
+        callback = self._transfer_callback("get", container_name, remote_file)
         try:
-            self.manager.containers[container_name].get(remote_file, local_file)
+            if self.manager.workers is not None:
+                await self.manager.workers.transfer(
+                    "get",
+                    container,
+                    remote_file,
+                    local_file,
+                    fds[0] if fds else None,
+                    callback,
+                )
+            elif fds:
+                with os.fdopen(fds[0], "wb", closefd=False) as fileobj:
+                    await self.manager.offload(
+                        container.getfo,
+                        remote_file,
+                        fileobj,
+                        callback,
+                    )
+            else:
+                await self.manager.offload(
+                    container.get,
+                    remote_file,
+                    local_file,
+                    callback,
+                )
         except FileNotFoundError as ex:
-            self.sock.raise_invalid_path(ex.filename)
+            await self.sock.raise_invalid_path(ex.filename)
         except IsADirectoryError as ex:
-            self.sock.raise_is_a_directory(ex.filename)
+            await self.sock.raise_is_a_directory(ex.filename)
+        except OperationCancelled:
+            if not fds:
+                with suppress(OSError):
+                    os.remove(local_file)  # Partially written
+            raise
         else:
-            self.sock.ok()
+            await self.sock.ok()
 
-    def _put(self) -> None:
+    async def _put(
+        self,
+        container_name: str,
+        local_file: str,
+        remote_file: str,
+        fds: Optional[List[int]] = None,
+    ) -> None:
         """
-        Puts a file into a container
+        Puts a file into a container. If the client passed an open source file
+        descriptor, the file is read from it instead of from local_file.
         """
-        self.sock.cont()
-        container_name = self.sock.recv().decode("utf-8")
-        self.sock.cont()
-        local_file = self.sock.recv().decode("utf-8")
-        self.sock.cont()
-        remote_file = self.sock.recv().decode("utf-8")
-
         self.manager.logger.debug(
             "Putting file '%s' to '%s' in '%s'", local_file, remote_file, container_name
         )
 
-        if container_name not in self.manager.containers:
+        container = self.manager.running(container_name)
+        if container is None:
             self.manager.logger.debug(
                 "Attempt to put file into nonexistent container %s", container_name
             )
-            self.sock.raise_container_not_started(container_name)
+            await self.sock.raise_container_not_started(container_name)
             return
+        callback = self._transfer_callback("put", container_name, remote_file)
         try:
-            self.manager.containers[container_name].put(local_file, remote_file)
+            if self.manager.workers is not None:
+                await self.manager.workers.transfer(
+                    "put",
+                    container,
+                    remote_file,
+                    local_file,
+                    fds[0] if fds else None,
+                    callback,
+                )
+            elif fds:
+                with os.fdopen(fds[0], "rb", closefd=False) as fileobj:
+                    await self.manager.offload(
+                        container.putfo,
+                        fileobj,
+                        local_file,
+                        remote_file,
+                        callback,
+                    )
+            else:
+                await self.manager.offload(
+                    container.put,
+                    local_file,
+                    remote_file,
+                    callback,
+                )
         except FileNotFoundError as ex:
-            self.sock.raise_invalid_path(ex.filename)
+            await self.sock.raise_invalid_path(ex.filename)
         except IsADirectoryError as ex:
-            self.sock.raise_is_a_directory(ex.filename)
+            await self.sock.raise_is_a_directory(ex.filename)
         else:
-            self.sock.ok()
+            await self.sock.ok()
 
-    def _install(self) -> None:
+    async def _install(self, container_name: str, archive_path: str) -> None:
         """
         Installs a container on the system
         """
-        self.sock.cont()
-        archive_path_str = self.sock.recv().decode("utf-8")
-        self.sock.cont()
-        container_name = self.sock.recv().decode("utf-8")
-
         self.manager.logger.debug(
-            "Installing container '%s' from '%s'", archive_path_str, container_name
+            "Installing container '%s' from '%s'", container_name, archive_path
         )
 
-        archive_path = Path(archive_path_str)
-        if not archive_path.is_file():
+        if not Path(archive_path).is_file():
             self.manager.logger.debug("Attempt to install container from invalid path")
-            self.sock.raise_invalid_path(archive_path_str)
+            await self.sock.raise_invalid_path(archive_path)
             return
-        install_container(archive_path, container_name)
 
-        self.sock.ok()
+        async with self.manager.modifying(container_name) as stopped:
+            if not stopped:
+                self.manager.logger.debug("Attempt to install over started container")
+                await self.sock.raise_container_started_cannot_modify(container_name)
+                return
+            users = await self.manager.image_users(container_name)
+            if users:
+                self.manager.logger.debug("Attempt to install over the image of clones")
+                await self.sock.raise_image_in_use(container_name, users)
+                return
+            await self.manager.offload(
+                install_container, Path(archive_path), container_name, report_progress
+            )
+
+        await self.sock.ok()
         self.manager.logger.debug("Successfully installed container %s", container_name)
 
-    def _archive(self) -> None:
+    async def _archive(self, container_name: str, path_to_destination: str) -> None:
         """
         Archives a container onto the disk
         """
-        self.sock.cont()
-        container_name = self.sock.recv().decode("utf-8")
-        self.sock.cont()
-        path_to_destination: str = self.sock.recv().decode("utf-8")
-
         if not get_container_dir(container_name).is_dir():
             self.manager.logger.debug("Container %s does not exist", container_name)
-            self.sock.raise_no_such_container(container_name)
-            return
-        if container_name in self.manager.containers:
-            self.manager.logger.debug("Attempt to archive started container")
-            self.sock.raise_container_started_cannot_modify(container_name)
+            await self.sock.raise_no_such_container(container_name)
             return
 
-        try:
-            archive_container(container_name, path_to_destination)
-        except FileExistsError:
-            self.sock.raise_invalid_path(str(path_to_destination))
-        else:
-            self.sock.ok()
+        async with self.manager.modifying(container_name) as stopped:
+            if not stopped:
+                self.manager.logger.debug("Attempt to archive started container")
+                await self.sock.raise_container_started_cannot_modify(container_name)
+                return
+            # Its disk only holds what changed since the image, which it points to
+            image = await self.manager.offload(get_image, container_name)
+            if image is not None:
+                self.manager.logger.debug("Attempt to archive a clone")
+                await self.sock.raise_clone_cannot_be_archived(container_name, image)
+                return
 
-    def _delete(self) -> None:
+            try:
+                await self.manager.offload(
+                    archive_container,
+                    container_name,
+                    path_to_destination,
+                    report_progress,
+                )
+            except FileExistsError:
+                await self.sock.raise_invalid_path(str(path_to_destination))
+                return
+
+        await self.sock.ok()
+
+    async def _delete(self, container_name: str) -> None:
         """
         Deletes a container from the file system
         """
-        self.sock.cont()
-        container_name: str = self.sock.recv().decode("utf-8")
-
         self.manager.logger.debug("Deleting container %s", container_name)
 
         if not get_container_dir(container_name).is_dir():
             self.manager.logger.debug("Attempt to delete container that does not exist")
-            self.sock.raise_no_such_container(container_name)
-            return
-        if container_name in self.manager.containers:
-            self.manager.logger.debug("Attempt to delete started container")
-            self.sock.raise_container_started_cannot_modify(container_name)
+            await self.sock.raise_no_such_container(container_name)
             return
 
-        shutil.rmtree(get_container_dir(container_name))
+        async with self.manager.modifying(container_name) as stopped:
+            if not stopped:
+                self.manager.logger.debug("Attempt to delete started container")
+                await self.sock.raise_container_started_cannot_modify(container_name)
+                return
+            users = await self.manager.image_users(container_name)
+            if users:
+                self.manager.logger.debug("Attempt to delete the image of clones")
+                await self.sock.raise_image_in_use(container_name, users)
+                return
+            await self.manager.offload(shutil.rmtree, get_container_dir(container_name))
 
-        self.sock.ok()
+        await self.sock.ok()
         self.manager.logger.debug("Successfully deleted container %s", container_name)
 
-    def _rename(self) -> None:
+    async def _rename(self, container_name: str, new_name: str) -> None:
         """
         Renames a container on the file system
         """
-        self.sock.cont()
-        old_name: str = self.sock.recv().decode("utf-8")
-        self.sock.cont()
-        new_name: str = self.sock.recv().decode("utf-8")
-
+        old_name = container_name
         self.manager.logger.debug("Renaming container '%s' to '%s'", old_name, new_name)
 
         if not get_container_dir(old_name).is_dir():
             self.manager.logger.debug("Attempt to rename container that does not exist")
-            self.sock.raise_no_such_container(old_name)
-            return
-        if old_name in self.manager.containers:
-            self.manager.logger.debug("Attempt to rename started container")
-            self.sock.raise_container_started_cannot_modify(old_name)
+            await self.sock.raise_no_such_container(old_name)
             return
 
-        os.rename(str(get_container_dir(old_name)), str(get_container_dir(new_name)))
+        async with self.manager.modifying(old_name, new_name) as stopped:
+            if not stopped:
+                self.manager.logger.debug("Attempt to rename started container")
+                await self.sock.raise_container_started_cannot_modify(old_name)
+                return
+            users = await self.manager.image_users(old_name)
+            if users:
+                self.manager.logger.debug("Attempt to rename the image of clones")
+                await self.sock.raise_image_in_use(old_name, users)
+                return
+            os.rename(
+                str(get_container_dir(old_name)), str(get_container_dir(new_name))
+            )
 
-        self.sock.ok()
+        await self.sock.ok()
         self.manager.logger.debug("Successfully renamed container")
 
+    async def _clone(self, container_name: str, new_name: str) -> None:
+        """
+        Creates a container sharing the disk of another, see clone_container
+        """
+        self.manager.logger.debug("Cloning '%s' as '%s'", container_name, new_name)
+
+        if not get_container_dir(container_name).is_dir():
+            self.manager.logger.debug("Attempt to clone container that does not exist")
+            await self.sock.raise_no_such_container(container_name)
+            return
+
+        # The image is locked too, so that it does not boot meanwhile
+        async with self.manager.modifying(container_name, new_name) as stopped:
+            if not stopped:
+                self.manager.logger.debug("Attempt to clone started container")
+                await self.sock.raise_container_started_cannot_modify(container_name)
+                return
+            try:
+                await self.manager.offload(clone_container, container_name, new_name)
+            except FileExistsError:
+                await self.sock.raise_invalid_path(str(get_container_dir(new_name)))
+                return
+
+        await self.sock.ok()
+        self.manager.logger.debug("Successfully cloned container")
+
+    async def _pool(self, sizes: Optional[Dict[str, int]] = None) -> None:
+        """
+        Sends the state of the warm pool, once resized if sizes are given
+
+        :param sizes: The number of containers to keep ready for some images, saved
+                      to pool.json. 0 empties the pool of an image.
+        """
+        if sizes is not None:
+            self.manager.pool.resize(sizes)
+            await self.manager.offload(save_pool_sizes, self.manager.pool.sizes)
+        await self.sock.ok(pool=self.manager.pool.snapshot())
+
 
 class _RunCommandHandler:
     """
-    Internal class used only for run_command.
+    Internal class used only for run_command. Also used by session workers, see
+    src.containers.session_workers.
 
-    :param manager: The parent ContainerManagerServer class
+    :param manager: The parent ContainerManagerServer class, or whatever offers the
+                    same spawn, offload, metrics and logger
     :param client_sock: Client socket object
-    :param client_addr: Client (IP, PORT)
+    :param client_addr: Client (IP, PORT), if known
     :param stdin: Container's stdin
     :param stdout: Container's stdout
     :param stderr: Container's stderr
+    :param fds: The client's (stdin, stdout, stderr) file descriptors, if it passed
+                them, or its (stdout, stderr) for a captured command. The command's
+                I/O then bypasses the client socket.
+    :param capture: Whether the command is captured: it gets no input, there are
+                    no keepalives, and its exit status is sent at the end
+    :param output: Chunks of output waiting for the session's writer, as
+                   (stream, data) pairs. Bounded, so a slow client holds back
+                   reading from the channel instead of buffering without limit.
+    :param last_send: Event loop time at which output was last sent to the client
     """
 
     manager: ContainerManagerServer
-    client_sock: socket.socket
-    client_addr: Tuple[str, int]
+    client_sock: AsyncClientServerSocket
+    client_addr: Optional[Tuple[str, int]]
 
     container: Container
     pid: int
     stdin: ChannelStdinFile
     stdout: ChannelFile
     stderr: ChannelStderrFile
-    mutex: threading.Lock = threading.Lock()
+    fds: Optional[List[int]]
+    capture: bool
+    output: "asyncio.Queue[Tuple[int, bytes]]"
+    last_send: float
 
     def __init__(
         self,
-        client_sock: socket.socket,
-        client_addr: Tuple[str, int],
+        client_sock: AsyncClientServerSocket,
+        client_addr: Optional[Tuple[str, int]],
         manager: ContainerManagerServer,
         stdin: ChannelStdinFile,
         stdout: ChannelFile,
         stderr: ChannelStderrFile,
         pid: int,
         container: Container,
+        fds: Optional[List[int]] = None,
+        capture: bool = False,
     ):
         self.client_sock = client_sock
         self.client_addr = client_addr
@@ -605,66 +1649,224 @@ class _RunCommandHandler:
         self.stderr = stderr
         self.pid = pid
         self.container = container
+        self.fds = fds
+        self.capture = capture
+        self.output = asyncio.Queue(maxsize=OUTPUT_QUEUE_SIZE)
+        self.last_send = asyncio.get_running_loop().time()
 
-    def send_and_recv(self):
+    async def send_and_recv(self) -> None:
         """
-        Sends output, receives input. Blocking function.
+        Sends output, receives input. Returns as soon as the command's output
+        ended or the client went away. The command is killed if it has not exited.
         """
-        t_send_stdout = threading.Thread(target=self._send_stdout, daemon=True)
-        t_send_stderr = threading.Thread(target=self._send_stderr, daemon=True)
-        t_send_null = threading.Thread(target=self._send_null, daemon=True)
-        t_recv = threading.Thread(target=self._recv, daemon=True)
-        t_send_stdout.start()
-        t_send_stderr.start()
-        t_recv.start()
-        t_send_null.start()
+        if self.capture:
+            await self.manager.offload(self.stdin.channel.shutdown_write)
+            tasks = [
+                self.manager.spawn(self._read_output()),
+                self.manager.spawn(self._write_output()),
+                self.manager.spawn(self._watch_client()),
+            ]
+        elif self.fds:
+            tasks = [
+                self.manager.spawn(self._read_output()),
+                self.manager.spawn(self._write_output()),
+                self.manager.spawn(self._recv_fd()),
+                self.manager.spawn(self._watch_client()),
+            ]
+        else:
+            tasks = [
+                self.manager.spawn(self._read_output()),
+                self.manager.spawn(self._write_output()),
+                self.manager.spawn(self._send_null()),
+                self.manager.spawn(self._recv()),
+            ]
+
+        channel = self.stdout.channel
+        self.manager.metrics.add_sessions(1)
+        try:
+            # The writer returns once all output was delivered; any other task
+            # returns once the client went away
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            if tasks[1] in done and not channel.exit_status_ready():
+                await self.manager.offload(channel.status_event.wait, EXIT_STATUS_WAIT)
+            if tasks[1] in done and self.capture:
+                await self._send_exit_status()
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.client_sock.close()
+            self.manager.metrics.add_sessions(-1)
 
-        while True:
-            if not (t_recv.is_alive() and t_send_null.is_alive()):
-                break
-            if not (t_send_stdout.is_alive() or t_send_stderr.is_alive()):
-                break
-            time.sleep(1)
-        self.client_sock.close()
-        self.container.sshi.exec_ssh_command(["kill", "-9", str(self.pid)])
-
-    def _recv(self):
+        if channel.exit_status_ready():
+            self.manager.logger.debug(
+                "Command %d on %s exited with status %d",
+                self.pid,
+                self.container.name,
+                channel.exit_status,
+            )
+        else:
+            await self.manager.offload(
+                self.container.sshi.exec_ssh_command, ["kill", "-9", str(self.pid)]
+            )
+
+    async def _recv(self) -> None:
+        """
+        Forwards input frames from the client to the command, until the client
+        hangs up. A frame with "eof" set closes the command's stdin.
+        """
+        try:
+            while True:
+                header, body = await self.client_sock.recv_msg()
+                if body:
+                    await self._write_input(body)
+                if header.get("eof"):
+                    await self.manager.offload(self.stdin.channel.shutdown_write)
+        except (ConnectionError, OSError):
+            pass
+
+    async def _recv_fd(self) -> None:
+        """
+        Forwards the client's stdin file descriptor to the command, until EOF.
+        """
+        try:
+            while True:
+                try:
+                    await wait_readable(self.fds[0])
+                except PermissionError:
+                    pass  # Regular files cannot be polled, but never block
+                data = os.read(self.fds[0], INPUT_CHUNK_SIZE)
+                if not data:
+                    break
+                await self._write_input(data)
+            await self.manager.offload(self.stdin.channel.shutdown_write)
+        except (ConnectionError, OSError):
+            pass
+        await asyncio.Future()  # Input ended, but the session goes on
+
+    async def _write_input(self, data: bytes) -> None:
+        """
+        Writes input to the command. Blocks while the channel's window is full, so
+        no more input is read from the client until the command consumed some.
+
+        :param data: The input
+        """
+        await self.manager.offload(self.stdin.channel.sendall, data)
+        self.manager.metrics.add_bytes("run_stdin", len(data))
+
+    async def _watch_client(self) -> None:
+        """
+        Returns once the client hangs up.
+        """
         try:
-            while msg := self.client_sock.recv(1 << 16):
-                while msg:
-                    size = msg[0]
-                    self.stdin.write(msg[1 : size + 1])
-                    msg = msg[size + 1 :]
+            while await self.client_sock.recv(1 << 16):
+                pass
         except (ConnectionError, OSError):
             pass
 
-    def _send_stdout(self):
+    async def _read_output(self) -> None:
+        """
+        Reads the output of the command in large chunks as it becomes available,
+        and queues it for the writer. Queues (0, b"") once the output ended.
+        """
+        channel = self.stdout.channel
         try:
-            while my_byte := self.stdout.read(1):
-                self.mutex.acquire()  # pylint: disable=consider-using-with
-                self.client_sock.send(b"\x01" + my_byte)
-                self.mutex.release()
+            while True:
+                while channel.recv_ready():
+                    await self.output.put((1, channel.recv(OUTPUT_CHUNK_SIZE)))
+                while channel.recv_stderr_ready():
+                    await self.output.put((2, channel.recv_stderr(OUTPUT_CHUNK_SIZE)))
+                if channel.eof_received or channel.closed:
+                    if not (channel.recv_ready() or channel.recv_stderr_ready()):
+                        break
+                    continue
+                await wait_readable(channel.fileno())
         except (ConnectionError, OSError):
-            if self.mutex.locked():
-                self.mutex.release()
+            pass
+        await self.output.put((0, b""))
+        await asyncio.Future()  # The writer ends the session once it is done
 
-    def _send_stderr(self):
+    async def _write_output(self) -> None:
+        """
+        Writes queued output to the client. This is the only task writing output
+        for the session; consecutive chunks of the same stream are coalesced.
+        """
         try:
-            while my_byte := self.stderr.read(1):
-                self.mutex.acquire()  # pylint: disable=consider-using-with
-                self.client_sock.send(b"\x02" + my_byte)
-                self.mutex.release()
+            while True:
+                stream, data = await self.output.get()
+                if not stream:
+                    return
+
+                chunks = [data]
+                size = len(data)
+                while not self.output.empty() and size < OUTPUT_CHUNK_SIZE:
+                    next_stream, next_data = self.output.get_nowait()
+                    if next_stream != stream:
+                        await self._write(stream, b"".join(chunks))
+                        if not next_stream:
+                            return
+                        stream, chunks, size = next_stream, [], 0
+                    chunks.append(next_data)
+                    size += len(next_data)
+
+                await self._write(stream, b"".join(chunks))
         except (ConnectionError, OSError):
-            if self.mutex.locked():
-                self.mutex.release()
+            pass
+
+    async def _write(self, stream: int, data: bytes) -> None:
+        """
+        Sends output of the command to the client, as a frame tagged with the
+        stream, or straight into the client's file descriptor.
+
+        :param stream: 1 for stdout, 2 for stderr
+        :param data: The output
+        """
+        if self.fds:
+            # stdout and stderr come last, whether or not stdin was passed
+            await self.manager.offload(_write_all, self.fds[stream - 3], data)
+        else:
+            await self.client_sock.send_msg({"stream": stream}, data)
+        self.manager.metrics.add_bytes(
+            "run_stdout" if stream == 1 else "run_stderr", len(data)
+        )
+        self.last_send = asyncio.get_running_loop().time()
 
-    def _send_null(self):
+    async def _send_exit_status(self) -> None:
+        """
+        Sends the exit status of a captured command to the client, as the last
+        frame of the session. It is None if the command has not exited, or was
+        killed by a signal.
+        """
+        channel = self.stdout.channel
+        exit_status = channel.exit_status if channel.exit_status_ready() else None
+        if exit_status is not None and exit_status < 0:
+            exit_status = None  # paramiko's -1, when no status was sent
+        with suppress(ConnectionError, OSError):
+            await self.client_sock.send_msg({"stream": 0, "exit_status": exit_status})
+
+    async def _send_null(self) -> None:
+        """
+        Sends a keepalive whenever the session was idle for KEEPALIVE_INTERVAL.
+        """
+        loop = asyncio.get_running_loop()
         try:
             while True:
-                self.mutex.acquire()  # pylint: disable=consider-using-with
-                self.client_sock.send(b"\x00\x00")
-                self.mutex.release()
-                time.sleep(1)
+                idle = loop.time() - self.last_send
+                if idle >= KEEPALIVE_INTERVAL:
+                    await self.client_sock.send_msg({"stream": 0})
+                    self.last_send = loop.time()
+                    idle = 0
+                await asyncio.sleep(KEEPALIVE_INTERVAL - idle)
         except (ConnectionError, OSError):
-            if self.mutex.locked():
-                self.mutex.release()
+            pass
+
+
+def _write_all(fd: int, data: bytes) -> None:
+    """
+    Writes all of data to a file descriptor. Blocking function.
+
+    :param fd: The file descriptor
+    :param data: The data to write
+    """
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view) :]
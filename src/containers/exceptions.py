@@ -4,15 +4,15 @@ Manages the exceptions related to the containers
 
 import re
 from pathlib import Path
+from typing import Dict, List, Optional
 
 from pexpect import EOF as PexpectEOFException
 from pexpect import TIMEOUT as PexpectTimeoutException
 from pexpect import ExceptionPexpect
 
-from src.system.my_socket import ClientServerSocket
 from src.system.syspath import get_server_log_file
 
-PORT_FAILURE_RE = r"""Could not set up host forwarding rule"""
+PORT_FAILURE_RE = r"""Could not set up host forwarding rule|Failed to bind socket"""
 LOGIN_FAILURE_RE = r"""Login incorrect"""
 
 
@@ -111,15 +111,15 @@ class ServerError(RuntimeError):
     """
     Occurs when an issue happens on the server
 
-    :param sock: The socket connection being used
+    :param details: The details of the error sent in the response frame
     """
 
-    def __init__(self, sock: ClientServerSocket):
-        self.sock = sock
-        self._recv()
-        self.sock.close()
+    def __init__(self, details: Optional[Dict[str, str]] = None):
+        super().__init__()
+        self.details = details or {}
+        self._parse()
 
-    def _recv(self):
+    def _parse(self):
         pass
 
     def __str__(self):
@@ -136,9 +136,8 @@ class UnknownRequestError(ServerError):
     :param request: The request sent by the client
     """
 
-    def _recv(self):
-        self.sock.cont()
-        self.request: str = self.sock.recv().decode("utf-8")
+    def _parse(self):
+        self.request: str = self.details.get("request", "")
 
     def __str__(self):
         return f"Server recieved an unknown request: {self.request}"
@@ -151,9 +150,8 @@ class ContainerNotStartedError(ServerError):
     :param container_name: The name of the container that wasn't started
     """
 
-    def _recv(self):
-        self.sock.cont()
-        self.container_name: str = self.sock.recv().decode("utf-8")
+    def _parse(self):
+        self.container_name: str = self.details.get("container_name", "")
 
     def __str__(self):
         return f"Container {self.container_name} is not running"
@@ -166,9 +164,8 @@ class ContainerStartedCannotModify(ServerError):
     :param container_name: The name of the container
     """
 
-    def _recv(self):
-        self.sock.cont()
-        self.container_name: str = self.sock.recv().decode("utf-8")
+    def _parse(self):
+        self.container_name: str = self.details.get("container_name", "")
 
     def __str__(self):
         return (
@@ -177,6 +174,47 @@ class ContainerStartedCannotModify(ServerError):
         )
 
 
+class ImageInUseError(ServerError):
+    """
+    Raised when there is an attempt to start or modify a container that other
+    containers run on, see clone_container
+
+    :param container_name: The name of the container
+    :param users: The clones of the container, and its warm pool
+    """
+
+    def _parse(self):
+        self.container_name: str = self.details.get("container_name", "")
+        self.users: List[str] = self.details.get("users", [])
+
+    def __str__(self):
+        return (
+            f"{self.container_name} is the image of {', '.join(self.users)}. Delete "
+            f"its clones and empty its warm pool (pool {self.container_name}=0) "
+            "before attempting this action again."
+        )
+
+
+class CloneCannotBeArchivedError(ServerError):
+    """
+    Raised when there is an attempt to archive a clone, whose disk only holds
+    what changed since its image
+
+    :param container_name: The name of the clone
+    :param image: The name of its image
+    """
+
+    def _parse(self):
+        self.container_name: str = self.details.get("container_name", "")
+        self.image: str = self.details.get("image", "")
+
+    def __str__(self):
+        return (
+            f"{self.container_name} is a clone of {self.image}, and cannot be "
+            "archived on its own."
+        )
+
+
 class UnknownContainerError(ServerError):
     """
     Raised when container is not installed
@@ -184,9 +222,8 @@ class UnknownContainerError(ServerError):
     :param container_name: The name of the unknown container
     """
 
-    def _recv(self):
-        self.sock.cont()
-        self.container_name: str = self.sock.recv().decode("utf-8")
+    def _parse(self):
+        self.container_name: str = self.details.get("container_name", "")
 
     def __str__(self):
         return f"Container {self.container_name} is not installed"
@@ -211,9 +248,8 @@ class InvalidPathError(ServerError):
     :param path: The invalid path obtained by the server
     """
 
-    def _recv(self):
-        self.sock.cont()
-        self.path: str = self.sock.recv().decode("utf-8")
+    def _parse(self):
+        self.path: str = self.details.get("path", "")
 
     def __str__(self):
         return f"The path {self.path} is invalid"
@@ -226,9 +262,36 @@ class SockIsADirectoryError(ServerError):
     :param path: The invalid path obtained by the server
     """
 
-    def _recv(self):
-        self.sock.cont()
-        self.path: str = self.sock.recv().decode("utf-8")
+    def _parse(self):
+        self.path: str = self.details.get("path", "")
 
     def __str__(self):
         return f"{self.path} is a directory."
+
+
+class UnknownOperationError(ServerError):
+    """
+    Raised when an operation does not exist, or finished too long ago
+
+    :param operation_id: The ID of the operation
+    """
+
+    def _parse(self):
+        self.operation_id: str = self.details.get("operation_id", "")
+
+    def __str__(self):
+        return f"Operation {self.operation_id} does not exist"
+
+
+class OperationCancelledError(ServerError):
+    """
+    Raised when an operation was cancelled before it was done
+
+    :param operation_id: The ID of the operation
+    """
+
+    def _parse(self):
+        self.operation_id: str = self.details.get("operation_id", "")
+
+    def __str__(self):
+        return f"Operation {self.operation_id} was cancelled"
@@ -0,0 +1,538 @@
+"""
+Runs the data-heavy work of the server in a pool of worker processes, so that
+streaming run sessions and file transfers use every core and never hold up the
+requests handled by the server itself. POSIX only.
+
+The server keeps dispatching requests and tracking the state of containers. For
+a RUN-COMMAND, it hands the client's connection over to a worker, which runs the
+command and streams its I/O from then on. For GET-FILE and PUT-FILE, it hands
+the file over, and answers the client once the worker is done. Each worker opens
+SSH connections of its own to the containers, and reuses them across requests.
+"""
+
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import os
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from src.containers.container import Container
+from src.system.async_socket import AsyncClientServerSocket
+from src.system.metrics import Metrics
+from src.system.server_logging import (
+    LOGGER_NAME,
+    start_worker_logging,
+    worker_logging,
+)
+from src.system.ssh import SSHInterface
+
+# Threads of a worker, for the blocking calls into paramiko
+WORKER_THREADS = 8
+# Seconds between two progress reports of the same transfer
+PROGRESS_INTERVAL = 0.1
+
+
+class SessionWorkerPool:
+    """
+    The worker processes of the server, and the jobs running on them. Must be used
+    from the server's event loop.
+
+    :param size: The number of worker processes
+    :param logger: Logger
+    :param workers: The worker processes
+    """
+
+    size: int
+    logger: logging.Logger
+    workers: List["_WorkerHandle"]
+
+    def __init__(self, size: int, logger: logging.Logger) -> None:
+        self.size = size
+        self.logger = logger
+        self.workers = []
+
+    def start(self) -> None:
+        """
+        Starts the worker processes
+        """
+        self.workers = [_WorkerHandle(self.logger) for _ in range(self.size)]
+
+    def stop(self) -> None:
+        """
+        Stops the worker processes. The jobs still running on them are cut short.
+        """
+        for worker in self.workers:
+            worker.close()
+        self.workers = []
+
+    async def run_command(
+        self,
+        container: Container,
+        cli: List[str],
+        client_sock: socket.socket,
+        buffered: bytes,
+        fds: Optional[List[int]],
+        capture: bool,
+        on_start: Callable[[int], None],
+    ) -> Dict[str, Any]:
+        """
+        Runs a command on a worker, which streams its I/O with the client from then
+        on. Raises ConnectionError if the worker died.
+
+        :param container: The running container
+        :param cli: The command
+        :param client_sock: The connection of the client, handed over to the worker
+        :param buffered: Data received from the client but not read yet
+        :param fds: The client's stdio file descriptors, if it passed them
+        :param capture: Whether the command is captured, see _RunCommandHandler
+        :param on_start: Called with the PID of the command once it started
+        :return: The exit status of the command ("exit_status", None if it did not
+                 exit on its own), and the bytes streamed ("bytes")
+        """
+
+        def on_event(event: Dict[str, Any]) -> None:
+            on_start(event["pid"])
+
+        return await self._pick().run(
+            {
+                "op": "RUN-COMMAND",
+                "ssh": _ssh_info(container),
+                "cli": cli,
+                "capture": capture,
+            },
+            [client_sock.fileno(), *(fds or [])],
+            buffered,
+            on_event,
+        )
+
+    async def transfer(
+        self,
+        direction: str,
+        container: Container,
+        remote_file: str,
+        local_file: str,
+        fd: Optional[int],
+        callback: Callable[[int, int], None],
+    ) -> None:
+        """
+        Transfers a file on a worker.
+        Raises FileNotFoundError, IsADirectoryError, or ConnectionError if the
+        worker died
+
+        :param direction: "get" or "put"
+        :param container: The running container
+        :param remote_file: The path of the file in the container
+        :param local_file: The path of the local file
+        :param fd: The open local file, handed over to the worker, if any
+        :param callback: Called with the bytes transferred so far and the total
+        """
+
+        def on_event(event: Dict[str, Any]) -> None:
+            callback(event["done"], event["total"])
+
+        await self._pick().run(
+            {
+                "op": "GET-FILE" if direction == "get" else "PUT-FILE",
+                "ssh": _ssh_info(container),
+                "remote_file": remote_file,
+                "local_file": local_file,
+            },
+            [fd] if fd is not None else [],
+            b"",
+            on_event,
+        )
+
+    def _pick(self) -> "_WorkerHandle":
+        """
+        Picks the worker with the fewest jobs, restarting it if it died
+
+        :return: The worker
+        """
+        index = min(range(len(self.workers)), key=lambda i: len(self.workers[i].jobs))
+        if self.workers[index].closed:
+            self.logger.warning("Session worker died, restarting it")
+            self.workers[index] = _WorkerHandle(self.logger)
+        return self.workers[index]
+
+
+class _WorkerHandle:
+    """
+    Internal class used by SessionWorkerPool for a single worker process. Jobs are
+    sent over a socket pair, tagged with an ID; the worker answers with events,
+    then with OK or ERROR.
+
+    :param process: The worker process
+    :param sock: The server's end of the socket pair
+    :param jobs: The futures and event callbacks of the running jobs, by ID
+    :param closed: Whether the worker died or was stopped
+    """
+
+    process: multiprocessing.process.BaseProcess
+    sock: AsyncClientServerSocket
+    jobs: Dict[int, Tuple["asyncio.Future[Dict[str, Any]]", Callable]]
+    closed: bool = False
+
+    def __init__(self, logger: logging.Logger) -> None:
+        parent, child = socket.socketpair()
+        # Not forked: the server has threads and an event loop of its own
+        context = multiprocessing.get_context("spawn")
+        self.process = context.Process(
+            target=_worker_main,
+            args=(child, worker_logging()),
+            name="jab-session-worker",
+            daemon=True,
+        )
+        self.process.start()
+        child.close()
+        self.logger = logger
+        self.sock = AsyncClientServerSocket(parent)
+        self.jobs = {}
+        self._ids = itertools.count()
+        self._reader = asyncio.ensure_future(self._recv())
+
+    async def run(
+        self,
+        job: Dict[str, Any],
+        fds: List[int],
+        body: bytes,
+        on_event: Callable[[Dict[str, Any]], None],
+    ) -> Dict[str, Any]:
+        """
+        Runs a job on the worker
+
+        :param job: The job
+        :param fds: File descriptors handed over to the worker
+        :param body: Data sent along with the job
+        :param on_event: Called with each event the worker sends about the job
+        :return: The result of the job
+        """
+        if self.closed:
+            raise ConnectionError("Session worker died")
+        job_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self.jobs[job_id] = (future, on_event)
+        try:
+            await self.sock.send_msg({**job, "id": job_id}, body, fds)
+            return await future
+        finally:
+            self.jobs.pop(job_id, None)
+
+    async def _recv(self) -> None:
+        """
+        Routes the answers of the worker to the jobs they belong to
+        """
+        try:
+            while True:
+                header, _ = await self.sock.recv_msg()
+                future, on_event = self.jobs.get(header.get("id"), (None, None))
+                if future is None or future.done():
+                    continue
+                if header["status"] == "EVENT":
+                    try:
+                        on_event(header)
+                    except Exception as ex:  # pylint: disable=broad-except
+                        # The job was cancelled: stop the worker running it
+                        future.set_exception(ex)
+                        await self.sock.send_msg({"op": "CANCEL", "id": header["id"]})
+                elif header["status"] == "ERROR":
+                    future.set_exception(_job_error(header))
+                else:
+                    future.set_result(header)
+        except (ConnectionError, OSError):
+            pass
+        except Exception as ex:  # pylint: disable=broad-except
+            self.logger.exception(ex)
+        self.close()
+
+    def close(self) -> None:
+        """
+        Stops the worker. Its running jobs fail with ConnectionError.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self._reader.cancel()
+        self.sock.close()  # The worker exits once its end is closed
+        for future, _ in self.jobs.values():
+            if not future.done():
+                future.set_exception(ConnectionError("Session worker died"))
+
+
+def _job_error(header: Dict[str, Any]) -> Exception:
+    """
+    :param header: The ERROR answer of a worker
+    :return: The exception raised by the job
+    """
+    if header["error"] == "INVALID_PATH":
+        return FileNotFoundError(2, "No such file", header["path"])
+    if header["error"] == "IS_A_DIRECTORY":
+        return IsADirectoryError(21, "Is a directory", header["path"])
+    return RuntimeError(header.get("message", header["error"]))
+
+
+def _ssh_info(container: Container) -> Dict[str, Any]:
+    """
+    :param container: A running container
+    :return: What a worker needs to open SSH connections to the container
+    """
+    return {
+        "name": container.name,
+        "port": container.ex_port,
+        "user": container.username,
+        "password": container.password,
+    }
+
+
+def _worker_main(sock: socket.socket, log_config: Optional[Dict[str, Any]]) -> None:
+    """
+    Entry point of a worker process
+
+    :param sock: The worker's end of the socket pair
+    :param log_config: Where the worker logs to, see worker_logging
+    """
+    start_worker_logging(log_config)
+    logger = logging.getLogger(f"{LOGGER_NAME}.worker")
+    with suppress(KeyboardInterrupt):
+        asyncio.run(_SessionWorker(logger).serve(sock))
+
+
+class _SessionWorker:
+    """
+    Internal class running in a worker process. Runs the jobs of the server
+    concurrently. Offers the spawn, offload, metrics and logger of
+    ContainerManagerServer to the jobs, so run sessions are served by the same
+    code as in the server.
+
+    :param logger: Logger
+    :param connections: SSH connections to the containers, by name and port
+    :param cancelled: IDs of the running jobs the server cancelled
+    """
+
+    logger: logging.Logger
+    connections: Dict[Tuple[str, int], SSHInterface]
+    cancelled: Set[int]
+    sock: AsyncClientServerSocket
+    executor: ThreadPoolExecutor
+
+    def __init__(self, logger: logging.Logger) -> None:
+        self.logger = logger
+        self.connections = {}
+        self.cancelled = set()
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def serve(self, sock: socket.socket) -> None:
+        """
+        Runs jobs until the server closes its end of the socket pair
+
+        :param sock: The worker's end of the socket pair
+        """
+        loop = asyncio.get_running_loop()
+        self.executor = ThreadPoolExecutor(
+            max_workers=WORKER_THREADS, thread_name_prefix="jab-session"
+        )
+        loop.set_default_executor(self.executor)
+        self.sock = AsyncClientServerSocket(sock)
+        try:
+            while True:
+                job, body = await self.sock.recv_msg()
+                if job["op"] == "CANCEL":
+                    self.cancelled.add(job["id"])
+                    continue
+                fds = self.sock.take_fds(job.get("fds", 0))
+                self.spawn(self._run(job, body, fds))
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            for connection in self.connections.values():
+                with suppress(Exception):
+                    connection.close_all()
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def spawn(self, coro: Awaitable[Any]) -> "asyncio.Task[Any]":
+        """
+        See ContainerManagerServer.spawn
+        """
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def offload(self, func: Callable[..., Any], *args: Any) -> Any:
+        """
+        See ContainerManagerServer.offload
+        """
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, func, *args
+        )
+
+    async def _run(self, job: Dict[str, Any], body: bytes, fds: List[int]) -> None:
+        """
+        Runs a job and sends its result to the server
+
+        :param job: The job
+        :param body: Data sent along with the job
+        :param fds: File descriptors handed over with the job, closed once done
+        """
+        try:
+            if job["op"] == "RUN-COMMAND":
+                header = {"status": "OK", **await self._run_command(job, body, fds)}
+            else:
+                header = {"status": "OK", **await self._transfer(job, fds)}
+        except _JobCancelled:
+            header = {"status": "ERROR", "error": "CANCELLED"}
+        except FileNotFoundError as ex:
+            header = {"status": "ERROR", "error": "INVALID_PATH", "path": ex.filename}
+        except IsADirectoryError as ex:
+            header = {"status": "ERROR", "error": "IS_A_DIRECTORY", "path": ex.filename}
+        except Exception as ex:  # pylint: disable=broad-except
+            self.logger.exception(ex)
+            header = {"status": "ERROR", "error": "EXCEPTION", "message": repr(ex)}
+        finally:
+            self.cancelled.discard(job["id"])
+            for fd in fds:
+                with suppress(OSError):
+                    os.close(fd)
+        with suppress(ConnectionError, OSError):  # The server went away
+            await self.sock.send_msg({"id": job["id"], **header})
+
+    async def _connection(self, info: Dict[str, Any]) -> SSHInterface:
+        """
+        Gets the SSH connection of the worker to a container, opening it if needed
+
+        :param info: The container, see _ssh_info
+        :return: The connection
+        """
+        key = (info["name"], info["port"])
+        connection = self.connections.get(key)
+        transport = connection and connection.ssh_client.get_transport()
+        if transport is None or not transport.is_active():
+            connection = SSHInterface(
+                "127.0.0.1",
+                info["user"],
+                info["port"],
+                info["password"],
+                info["name"],
+                self.logger,
+            )
+            await self.offload(connection.open_all)
+            self.connections[key] = connection
+        return connection
+
+    async def _run_command(
+        self, job: Dict[str, Any], body: bytes, fds: List[int]
+    ) -> Dict[str, Any]:
+        """
+        Runs a command, and streams its I/O with the client
+
+        :param job: The job, with the command ("cli")
+        :param body: Data received from the client but not read by the server
+        :param fds: The connection of the client, then the client's stdio file
+                    descriptors if it passed them
+        :return: The exit status of the command, and the bytes streamed
+        """
+        # pylint: disable=import-outside-toplevel,cyclic-import
+        from src.containers.container_manager_server import _RunCommandHandler
+
+        connection = await self._connection(job["ssh"])
+        stdin, stdout, stderr, pid = await self.offload(
+            connection.exec_ssh_command, job["cli"]
+        )
+        await self.sock.send_msg({"id": job["id"], "status": "EVENT", "pid": pid})
+
+        # The connection and the stdio of the client are closed along with fds
+        client_sock = socket.socket(fileno=os.dup(fds[0]))
+        session = _Session(self, job["ssh"]["name"], connection)
+        await _RunCommandHandler(
+            client_sock=AsyncClientServerSocket(client_sock, body),
+            client_addr=None,
+            manager=session,
+            stdin=stdin,
+            stdout=stdout,
+            stderr=stderr,
+            pid=pid,
+            container=session,
+            fds=fds[1:] or None,
+            capture=job["capture"],
+        ).send_and_recv()
+
+        channel = stdout.channel
+        return {
+            "exit_status": channel.exit_status if channel.exit_status_ready() else None,
+            "bytes": session.metrics.bytes_streamed,
+        }
+
+    async def _transfer(self, job: Dict[str, Any], fds: List[int]) -> Dict[str, Any]:
+        """
+        Transfers a file, reporting its progress to the server
+
+        :param job: The job
+        :param fds: The open local file, if the client passed it
+        :return: Nothing more to report
+        """
+        connection = await self._connection(job["ssh"])
+        loop = asyncio.get_running_loop()
+        last = 0.0
+
+        def callback(done: int, total: int) -> None:
+            # Called from a thread of the worker
+            nonlocal last
+            if job["id"] in self.cancelled:
+                raise _JobCancelled(job["id"])
+            now = time.monotonic()
+            if done < total and now - last < PROGRESS_INTERVAL:
+                return
+            last = now
+            event = {"id": job["id"], "status": "EVENT", "done": done, "total": total}
+            loop.call_soon_threadsafe(self.spawn, self.sock.send_msg(event))
+
+        remote_file, local_file = job["remote_file"], job["local_file"]
+        if job["op"] == "GET-FILE":
+            if fds:
+                with os.fdopen(fds[0], "wb", closefd=False) as fileobj:
+                    await self.offload(connection.getfo, remote_file, fileobj, callback)
+            else:
+                await self.offload(connection.get, remote_file, local_file, callback)
+        elif fds:
+            with os.fdopen(fds[0], "rb", closefd=False) as fileobj:
+                await self.offload(
+                    connection.putfo, fileobj, local_file, remote_file, callback
+                )
+        else:
+            await self.offload(connection.put, local_file, remote_file, callback)
+        return {}
+
+
+class _JobCancelled(Exception):
+    """
+    Internal exception raised by the progress callback of a transfer once the
+    server cancelled it
+    """
+
+
+class _Session:
+    """
+    Internal class used by _SessionWorker for a single run session. Stands in for
+    both the server and the container of _RunCommandHandler, so the bytes it
+    streams are counted for the session alone.
+
+    :param name: The name of the container
+    :param sshi: The worker's SSH connection to the container
+    :param metrics: The bytes streamed by the session
+    """
+
+    name: str
+    sshi: SSHInterface
+    metrics: Metrics
+
+    def __init__(self, worker: _SessionWorker, name: str, sshi: SSHInterface):
+        self.name = name
+        self.sshi = sshi
+        self.metrics = Metrics()
+        self.logger = worker.logger
+        self.spawn = worker.spawn
+        self.offload = worker.offload
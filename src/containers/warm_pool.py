@@ -0,0 +1,316 @@
+"""
+Keeps containers booted ahead of time for the images listed in pool.json, so that
+the first start of a clone of one of them (see clone_container) takes one over
+instead of booting
+"""
+
+import asyncio
+import itertools
+import json
+import logging
+import shutil
+import time
+from contextlib import suppress
+from signal import SIGABRT
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+from src.containers.container import Container
+from src.containers.container_extras import write_clone_files
+from src.containers.exceptions import InvalidConfigError
+from src.system.events import EventBus
+from src.system.server_logging import subsystem_logger
+from src.system.syspath import get_container_config, get_pool_dir, get_pool_file
+
+# Number of containers of the pool booted at once, unless the server says otherwise
+POOL_PARALLELISM = 2
+# Seconds before booting for an image again, once a container of its pool failed to
+POOL_RETRY_DELAY = 30.0
+
+
+class WarmPool:
+    """
+    The containers booted ahead of time. Each of them runs on a copy-on-write
+    overlay of the disk of its image, and is handed over to the first clone of the
+    image that starts. The pool is then refilled in the background, booting no more
+    than parallelism containers at once. Must be used from the event loop.
+
+    :param sizes: The number of containers kept ready for each image
+    :param parallelism: The number of containers booted at once
+    :param logger: Logger
+    :param offload: Runs a blocking function off the event loop
+    :param spawn: Runs a coroutine in the background
+    :param events: Where the pool reports its containers being ready
+    :param busy: Whether an image is running or being modified, in which case no
+                 container is booted for it
+    :param ready: The containers ready to be taken over, by image
+    :param booting: The number of containers being booted, by image
+    """
+
+    sizes: Dict[str, int]
+    parallelism: int
+    logger: logging.Logger
+    offload: Callable[..., Awaitable[Any]]
+    spawn: Callable[[Awaitable[Any]], "asyncio.Task[Any]"]
+    events: EventBus
+    busy: Callable[[str], bool]
+    ready: Dict[str, List[Container]]
+    booting: Dict[str, int]
+
+    def __init__(
+        self,
+        sizes: Dict[str, int],
+        parallelism: int,
+        logger: logging.Logger,
+        offload: Callable[..., Awaitable[Any]],
+        spawn: Callable[[Awaitable[Any]], "asyncio.Task[Any]"],
+        events: EventBus,
+        busy: Callable[[str], bool] = lambda image: False,
+    ) -> None:
+        self.sizes = {}
+        self.parallelism = parallelism
+        self.logger = subsystem_logger(logger, "pool")
+        self.offload = offload
+        self.spawn = spawn
+        self.events = events
+        self.busy = busy
+        self.ready = {}
+        self.booting = {}
+        self._slots = asyncio.Semaphore(max(parallelism, 1))
+        self._ids = itertools.count(1)
+        # Booting containers, so that they can be killed if the server halts
+        self._starting: Set[Container] = set()
+        self._retry_at: Dict[str, float] = {}
+        self._closed = False
+        self.resize(sizes, refill=False)
+
+    async def start(self) -> None:
+        """
+        Removes what a previous server left of the pool, and fills it
+        """
+        await self.offload(shutil.rmtree, get_pool_dir(), True)
+        self.refill()
+
+    def resize(self, sizes: Dict[str, int], refill: bool = True) -> None:
+        """
+        Changes the number of containers kept ready for some images. Containers
+        beyond the new size are killed.
+
+        :param sizes: The new sizes, by image. 0 empties the pool of an image.
+        :param refill: Whether to boot the containers now missing
+        """
+        for image, size in sizes.items():
+            if not isinstance(size, int) or size < 0:
+                raise ValueError(f"Invalid size {size!r} for the pool of {image}")
+        for image, size in sizes.items():
+            if size:
+                self.sizes[image] = size
+            else:
+                self.sizes.pop(image, None)
+            self._retry_at.pop(image, None)
+            ready = self.ready.get(image, [])
+            while len(ready) > size:
+                self.spawn(self._discard(ready.pop()))
+        if refill:
+            self.refill()
+
+    def refill(self) -> None:
+        """
+        Boots containers for the images whose pool is not full
+        """
+        if self._closed:
+            return
+        for image, size in self.sizes.items():
+            missing = size - len(self.ready.get(image, [])) - self.booting.get(image, 0)
+            if missing > 0 and (
+                self._retry_at.get(image, 0) > time.monotonic() or self.busy(image)
+            ):
+                continue
+            for _ in range(missing):
+                self.booting[image] = self.booting.get(image, 0) + 1
+                self.spawn(self._fill(image))
+
+    def prune(self) -> None:
+        """
+        Forgets the containers of the pool whose QEMU process exited, and replaces
+        them
+        """
+        for image, ready in self.ready.items():
+            for container in [c for c in ready if c.exited()]:
+                self.logger.warning("A container of the pool of %s exited", image)
+                ready.remove(container)
+                self.spawn(self._discard(container))
+        self.refill()
+
+    async def claim(self, clone: Container) -> Optional[Container]:
+        """
+        Hands a container of the pool over to a clone that was never started
+
+        :param clone: The clone being started
+        :return: The container, now running as the clone, or None if the clone
+                 cannot be given one and must be booted
+        """
+        if clone.image is None or (clone.directory / "hdd.qcow2").exists():
+            return None
+        ready = self.ready.get(clone.image, [])
+        config = clone.to_dict()
+        # A clone whose config was changed since it was created is booted as such
+        for container in [c for c in ready if c.to_dict() == config]:
+            ready.remove(container)
+            self.refill()
+            if container.exited():
+                self.spawn(self._discard(container))
+                continue
+            try:
+                await self.offload(container.move_to, clone.name)
+            except OSError as exc:
+                self.logger.warning(
+                    "Could not hand a container over to %s: %r", clone.name, exc
+                )
+                self.spawn(self._discard(container))
+                return None
+            self.logger.debug("Handed a container over to %s", clone.name)
+            return container
+        return None
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        """
+        :return: The size of the pool of each image, and how many of its
+                 containers are ready and booting
+        """
+        images = set(self.sizes) | {image for image, n in self.booting.items() if n}
+        return {
+            image: {
+                "size": self.sizes.get(image, 0),
+                "ready": len(self.ready.get(image, [])),
+                "booting": self.booting.get(image, 0),
+            }
+            for image in sorted(images)
+        }
+
+    def holds(self, image: str) -> bool:
+        """
+        :param image: The name of an image
+        :return: Whether containers are kept ready, or being booted, for the image
+        """
+        return bool(
+            self.sizes.get(image) or self.ready.get(image) or self.booting.get(image)
+        )
+
+    def count_ready(self) -> int:
+        """
+        :return: The number of containers ready to be taken over
+        """
+        return sum(len(ready) for ready in self.ready.values())
+
+    async def stop(self) -> None:
+        """
+        Kills every container of the pool, including those still booting
+        """
+        self._closed = True
+        containers = [c for ready in self.ready.values() for c in ready]
+        self.ready = {}
+        for container in list(self._starting):
+            with suppress(OSError, AttributeError):
+                container.booter.kill(SIGABRT)
+        await asyncio.gather(*(self._discard(c) for c in containers))
+
+    async def _fill(self, image: str) -> None:
+        """
+        Boots a container for the pool of an image
+        """
+        try:
+            async with self._slots:
+                # The pool may have been resized or stopped while waiting
+                wanted = self.sizes.get(image, 0) - len(self.ready.get(image, []))
+                if self._closed or self.booting[image] > wanted or self.busy(image):
+                    return
+                name = f"{image}@pool{next(self._ids)}"
+                container = await self.offload(self._boot, image, name)
+        except (InvalidConfigError, FileNotFoundError) as exc:
+            self.logger.warning("Not pooling %s: %s", image, exc)
+            self.sizes.pop(image, None)
+            return
+        except Exception as exc:  # pylint: disable=broad-except
+            if self._closed:
+                return  # Killed by stop
+            self.logger.warning("A container of the pool of %s failed: %r", image, exc)
+            self.events.publish("pool_boot_failed", image, error=repr(exc))
+            self._retry_at[image] = time.monotonic() + POOL_RETRY_DELAY
+            asyncio.get_running_loop().call_later(POOL_RETRY_DELAY, self.refill)
+            return
+        finally:
+            self.booting[image] -= 1
+
+        if self._closed or len(self.ready.get(image, [])) >= self.sizes.get(image, 0):
+            await self._discard(container)
+            return
+        self.ready.setdefault(image, []).append(container)
+        self.events.publish("pool_ready", image, ready=len(self.ready[image]))
+
+    def _boot(self, image: str, name: str) -> Container:
+        """
+        Prepares the folder of a container of the pool, and boots it. Blocking.
+
+        :param image: The image of the container
+        :param name: The name of the container, until a clone takes it over
+        :return: The container
+        """
+        with open(get_container_config(image), "r", encoding="utf-8") as file:
+            config = json.load(file)
+        if config.get("portfwd"):
+            raise InvalidConfigError("its containers forward ports of the host")
+        config["image"] = config.get("image", image)
+
+        directory = get_pool_dir() / name
+        directory.mkdir(parents=True)
+        container = None
+        try:
+            write_clone_files(image, directory, config)
+            container = Container(name, self.logger, directory)
+            self._starting.add(container)
+            container.start()
+        except BaseException:
+            if container is not None:
+                with suppress(OSError, AttributeError):
+                    container.kill()
+            shutil.rmtree(directory, ignore_errors=True)
+            raise
+        finally:
+            self._starting.discard(container)
+        return container
+
+    async def _discard(self, container: Container) -> None:
+        """
+        Kills a container of the pool, and removes its folder
+        """
+        with suppress(OSError, AttributeError):
+            await self.offload(container.kill)
+        await self.offload(shutil.rmtree, container.directory, True)
+
+
+def load_pool_sizes() -> Dict[str, int]:
+    """
+    Reads the size of the pool of each image from pool.json, as in {"lab": 4}.
+    Raises InvalidConfigError, ValueError if the file is malformed
+
+    :return: The sizes, by image. Empty if there is no pool.json.
+    """
+    if not get_pool_file().is_file():
+        return {}
+    with open(get_pool_file(), "r", encoding="utf-8") as file:
+        sizes = json.load(file)
+    if not isinstance(sizes, dict) or not all(
+        isinstance(size, int) and size >= 0 for size in sizes.values()
+    ):
+        raise InvalidConfigError(f"{get_pool_file()} must map images to sizes")
+    return sizes
+
+
+def save_pool_sizes(sizes: Dict[str, int]) -> None:
+    """
+    Writes the size of the pool of each image to pool.json
+
+    :param sizes: The sizes, by image
+    """
+    with open(get_pool_file(), "w", encoding="utf-8") as file:
+        json.dump(sizes, file)
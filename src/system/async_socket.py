@@ -0,0 +1,368 @@
+"""
+Deals with the server side of client/server sockets, on the event loop
+"""
+
+import asyncio
+import json
+import os
+import socket
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from src.system.my_socket import (
+    FRAME_HEADER,
+    MAX_FDS_PER_FRAME,
+    decode_frame_prefix,
+    encode_frame,
+    is_unix_socket,
+)
+
+
+class AsyncClientServerSocket:
+    """
+    Asynchronous counterpart of ClientServerSocket, used by the server's event loop.
+    Must be created from within a running event loop.
+
+    File descriptors received over a unix domain socket are queued in the order
+    they arrive, and are claimed with take_fds once their frame has been read.
+
+    :param _sock: The python socket.socket object
+    :param buffered: Data already received from the socket, read before the rest
+    """
+
+    recv_size: int = 1 << 16
+
+    def __init__(self, sock: socket.socket, buffered: bytes = b"") -> None:
+        sock.setblocking(False)
+        self._sock = sock
+        self._loop = asyncio.get_running_loop()
+        self._send_lock = asyncio.Lock()
+        self._buffer = bytearray(buffered)
+        self._detached = False
+        self._fds: Deque[int] = deque()
+        self._unix = is_unix_socket(sock)
+
+    async def send(self, data: bytes) -> None:
+        """
+        Sends raw data over the socket
+
+        :param data: The data to be sent over the socket
+        """
+        async with self._send_lock:
+            await self._loop.sock_sendall(self._sock, data)
+
+    async def recv(self, bufsize: int = 1 << 16) -> bytes:
+        """
+        Recieves raw data over the socket
+
+        :param bufsize: The maximum number of bytes to recieve
+        """
+        if self._buffer:
+            data = bytes(self._buffer[:bufsize])
+            del self._buffer[:bufsize]
+            return data
+        return await self._recv_some(bufsize)
+
+    def take_fds(self, count: int) -> List[int]:
+        """
+        Claims file descriptors received along with the last frame read
+
+        :param count: The number of file descriptors attached to the frame
+        :return: The file descriptors, now owned by the caller
+        """
+        if count > len(self._fds):
+            raise ConnectionError("Frame claims more file descriptors than received")
+        return [self._fds.popleft() for _ in range(count)]
+
+    async def _recv_some(self, bufsize: int) -> bytes:
+        """
+        Recieves up to bufsize bytes, collecting any file descriptors sent with them
+
+        :param bufsize: The maximum number of bytes to recieve
+        """
+        if not self._unix:
+            return await self._loop.sock_recv(self._sock, bufsize)
+
+        while True:
+            try:
+                data, fds, _, _ = socket.recv_fds(  # pylint: disable=no-member
+                    self._sock, bufsize, MAX_FDS_PER_FRAME
+                )
+            except (BlockingIOError, InterruptedError):
+                await wait_readable(self._sock.fileno())
+            else:
+                self._fds.extend(fds)
+                return data
+
+    async def send_msg(
+        self,
+        header: Dict[str, Any],
+        body: bytes = b"",
+        fds: Optional[List[int]] = None,
+    ) -> None:
+        """
+        Sends a single frame over the socket
+
+        :param header: The JSON-serializable header of the frame
+        :param body: The binary body of the frame
+        :param fds: File descriptors attached to the frame (unix sockets only)
+        """
+        if not fds:
+            await self.send(encode_frame(header, body))
+            return
+
+        frame = encode_frame({**header, "fds": len(fds)}, body)
+        async with self._send_lock:
+            while True:
+                try:
+                    sent = socket.send_fds(  # pylint: disable=no-member
+                        self._sock, [frame], fds
+                    )
+                    break
+                except (BlockingIOError, InterruptedError):
+                    await wait_writable(self._sock.fileno())
+            await self._loop.sock_sendall(self._sock, frame[sent:])
+
+    async def recv_msg(self) -> Tuple[Dict[str, Any], bytes]:
+        """
+        Recieves a single frame over the socket
+
+        :return: The header and the body of the frame
+        """
+        header_len, body_len = decode_frame_prefix(
+            await self._recv_exactly(FRAME_HEADER.size)
+        )
+        header = json.loads((await self._recv_exactly(header_len)).decode("utf-8"))
+        body = await self._recv_exactly(body_len) if body_len else b""
+        return header, body
+
+    async def _recv_exactly(self, size: int) -> bytes:
+        """
+        Recieves exactly size bytes over the socket
+
+        :param size: The number of bytes to recieve
+        """
+        while len(self._buffer) < size:
+            chunk = await self._recv_some(self.recv_size)
+            if not chunk:
+                raise ConnectionError("Connection closed in the middle of a frame")
+            self._buffer += chunk
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def detach(self) -> Tuple[socket.socket, bytes]:
+        """
+        Gives up the socket, for instance to hand it over to another process.
+        Closing this object no longer closes the socket.
+
+        :return: The socket, and the data received from it but not read yet
+        """
+        self._detached = True
+        buffered = bytes(self._buffer)
+        self._buffer.clear()
+        return self._sock, buffered
+
+    def close(self) -> None:
+        """
+        Closes the socket, along with any file descriptors nobody claimed
+        """
+        while self._fds:
+            os.close(self._fds.popleft())
+        if not self._detached:
+            self._sock.close()
+
+
+class Responder:
+    """
+    Sends the response to a single request over a shared AsyncClientServerSocket
+
+    :param sock: The connection the request came from
+    :param request_id: The ID of the request, echoed back in every response frame
+    :param status: The status of the last response sent, if any
+    """
+
+    sock: AsyncClientServerSocket
+    request_id: Optional[int]
+    status: Optional[str] = None
+
+    def __init__(
+        self, sock: AsyncClientServerSocket, request_id: Optional[int]
+    ) -> None:
+        self.sock = sock
+        self.request_id = request_id
+
+    async def send_msg(self, header: Dict[str, Any], body: bytes = b"") -> None:
+        """
+        Sends a frame tagged with the ID of the request
+
+        :param header: The JSON-serializable header of the frame
+        :param body: The binary body of the frame
+        """
+        if self.request_id is not None:
+            header = {"id": self.request_id, **header}
+        self.status = header.get("status", self.status)
+        await self.sock.send_msg(header, body)
+
+    async def begin(self) -> None:
+        """
+        Sends BEGIN over the socket
+        """
+        await self.send_msg({"status": "BEGIN"})
+
+    async def ok(self, **data: Any) -> None:  # pylint: disable=invalid-name
+        """
+        Sends OK over the socket
+
+        :param data: Values returned to the client along with the response
+        """
+        await self.send_msg({"status": "OK", **data})
+
+    async def event(self, **data: Any) -> None:
+        """
+        Sends a partial result over the socket. Any number of events may precede
+        the final OK or ERROR of a request.
+
+        :param data: Values sent to the client
+        """
+        await self.send_msg({"status": "EVENT", **data})
+
+    async def error(self, code: str, **args: str) -> None:
+        """
+        Sends an error response over the socket
+
+        :param code: The error code, see get_server_error
+        :param args: The details of the error
+        """
+        await self.send_msg({"status": "ERROR", "error": code, "args": args})
+
+    async def raise_exception(self) -> None:
+        """
+        Notifies client that an exception occured
+        """
+        await self.error("EXCEPTION_OCCURED")
+
+    async def raise_unknown_request(self, request: str) -> None:
+        """
+        Notifies client that the server got an unknown request
+
+        :param request: The content of the unknown request
+        """
+        await self.error("UNKNOWN_REQUEST", request=request)
+
+    async def raise_container_not_started(self, container_name: str) -> None:
+        """
+        Notifies client that a container was not started
+
+        :param container_name: The name of the container not started
+        """
+        await self.error("CONTAINER_NOT_STARTED", container_name=container_name)
+
+    async def raise_no_such_container(self, container_name: str) -> None:
+        """
+        Notifies client that a container does not exist
+
+        :param container_name: The name of the container
+        """
+        await self.error("NO_SUCH_CONTAINER", container_name=container_name)
+
+    async def raise_container_started_cannot_modify(self, container_name: str) -> None:
+        """
+        Notifies the client that a container has been started (so cannot be modified)
+
+        :param container_name: The name of the container
+        """
+        await self.error(
+            "CONTAINER_STARTED_CANNOT_MODIFY", container_name=container_name
+        )
+
+    async def raise_image_in_use(self, container_name: str, users: List[str]) -> None:
+        """
+        Notifies the client that other containers run on a container (so it cannot
+        be started or modified)
+
+        :param container_name: The name of the container
+        :param users: The clones of the container, and its warm pool
+        """
+        await self.error("IMAGE_IN_USE", container_name=container_name, users=users)
+
+    async def raise_clone_cannot_be_archived(
+        self, container_name: str, image: str
+    ) -> None:
+        """
+        Notifies the client that a clone cannot be archived
+
+        :param container_name: The name of the clone
+        :param image: The name of its image
+        """
+        await self.error(
+            "CLONE_CANNOT_BE_ARCHIVED", container_name=container_name, image=image
+        )
+
+    async def raise_boot_error(self) -> None:
+        """
+        Notifies the client that a container failed to boot
+        """
+        await self.error("BOOT_FAILURE")
+
+    async def raise_invalid_path(self, path: str) -> None:
+        """
+        Notifies the client that an invalid path was given to the server
+
+        :param path: The path that was given to the server
+        """
+        await self.error("INVALID_PATH", path=path)
+
+    async def raise_no_such_operation(self, operation_id: str) -> None:
+        """
+        Notifies the client that an operation does not exist, or was forgotten
+
+        :param operation_id: The ID of the operation
+        """
+        await self.error("NO_SUCH_OPERATION", operation_id=operation_id)
+
+    async def raise_operation_cancelled(self, operation_id: str) -> None:
+        """
+        Notifies the client that an operation was cancelled before it was done
+
+        :param operation_id: The ID of the operation
+        """
+        await self.error("OPERATION_CANCELLED", operation_id=operation_id)
+
+    async def raise_is_a_directory(self, path: str):
+        """
+        Notifies a client that a directory was provided
+
+        :path: The path provided
+        """
+        await self.error("IS_A_DIRECTORY", path=path)
+
+
+async def wait_readable(fileno: int) -> None:
+    """
+    Waits until a file descriptor is readable. Must be called from the event loop.
+
+    :param fileno: The file descriptor
+    """
+    loop = asyncio.get_running_loop()
+    readable = loop.create_future()
+    loop.add_reader(fileno, lambda: readable.done() or readable.set_result(None))
+    try:
+        await readable
+    finally:
+        loop.remove_reader(fileno)
+
+
+async def wait_writable(fileno: int) -> None:
+    """
+    Waits until a file descriptor is writable. Must be called from the event loop.
+
+    :param fileno: The file descriptor
+    """
+    loop = asyncio.get_running_loop()
+    writable = loop.create_future()
+    loop.add_writer(fileno, lambda: writable.done() or writable.set_result(None))
+    try:
+        await writable
+    finally:
+        loop.remove_writer(fileno)
@@ -0,0 +1,163 @@
+"""
+Publishes what happens on the container manager server to the clients that
+subscribed to it
+"""
+
+import asyncio
+import fnmatch
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# Number of events a subscriber may fall behind by before events are dropped
+SUBSCRIBER_QUEUE_SIZE = 1000
+# Seconds between two progress events of the same transfer
+TRANSFER_EVENT_INTERVAL = 0.5
+
+
+class Subscription:
+    """
+    The events a single subscriber asked for, queued until they are sent. Must be
+    created from the event loop.
+
+    :param containers: Glob patterns of the containers whose events are wanted,
+                       or None for all events
+    :param kinds: The kinds of events wanted, or None for all of them
+    :param queue: The events waiting to be sent
+    :param dropped: Number of events dropped since the last one queued, because
+                    the subscriber fell behind
+    """
+
+    containers: Optional[List[str]]
+    kinds: Optional[List[str]]
+    queue: "asyncio.Queue[Dict[str, Any]]"
+    dropped: int = 0
+
+    def __init__(
+        self, containers: Optional[List[str]], kinds: Optional[List[str]]
+    ) -> None:
+        self.containers = containers
+        self.kinds = kinds
+        self.queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.loop = asyncio.get_running_loop()
+
+    def wants(self, event: Dict[str, Any]) -> bool:
+        """
+        :param event: An event
+        :return: Whether the subscriber asked for the event
+        """
+        if self.kinds is not None and event["event"] not in self.kinds:
+            return False
+        if self.containers is None:
+            return True
+        container = event.get("container")
+        return container is not None and any(
+            fnmatch.fnmatchcase(container, pattern) for pattern in self.containers
+        )
+
+    def put(self, event: Dict[str, Any]) -> None:
+        """
+        Queues an event, or drops it if the subscriber fell too far behind. Must be
+        called from the event loop.
+
+        :param event: The event
+        """
+        if self.queue.full():
+            self.dropped += 1
+            return
+        if self.dropped:
+            event = {**event, "dropped": self.dropped}
+            self.dropped = 0
+        self.queue.put_nowait(event)
+
+
+class EventBus:
+    """
+    Hands events to every interested subscriber. Events may be published from the
+    event loop or from worker threads, and cost next to nothing when nobody is
+    subscribed.
+
+    :param subscriptions: The current subscriptions
+    """
+
+    subscriptions: Tuple[Subscription, ...]
+
+    def __init__(self) -> None:
+        # Replaced rather than mutated, so publishers never see it change under them
+        self.subscriptions = ()
+
+    def subscribe(
+        self,
+        containers: Optional[List[str]] = None,
+        kinds: Optional[List[str]] = None,
+    ) -> Subscription:
+        """
+        Starts queuing events for a subscriber. Must be called from the event loop.
+
+        :param containers: See Subscription
+        :param kinds: See Subscription
+        :return: The subscription
+        """
+        subscription = Subscription(containers, kinds)
+        self.subscriptions = (*self.subscriptions, subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        """
+        Stops queuing events for a subscriber. Must be called from the event loop.
+
+        :param subscription: The subscription
+        """
+        self.subscriptions = tuple(
+            s for s in self.subscriptions if s is not subscription
+        )
+
+    def publish(self, kind: str, container: Optional[str] = None, **data: Any) -> None:
+        """
+        Publishes an event
+
+        :param kind: The kind of event, as in "running" or "session_opened"
+        :param container: The container the event is about, if any
+        :param data: Details of the event
+        """
+        subscriptions = self.subscriptions
+        if not subscriptions:
+            return
+        event = {"event": kind, "time": time.time(), **data}
+        if container is not None:
+            event["container"] = container
+        for subscription in subscriptions:
+            if subscription.wants(event):
+                subscription.loop.call_soon_threadsafe(subscription.put, event)
+
+    def transfer_callback(
+        self, direction: str, container: str, path: str
+    ) -> Callable[[int, int], None]:
+        """
+        Makes a progress callback for paramiko's SFTP transfers, which publishes
+        "transfer" events at most every TRANSFER_EVENT_INTERVAL, and once done if
+        the size of the file is known.
+
+        :param direction: "get" or "put"
+        :param container: The container files are transferred to or from
+        :param path: The path of the file in the container
+        :return: The callback, taking the bytes transferred so far and the total
+        """
+        last = 0.0
+
+        def callback(done: int, total: int) -> None:
+            nonlocal last
+            now = time.monotonic()
+            # The total is 0 when the size of the file is unknown
+            if (done < total or not total) and now - last < TRANSFER_EVENT_INTERVAL:
+                return
+            last = now
+            self.publish(
+                "transfer",
+                container,
+                direction=direction,
+                path=path,
+                done=done,
+                total=total,
+            )
+
+        return callback
@@ -0,0 +1,252 @@
+"""
+Collects metrics about the container manager server
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from typing import Any, Callable, Dict, List, Tuple
+
+# Upper bounds, in seconds, of the buckets of latency and duration histograms
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+
+
+class Histogram:
+    """
+    A histogram with fixed buckets, in the style of Prometheus
+
+    :param buckets: Upper bounds of the buckets, in increasing order
+    :param counts: Number of observations falling in each bucket, plus the
+                   observations above the last bound
+    :param total: Sum of all observations
+    """
+
+    buckets: Tuple[float, ...]
+    counts: List[int]
+    total: float
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+
+    @property
+    def count(self) -> int:
+        """
+        Number of observations
+        """
+        return sum(self.counts)
+
+    def observe(self, value: float) -> None:
+        """
+        Records an observation
+
+        :param value: The observed value
+        """
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        """
+        Gets the number of observations at or below each bound
+
+        :return: (upper bound, count) pairs, ending with ("+Inf", count)
+        """
+        result = []
+        running = 0
+        for bound, count in zip((*map(str, self.buckets), "+Inf"), self.counts):
+            running += count
+            result.append((bound, running))
+        return result
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        :return: A JSON-serializable copy of the histogram
+        """
+        return {"count": self.count, "sum": self.total, "buckets": self.cumulative()}
+
+
+class Metrics:
+    """
+    Counters, histograms and gauges of the server. Safe to update from the event
+    loop and from worker threads alike.
+
+    :param started: Time at which metrics started being collected
+    :param requests: Number of requests handled, per op
+    :param errors: Number of requests answered with an error, per op
+    :param latency: Time taken to handle requests, per op
+    :param boot_duration: Time taken by successful boots
+    :param bytes_streamed: Bytes moved by RUN-COMMAND sessions and file transfers,
+                           per direction ("run_stdin", "run_stdout", "run_stderr",
+                           "get", "put")
+    :param connections: Number of client connections currently open
+    :param sessions: Number of RUN-COMMAND sessions currently open
+    :param gauges: Gauges computed when metrics are read, by name
+    """
+
+    started: float
+    requests: Dict[str, int]
+    errors: Dict[str, int]
+    latency: Dict[str, Histogram]
+    boot_duration: Histogram
+    bytes_streamed: Dict[str, int]
+    connections: int = 0
+    sessions: int = 0
+    gauges: Dict[str, Callable[[], float]]
+
+    def __init__(self) -> None:
+        self.started = time.time()
+        self.requests = {}
+        self.errors = {}
+        self.latency = {}
+        self.boot_duration = Histogram()
+        self.bytes_streamed = {}
+        self.gauges = {}
+        self._lock = threading.Lock()
+
+    def observe_request(self, op: str, seconds: float, failed: bool) -> None:
+        """
+        Records a handled request
+
+        :param op: The operation requested
+        :param seconds: Time taken to handle the request
+        :param failed: Whether the request was answered with an error
+        """
+        with self._lock:
+            self.requests[op] = self.requests.get(op, 0) + 1
+            if failed:
+                self.errors[op] = self.errors.get(op, 0) + 1
+            self.latency.setdefault(op, Histogram()).observe(seconds)
+
+    def observe_boot(self, seconds: float) -> None:
+        """
+        Records a successful boot
+
+        :param seconds: Time taken to boot
+        """
+        with self._lock:
+            self.boot_duration.observe(seconds)
+
+    def add_bytes(self, direction: str, size: int) -> None:
+        """
+        Records streamed bytes
+
+        :param direction: See bytes_streamed
+        :param size: Number of bytes
+        """
+        with self._lock:
+            self.bytes_streamed[direction] = (
+                self.bytes_streamed.get(direction, 0) + size
+            )
+
+    def transfer_callback(self, direction: str) -> Callable[[int, int], None]:
+        """
+        Makes a progress callback for paramiko's SFTP transfers, which records the
+        transferred bytes as they go.
+
+        :param direction: "get" or "put"
+        :return: The callback, taking the bytes transferred so far and the total
+        """
+        transferred = 0
+
+        def callback(done: int, _total: int) -> None:
+            nonlocal transferred
+            self.add_bytes(direction, done - transferred)
+            transferred = done
+
+        return callback
+
+    def add_connections(self, delta: int) -> None:
+        """
+        Records client connections being opened (1) or closed (-1)
+        """
+        with self._lock:
+            self.connections += delta
+
+    def add_sessions(self, delta: int) -> None:
+        """
+        Records RUN-COMMAND sessions being opened (1) or closed (-1)
+        """
+        with self._lock:
+            self.sessions += delta
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        :return: A JSON-serializable copy of all metrics
+        """
+        with self._lock:
+            return {
+                "uptime": time.time() - self.started,
+                "requests": dict(self.requests),
+                "errors": dict(self.errors),
+                "latency": {op: h.snapshot() for op, h in self.latency.items()},
+                "boot_duration": self.boot_duration.snapshot(),
+                "bytes_streamed": dict(self.bytes_streamed),
+                "gauges": {
+                    "connections": self.connections,
+                    "sessions": self.sessions,
+                    **{name: gauge() for name, gauge in self.gauges.items()},
+                },
+            }
+
+    def prometheus(self) -> str:
+        """
+        Renders all metrics in the Prometheus text exposition format
+
+        :return: The metrics
+        """
+        stats = self.snapshot()
+        lines = [
+            "# TYPE jab_uptime_seconds gauge",
+            f"jab_uptime_seconds {stats['uptime']}",
+            "# TYPE jab_requests_total counter",
+            *(
+                f'jab_requests_total{{op="{op}"}} {count}'
+                for op, count in sorted(stats["requests"].items())
+            ),
+            "# TYPE jab_request_errors_total counter",
+            *(
+                f'jab_request_errors_total{{op="{op}"}} {count}'
+                for op, count in sorted(stats["errors"].items())
+            ),
+            "# TYPE jab_request_duration_seconds histogram",
+        ]
+        for op, histogram in sorted(stats["latency"].items()):
+            lines += _prometheus_histogram(
+                "jab_request_duration_seconds", histogram, f'op="{op}"'
+            )
+        lines.append("# TYPE jab_boot_duration_seconds histogram")
+        lines += _prometheus_histogram(
+            "jab_boot_duration_seconds", stats["boot_duration"]
+        )
+        lines.append("# TYPE jab_streamed_bytes_total counter")
+        lines += [
+            f'jab_streamed_bytes_total{{direction="{direction}"}} {size}'
+            for direction, size in sorted(stats["bytes_streamed"].items())
+        ]
+        for name, value in sorted(stats["gauges"].items()):
+            lines += [f"# TYPE jab_{name} gauge", f"jab_{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+
+def _prometheus_histogram(
+    name: str, histogram: Dict[str, Any], labels: str = ""
+) -> List[str]:
+    """
+    Renders a histogram snapshot in the Prometheus text exposition format
+
+    :param name: The name of the metric
+    :param histogram: The snapshot of the histogram
+    :param labels: Labels of the metric, as in 'op="PING"'
+    :return: The lines of the histogram
+    """
+    prefix = f"{labels}," if labels else ""
+    suffix = f"{{{labels}}}" if labels else ""
+    return [
+        *(
+            f'{name}_bucket{{{prefix}le="{bound}"}} {count}'
+            for bound, count in histogram["buckets"]
+        ),
+        f"{name}_sum{suffix} {histogram['sum']}",
+        f"{name}_count{suffix} {histogram['count']}",
+    ]
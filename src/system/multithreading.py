@@ -1,6 +1,7 @@
 """
 Manages multithreading for the project
 """
+import contextvars
 import sys
 import threading
 from time import sleep
@@ -24,12 +25,16 @@ class InterruptibleTask:
 
     def exec(self) -> None:
         """
-        Executes the task
+        Executes the task, in a copy of the current context
         """
-        thread = threading.Thread(target=self.target, args=self.args, daemon=True)
+        context = contextvars.copy_context()
+        thread = threading.Thread(
+            target=context.run, args=(self.target, *self.args), daemon=True
+        )
         thread.start()
         while thread.is_alive():
-            sleep(0.2)
+            # Short timeouts keep the main thread responsive to KeyboardInterrupt
+            thread.join(0.2)
 
 
 class SpinningTask:
@@ -62,9 +67,10 @@ class SpinningTask:
 
     def exec(self) -> None:
         """
-        Execute the target task.
+        Execute the target task, in a copy of the current context.
         """
-        thread = threading.Thread(target=self._task, daemon=True)
+        context = contextvars.copy_context()
+        thread = threading.Thread(target=context.run, args=(self._task,), daemon=True)
         thread.start()
 
         spinner = ("|", "/", "-", "\\")
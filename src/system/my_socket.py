@@ -2,185 +2,236 @@
 Deals with client/server socket objects
 """
 
+import json
+import select
 import socket
-from typing import List, Union
+import struct
+import threading
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import src.containers.exceptions as exc
+from src.system.tracing import current_trace
+
+FRAME_HEADER = struct.Struct("!II")
+MAX_HEADER_SIZE = 1 << 20
+# The stdio of a command, plus the connection of the client when it is handed over
+# to a session worker
+MAX_FDS_PER_FRAME = 4
 
 
 class ClientServerSocket:
     """
     Custom socket object used for interaction between client/server
 
+    Requests and responses are sent as frames. A frame is an 8-byte prefix holding
+    the length of a JSON header and the length of a binary body, followed by the
+    header and the body. Sending a frame is thread-safe, so many requests can share
+    a single connection.
+
+    Over a unix domain socket, open file descriptors may be attached to a frame.
+    Its header then holds the number of descriptors under "fds".
+
     :param _sock: The python socket.socket object
     """
 
     def __init__(self, sock: socket.socket) -> None:
         self._sock = sock
+        self._send_lock = threading.Lock()
+
+    @property
+    def can_pass_fds(self) -> bool:
+        """
+        Whether file descriptors can be attached to frames on this socket
+        """
+        return is_unix_socket(self._sock)
 
     def send(self, data: Union[bytes, str]) -> None:
         """
-        Sends data over the socket
+        Sends raw data over the socket
 
         :param data: The data to be sent over the socket
         """
         if isinstance(data, str):
             data = data.encode()
-        self._sock.send(data)
+        self._sock.sendall(data)
 
     def recv(self, bufsize=1024) -> bytes:
         """
-        Recieves data over the socket
+        Recieves raw data over the socket
 
         :param bufsize: The maximum number of bytes to recieve
         """
         return self._sock.recv(bufsize)
 
-    def recv_expect(
-        self, expected: Union[bytes, List[bytes]], bufsize: int = 1024
+    def send_msg(
+        self,
+        header: Dict[str, Any],
+        body: bytes = b"",
+        fds: Optional[List[int]] = None,
     ) -> None:
         """
-        Recieves data and ensures it has a particular value
-
-        :param expected: The expected value to recieve
-        :param bufsize: The maximum number of bytes to recieve
+        Sends a single frame over the socket
+
+        :param header: The JSON-serializable header of the frame
+        :param body: The binary body of the frame
+        :param fds: File descriptors attached to the frame (unix sockets only)
+        """
+        if fds:
+            header = {**header, "fds": len(fds)}
+        frame = encode_frame(header, body)
+        with self._send_lock:
+            if fds:
+                sent = socket.send_fds(  # pylint: disable=no-member
+                    self._sock, [frame], fds
+                )
+                frame = frame[sent:]
+            self._sock.sendall(frame)
+
+    def recv_msg(self) -> Tuple[Dict[str, Any], bytes]:
+        """
+        Recieves a single frame over the socket
+
+        :return: The header and the body of the frame
+        """
+        header_len, body_len = decode_frame_prefix(
+            self._recv_exactly(FRAME_HEADER.size)
+        )
+        header = json.loads(self._recv_exactly(header_len).decode("utf-8"))
+        body = self._recv_exactly(body_len) if body_len else b""
+        return header, body
+
+    def request(
+        self,
+        op: str,
+        container_name: Optional[str] = None,
+        request_id: Optional[int] = None,
+        fds: Optional[List[int]] = None,
+        **args: Any,
+    ) -> None:
         """
-        msg = self.recv(bufsize)
-
-        if isinstance(expected, bytes):
-            match = msg == expected
-        else:
-            match = msg in expected
-
-        if not match:
-            msg = msg.decode()
-            get_server_error(msg, self)
-
-        return msg
+        Sends a request frame over the socket. The request is tagged with the
+        current trace, if any, so the server's spans are recorded under it.
 
-    def close(self) -> None:
-        """
-        Closes the socket
+        :param op: The operation requested
+        :param container_name: The container the operation applies to, if any
+        :param request_id: The ID the server will tag the response with, if any
+        :param fds: File descriptors handed over to the server (unix sockets only)
+        :param args: The arguments of the operation
         """
-        self._sock.close()
+        header: Dict[str, Any] = {"op": op, "args": args}
+        if container_name is not None:
+            header["container"] = container_name
+        if request_id is not None:
+            header["id"] = request_id
+        if current_trace.get() is not None:
+            header["trace"] = current_trace.get()
+        self.send_msg(header, fds=fds)
 
-    def cont(self) -> None:
-        """
-        Sends CONT over the socket
+    def recv_response(self) -> Dict[str, Any]:
         """
-        self.send(b"CONT")
+        Recieves a response frame and raises the error encoded in it, if any
 
-    def yes(self) -> None:
-        """
-        Sends YES over the socket
+        :return: The header of the response
         """
-        self.send(b"YES")
+        header, _ = self.recv_msg()
+        return check_response(header)
 
-    def no(self) -> None:  # pylint: disable=invalid-name
+    def _recv_exactly(self, size: int) -> bytes:
         """
-        Sends NO over the socket
-        """
-        self.send(b"NO")
+        Recieves exactly size bytes over the socket
 
-    def begin(self) -> None:
-        """
-        Sends BEGIN over the socket
+        :param size: The number of bytes to recieve
         """
-        self.send(b"BEGIN")
+        buffer = bytearray()
+        while len(buffer) < size:
+            chunk = self._sock.recv(size - len(buffer))
+            if not chunk:
+                raise ConnectionError("Connection closed in the middle of a frame")
+            buffer += chunk
+        return bytes(buffer)
 
-    def ok(self) -> None:  # pylint: disable=invalid-name
-        """
-        Sends OK over the socket
+    def readable(self) -> bool:
         """
-        self.send(b"OK")
+        Checks whether data can be recieved without blocking
 
-    def raise_exception(self) -> None:
+        :return: True if data (or EOF) is waiting on the socket
         """
-        Notifies client that an exception occured
-        """
-        self.send(b"EXCEPTION_OCCURED")
+        return bool(select.select([self._sock], [], [], 0)[0])
 
-    def raise_unknown_request(self, request: str) -> None:
+    def close(self) -> None:
         """
-        Notifies client that the server got an unknown request
-
-        :param request: The content of the unknown request
+        Closes the socket
         """
-        self.send(b"UNKNOWN_REQUEST")
-        self.recv()
-        self.send(request)
+        self._sock.close()
 
-    def raise_container_not_started(self, container_name: str) -> None:
-        """
-        Notifies client that a container was not started
 
-        :param container_name: The name of the container not started
-        """
-        self.send(b"CONTAINER_NOT_STARTED")
-        self.recv()
-        self.send(container_name)
+def is_unix_socket(sock: socket.socket) -> bool:
+    """
+    Determines whether a socket is a unix domain socket
 
-    def raise_no_such_container(self, container_name: str) -> None:
-        """
-        Notifies client that a container does not exist
+    :param sock: The socket
+    """
+    return hasattr(socket, "AF_UNIX") and sock.family == socket.AF_UNIX
 
-        :param container_name: The name of the container
-        """
-        self.send(b"NO_SUCH_CONTAINER")
-        self.recv()
-        self.send(container_name)
 
-    def raise_container_started_cannot_modify(self, container_name: str) -> None:
-        """
-        Notifies the client that a container has been started (so cannot be modified)
+def encode_frame(header: Dict[str, Any], body: bytes = b"") -> bytes:
+    """
+    Encodes a frame
 
-        :param container_name: The name of the container
-        """
-        self.send(b"CONTAINER_STARTED_CANNOT_MODIFY")
-        self.recv()
-        self.send(container_name)
+    :param header: The JSON-serializable header of the frame
+    :param body: The binary body of the frame
+    :return: The encoded frame
+    """
+    data = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    return FRAME_HEADER.pack(len(data), len(body)) + data + body
 
-    def raise_boot_error(self) -> None:
-        """
-        Notifies the client that a container failed to boot
-        """
-        self.send(b"BOOT_FAILURE")
 
-    def raise_invalid_path(self, path: str) -> None:
-        """
-        Notifies the client that an invalid path was given to the server
+def decode_frame_prefix(prefix: bytes) -> Tuple[int, int]:
+    """
+    Decodes the fixed-size prefix of a frame
 
-        :param path: The path that was given to the server
-        """
-        self.send(b"INVALID_PATH")
-        self.recv()
-        self.send(path)
+    :param prefix: The first FRAME_HEADER.size bytes of the frame
+    :return: The length of the header and the length of the body
+    """
+    header_len, body_len = FRAME_HEADER.unpack(prefix)
+    if header_len > MAX_HEADER_SIZE:
+        raise ConnectionError(f"Frame header too large ({header_len} bytes)")
+    return header_len, body_len
 
-    def raise_is_a_directory(self, path: str):
-        """
-        Notifies a client that a directory was provided
 
-        :path: The path provided
-        """
-        self.send(b"IS_A_DIRECTORY")
-        self.recv()
-        self.send(path)
+def check_response(header: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Raises the error encoded in a response header, if any
+
+    :param header: The header of the response
+    :return: The header of the response
+    """
+    if header.get("status") == "ERROR":
+        get_server_error(header.get("error", ""), header.get("args", {}))
+    return header
 
 
-def get_server_error(value: str, sock: ClientServerSocket) -> None:
+def get_server_error(value: str, details: Dict[str, str]) -> None:
     """
     Gets the exception related to a server error
+
+    :param value: The error code sent by the server
+    :param details: The details of the error sent by the server
     """
     mapping = {
         "UNKNOWN_REQUEST": exc.UnknownRequestError,
         "CONTAINER_NOT_STARTED": exc.ContainerNotStartedError,
         "NO_SUCH_CONTAINER": exc.UnknownContainerError,
         "CONTAINER_STARTED_CANNOT_MODIFY": exc.ContainerStartedCannotModify,
+        "IMAGE_IN_USE": exc.ImageInUseError,
+        "CLONE_CANNOT_BE_ARCHIVED": exc.CloneCannotBeArchivedError,
         "BOOT_FAILURE": exc.BootFailureError,
         "INVALID_PATH": exc.InvalidPathError,
         "EXCEPTION_OCCURED": exc.ServerError,
         "IS_A_DIRECTORY": exc.SockIsADirectoryError,
+        "NO_SUCH_OPERATION": exc.UnknownOperationError,
+        "OPERATION_CANCELLED": exc.OperationCancelledError,
     }
     if value not in mapping:
         raise ValueError(f"Recieved unknown error from server: {value}")
-    raise mapping[value](sock)
+    raise mapping[value](details)
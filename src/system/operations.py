@@ -0,0 +1,207 @@
+"""
+Tracks the long-running operations of the server (installs, archives, boots and
+file transfers) that clients submitted to run in the background. Clients poll,
+wait for and cancel operations by ID, from any connection.
+"""
+
+import asyncio
+import itertools
+import time
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+# The operation being run, if any. Carried into worker threads along with the rest
+# of the context, so that the blocking work reports its progress to it.
+current_operation: ContextVar[Optional["Operation"]] = ContextVar(
+    "current_operation", default=None
+)
+
+# Seconds finished operations are kept around for clients to collect
+OPERATION_TTL = 600.0
+
+
+class OperationCancelled(Exception):
+    """
+    Raised by the progress reports of an operation once it was cancelled, to cut
+    the work short
+    """
+
+
+class Operation:
+    """
+    A long-running operation. Progress is reported from worker threads, everything
+    else happens on the event loop.
+
+    :param id: The ID of the operation
+    :param op: The request run in the background, as in "INSTALL"
+    :param container: The container the operation applies to, if any
+    :param state: "running", "done", "failed" or "cancelled"
+    :param phase: What the operation is doing, as in "transfer" or "console_login"
+    :param done: Bytes processed so far
+    :param total: Bytes to process in all, 0 if unknown
+    :param error: The error code of the operation, if it failed
+    :param error_args: The details of the error
+    :param cancel_requested: Whether the operation was asked to stop
+    :param finished: Set once the operation is over
+    """
+
+    id: str
+    op: str
+    container: Optional[str]
+    state: str = "running"
+    phase: Optional[str] = None
+    done: int = 0
+    total: int = 0
+    error: Optional[str] = None
+    error_args: Dict[str, Any]
+    cancel_requested: bool = False
+    finished: asyncio.Event
+
+    def __init__(self, operation_id: str, op: str, container: Optional[str]) -> None:
+        self.id = operation_id
+        self.op = op
+        self.container = container
+        self.error_args = {}
+        self.finished = asyncio.Event()
+        self._began = time.monotonic()
+        self._ended: Optional[float] = None
+        self._progress_began: Optional[float] = None
+
+    def progress(self, done: int, total: int) -> None:
+        """
+        Reports the bytes processed so far. Raises OperationCancelled if the
+        operation was cancelled. May be called from any thread.
+
+        :param done: Bytes processed so far
+        :param total: Bytes to process in all, 0 if unknown
+        """
+        if self.cancel_requested:
+            raise OperationCancelled(self.id)
+        if self._progress_began is None:
+            self._progress_began = time.monotonic()
+        self.done, self.total = done, total
+
+    def set_phase(self, phase: str) -> None:
+        """
+        Reports what the operation is doing. Raises OperationCancelled if the
+        operation was cancelled. May be called from any thread.
+
+        :param phase: The phase of the operation
+        """
+        if self.cancel_requested:
+            raise OperationCancelled(self.id)
+        self.phase = phase
+
+    def end(self, error: Optional[str] = None, **error_args: Any) -> None:
+        """
+        Marks the operation as over
+
+        :param error: The error code of the operation, if it failed
+        :param error_args: The details of the error
+        """
+        if self.finished.is_set():
+            return
+        if self.cancel_requested and error is not None:
+            self.state = "cancelled"
+            self.error, self.error_args = "OPERATION_CANCELLED", {
+                "operation_id": self.id
+            }
+        elif error is not None:
+            self.state = "failed"
+            self.error, self.error_args = error, error_args
+        else:
+            self.state = "done"
+        self._ended = time.monotonic()
+        self.finished.set()
+
+    def age(self) -> float:
+        """
+        :return: Seconds since the operation ended, 0 if it is still running
+        """
+        return 0.0 if self._ended is None else time.monotonic() - self._ended
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        :return: The state of the operation, with its throughput ("rate", in bytes
+                 per second) and its duration so far ("elapsed", in seconds)
+        """
+        now = self._ended or time.monotonic()
+        rate = 0.0
+        if self._progress_began is not None and now > self._progress_began:
+            rate = self.done / (now - self._progress_began)
+        snapshot = {
+            "id": self.id,
+            "op": self.op,
+            "container": self.container,
+            "state": self.state,
+            "phase": self.phase,
+            "done": self.done,
+            "total": self.total,
+            "rate": rate,
+            "elapsed": now - self._began,
+        }
+        if self.error is not None:
+            snapshot["error"] = self.error
+            snapshot["error_args"] = self.error_args
+        return snapshot
+
+
+class Operations:
+    """
+    The operations of the server, running or recently finished. Must be used from
+    the event loop.
+
+    :param operations: The operations, by ID
+    """
+
+    operations: Dict[str, Operation]
+
+    def __init__(self) -> None:
+        self.operations = {}
+        self._ids = itertools.count(1)
+
+    def create(self, op: str, container: Optional[str]) -> Operation:
+        """
+        Tracks a new operation, and forgets those that ended OPERATION_TTL ago
+
+        :param op: The request run in the background
+        :param container: The container the operation applies to, if any
+        :return: The operation
+        """
+        for operation_id, operation in list(self.operations.items()):
+            if operation.age() > OPERATION_TTL:
+                del self.operations[operation_id]
+        operation = Operation(f"op-{next(self._ids)}", op, container)
+        self.operations[operation.id] = operation
+        return operation
+
+    def get(self, operation_id: str) -> Optional[Operation]:
+        """
+        :param operation_id: The ID of an operation
+        :return: The operation, or None if there is no such operation
+        """
+        return self.operations.get(operation_id)
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        """
+        :return: The state of every operation, see Operation.snapshot
+        """
+        return [operation.snapshot() for operation in self.operations.values()]
+
+
+def report_progress(done: int, total: int) -> None:
+    """
+    Reports progress to the current operation, if any. See Operation.progress.
+    """
+    operation = current_operation.get()
+    if operation is not None:
+        operation.progress(done, total)
+
+
+def report_phase(phase: str) -> None:
+    """
+    Reports the phase of the current operation, if any. See Operation.set_phase.
+    """
+    operation = current_operation.get()
+    if operation is not None:
+        operation.set_phase(phase)
@@ -0,0 +1,156 @@
+"""
+Profiles the container manager server while it runs
+"""
+
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from os.path import basename
+from pathlib import Path
+from typing import Dict, List, Optional
+
+# Number of entries kept in the text reports
+REPORT_LIMIT = 50
+
+
+class StackSampler:
+    """
+    Samples the stacks of every thread of the process at a fixed interval, from
+    a thread of its own. Unlike cProfile, this sees the worker threads too.
+
+    :param interval: Seconds between samples
+    :param samples: Number of times each stack was seen, keyed by the stack in the
+                    collapsed format of flame graphs ("thread;outer;...;inner")
+    """
+
+    interval: float
+    samples: Counter
+
+    def __init__(self, interval: float = 0.005) -> None:
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="jab-sampler", daemon=True
+        )
+
+    def start(self) -> None:
+        """
+        Starts sampling
+        """
+        self._thread.start()
+
+    def stop(self) -> Counter:
+        """
+        Stops sampling
+
+        :return: The samples
+        """
+        self._stop.set()
+        self._thread.join()
+        return self.samples
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            frames = sys._current_frames()  # pylint: disable=protected-access
+            for ident, frame in frames.items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        f"{code.co_name} ({basename(code.co_filename)}:{frame.f_lineno})"
+                    )
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.samples[";".join(reversed(stack))] += 1
+
+
+def write_cpu_profile(
+    directory: Path, profile: cProfile.Profile, samples: Counter
+) -> List[Path]:
+    """
+    Writes the results of a CPU profile
+
+    :param directory: The directory the results are written to
+    :param profile: cProfile of the event loop thread
+    :param samples: Stack samples of all threads, see StackSampler
+    :return: The files written: the cProfile stats (readable with pstats or
+             snakeviz), a text report, and the collapsed stacks (readable with
+             flamegraph.pl or speedscope)
+    """
+    stem = directory / f"profile-{_timestamp()}"
+    stats_file = stem.with_suffix(".prof")
+    report_file = stem.with_suffix(".txt")
+    stacks_file = stem.with_suffix(".stacks")
+
+    profile.dump_stats(str(stats_file))
+
+    report = io.StringIO()
+    report.write("Event loop thread, by cumulative time:\n")
+    pstats.Stats(profile, stream=report).sort_stats("cumulative").print_stats(
+        REPORT_LIMIT
+    )
+    report.write("All threads, by samples of the innermost frame:\n")
+    innermost: Dict[str, int] = Counter()
+    for stack, count in samples.items():
+        innermost[stack.rsplit(";", 1)[-1]] += count
+    total = sum(samples.values()) or 1
+    for frame, count in innermost.most_common(REPORT_LIMIT):
+        report.write(f"{100 * count / total:6.2f}% {count:>8}  {frame}\n")
+    report_file.write_text(report.getvalue(), encoding="utf-8")
+
+    stacks_file.write_text(
+        "".join(f"{stack} {count}\n" for stack, count in samples.items()),
+        encoding="utf-8",
+    )
+    return [stats_file, report_file, stacks_file]
+
+
+def write_memory_report(
+    directory: Path,
+    snapshot: tracemalloc.Snapshot,
+    baseline: Optional[tracemalloc.Snapshot] = None,
+) -> List[Path]:
+    """
+    Writes the allocations of a tracemalloc snapshot
+
+    :param directory: The directory the report is written to
+    :param snapshot: The snapshot
+    :param baseline: An earlier snapshot, to report what changed since
+    :return: The files written: the report, and the raw snapshot (readable with
+             tracemalloc.Snapshot.load)
+    """
+    stem = directory / f"memory-{_timestamp()}"
+    report_file = stem.with_suffix(".txt")
+    snapshot_file = stem.with_suffix(".tracemalloc")
+
+    snapshot.dump(str(snapshot_file))
+
+    report = io.StringIO()
+    current, peak = tracemalloc.get_traced_memory()
+    report.write(f"Traced memory: {current} bytes (peak: {peak} bytes)\n\n")
+    report.write("Largest allocations, by line:\n")
+    for stat in snapshot.statistics("lineno")[:REPORT_LIMIT]:
+        report.write(f"{stat}\n")
+    if baseline is not None:
+        report.write("\nGrowth since the start of the profile, by line:\n")
+        for stat in snapshot.compare_to(baseline, "lineno")[:REPORT_LIMIT]:
+            report.write(f"{stat}\n")
+    report_file.write_text(report.getvalue(), encoding="utf-8")
+    return [report_file, snapshot_file]
+
+
+def _timestamp() -> str:
+    """
+    :return: The current time, for file names
+    """
+    return time.strftime("%Y%m%d-%H%M%S")
@@ -0,0 +1,113 @@
+"""
+Lets the CLI know the moment the server it launched is listening. The CLI hands
+the write end of a pipe to the server, which writes its server info to the pipe
+once its sockets are listening. If the server dies first, the pipe is closed
+without anything written to it.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from src.system.state import frozen
+
+# Environment variable holding the write end of the pipe, in the server
+READY_ENV = "JAB_READY_FD"
+
+
+def launch_server(cmd: List[str], timeout: float) -> Dict[str, Any]:
+    """
+    Launches the server in the background, and waits for it to be listening
+
+    :param cmd: The command running the server
+    :param timeout: Seconds to wait for the server
+    :return: The server info, as written to server_info.json
+    """
+    read_fd, write_fd = os.pipe()
+    env = dict(os.environ)
+    try:
+        if os.name == "nt":
+            # pylint: disable=import-error,import-outside-toplevel
+            import msvcrt
+
+            handle = msvcrt.get_osfhandle(write_fd)
+            os.set_handle_inheritable(handle, True)
+            env[READY_ENV] = str(handle)
+            startupinfo = subprocess.STARTUPINFO()
+            startupinfo.lpAttributeList = {"handle_list": [handle]}
+            subprocess.Popen(  # pylint: disable=consider-using-with
+                cmd,
+                env=env,
+                startupinfo=startupinfo,
+                creationflags=subprocess.DETACHED_PROCESS,
+            )
+        else:
+            env[READY_ENV] = str(write_fd)
+            subprocess.Popen(  # pylint: disable=consider-using-with
+                cmd,
+                env=env,
+                pass_fds=(write_fd,),
+                start_new_session=True,  # Out of reach of the terminal's Ctrl+C
+            )
+    finally:
+        # Only the server holds the write end now, so the pipe closes if it dies
+        os.close(write_fd)
+
+    with os.fdopen(read_fd, "rb") as pipe:
+        return _read_ready(pipe, timeout)
+
+
+def _read_ready(pipe, timeout: float) -> Dict[str, Any]:
+    """
+    Reads the server info from the pipe, from a thread of its own so that reading
+    can time out on every platform
+
+    :param pipe: The read end of the pipe
+    :param timeout: Seconds to wait for the server
+    :return: The server info
+    """
+    result: List[bytes] = []
+    reader = threading.Thread(target=lambda: result.append(pipe.read()), daemon=True)
+    reader.start()
+    reader.join(timeout)
+    if reader.is_alive():
+        raise TimeoutError("Server took too long to start.")
+    if not result[0]:
+        raise ChildProcessError("Server exited before it started listening.")
+    return json.loads(result[0])
+
+
+def notify_ready(server_info: Dict[str, Any]) -> None:
+    """
+    Tells the CLI that launched the server that it is listening. Does nothing if
+    the server was launched some other way.
+
+    :param server_info: The server info, as written to server_info.json
+    """
+    value: Optional[str] = os.environ.pop(READY_ENV, None)
+    if value is None:
+        return
+    try:
+        if os.name == "nt":
+            import msvcrt  # pylint: disable=import-error,import-outside-toplevel
+
+            fd = msvcrt.open_osfhandle(int(value), 0)
+        else:
+            fd = int(value)
+        with os.fdopen(fd, "wb") as pipe:
+            pipe.write(json.dumps(server_info).encode("utf-8"))
+    except (OSError, ValueError):
+        pass  # The CLI went away; server_info.json is still there
+
+
+def server_command() -> List[str]:
+    """
+    :return: The command running the server, next to the running CLI
+    """
+    if frozen():
+        return [str(Path(sys.executable).parent.parent / "server" / "server")]
+    return [sys.executable, str(Path(__file__).parent.parent.parent / "server.py")]
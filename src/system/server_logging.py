@@ -0,0 +1,175 @@
+"""
+Configures the logging of the container manager server. Records are put on a
+queue by the thread logging them, and written to server.log by a background
+thread, so that request handlers never wait on the disk. Session worker
+processes send their records to the server over a queue of their own.
+"""
+
+import logging
+import multiprocessing
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+# Name of the root logger of the server; subsystems log under it
+LOGGER_NAME = "jab"
+# Subsystems whose level can be set on their own
+SUBSYSTEMS = ("server", "lifecycle", "container", "ssh", "worker", "pool")
+# server.log is rotated once it reaches this size
+LOG_MAX_BYTES = 10 << 20
+# Number of rotated logs kept (server.log.1, server.log.2, ...)
+LOG_BACKUPS = 3
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s [%(threadName)s] %(message)s"
+
+_listener: Optional[QueueListener] = None
+# Records of the session workers, and the thread logging them in the server
+_worker_records: Optional[Any] = None
+_worker_listener: Optional[QueueListener] = None
+
+
+class _QueueHandler(QueueHandler):
+    """
+    Puts records on the queue without formatting them. The message is merged
+    with its arguments, so arguments changed afterwards do not affect it, but
+    timestamps, tracebacks and the rest are formatted by the writer thread.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class _ForwardHandler(logging.Handler):
+    """
+    Logs the records of session workers to the logger of the same name in the
+    server, so that they go through the same levels and handlers
+    """
+
+    def emit(self, record: logging.LogRecord) -> None:
+        logger = logging.getLogger(record.name)
+        if logger.isEnabledFor(record.levelno):
+            logger.handle(record)
+
+
+def parse_levels(spec: str) -> Dict[str, str]:
+    """
+    Parses per-subsystem log levels
+
+    :param spec: Levels as in "ssh=INFO,container=WARNING"
+    :return: The level of each subsystem listed
+    """
+    levels = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        subsystem, _, level = item.partition("=")
+        if subsystem not in SUBSYSTEMS:
+            raise ValueError(f"Unknown subsystem '{subsystem}'")
+        levels[subsystem] = level.upper()
+    return levels
+
+
+def start_server_logging(
+    log_file: Path,
+    level: str = "DEBUG",
+    levels: Optional[Dict[str, str]] = None,
+    max_bytes: int = LOG_MAX_BYTES,
+) -> logging.Logger:
+    """
+    Starts writing the logs of the server. The log of the previous run is kept as
+    server.log.1.
+
+    :param log_file: The path to server.log
+    :param level: The level of every subsystem not given in levels
+    :param levels: The level of each subsystem, see SUBSYSTEMS
+    :param max_bytes: The size at which the log is rotated
+    :return: The logger of the server
+    """
+    global _listener  # pylint: disable=global-statement
+
+    file_handler = RotatingFileHandler(
+        log_file, maxBytes=max_bytes, backupCount=LOG_BACKUPS, encoding="utf-8"
+    )
+    if log_file.stat().st_size:
+        file_handler.doRollover()
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    records: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    _listener = QueueListener(records, file_handler)
+    _listener.start()
+
+    root = logging.getLogger(LOGGER_NAME)
+    root.setLevel(level.upper())
+    root.addHandler(_QueueHandler(records))
+    root.propagate = False
+    for subsystem, subsystem_level in (levels or {}).items():
+        logging.getLogger(f"{LOGGER_NAME}.{subsystem}").setLevel(subsystem_level)
+
+    return logging.getLogger(f"{LOGGER_NAME}.server")
+
+
+def worker_logging() -> Optional[Dict[str, Any]]:
+    """
+    Gets what a session worker needs to log to server.log, see
+    start_worker_logging. The queue of the workers is created on first use.
+
+    :return: The queue and the levels of the server, or None if the server does
+             not log
+    """
+    global _worker_records, _worker_listener  # pylint: disable=global-statement
+    if _listener is None:
+        return None
+    if _worker_records is None:
+        _worker_records = multiprocessing.get_context("spawn").Queue()
+        _worker_listener = QueueListener(_worker_records, _ForwardHandler())
+        _worker_listener.start()
+
+    levels = {LOGGER_NAME: logging.getLogger(LOGGER_NAME).level}
+    for subsystem in SUBSYSTEMS:
+        name = f"{LOGGER_NAME}.{subsystem}"
+        if logging.getLogger(name).level:
+            levels[name] = logging.getLogger(name).level
+    return {"queue": _worker_records, "levels": levels}
+
+
+def start_worker_logging(config: Optional[Dict[str, Any]]) -> None:
+    """
+    Sends the records of a session worker process to the server
+
+    :param config: See worker_logging
+    """
+    if config is None:
+        return
+    root = logging.getLogger(LOGGER_NAME)
+    # Formatted in the worker, as tracebacks cannot be sent to the server as is
+    root.addHandler(QueueHandler(config["queue"]))
+    root.propagate = False
+    for name, level in config["levels"].items():
+        logging.getLogger(name).setLevel(level)
+
+
+def stop_server_logging() -> None:
+    """
+    Writes the records still queued, and stops the writer thread
+    """
+    global _listener, _worker_records  # pylint: disable=global-statement
+    global _worker_listener  # pylint: disable=global-statement
+    if _worker_listener is not None:
+        _worker_listener.stop()
+        _worker_listener = None
+        _worker_records = None
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def subsystem_logger(logger: logging.Logger, subsystem: str) -> logging.Logger:
+    """
+    Gets the logger of a subsystem, next to the given logger under the same root.
+    For instance, the "ssh" subsystem of the "jab.server" logger is "jab.ssh".
+
+    :param logger: A logger of the server
+    :param subsystem: The subsystem, see SUBSYSTEMS
+    :return: The logger of the subsystem
+    """
+    return logging.getLogger(f"{logger.name.partition('.')[0]}.{subsystem}")
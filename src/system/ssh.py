@@ -6,21 +6,27 @@ import logging
 import os
 import shlex
 import signal
+import socket
 import time
 from os.path import basename, isdir
 from os.path import join as joindir
+from pathlib import Path
 from posixpath import basename as posixbasename
 from posixpath import join as posixjoin
-from stat import S_ISDIR
-from typing import Optional, Tuple
+from stat import S_ISDIR, S_ISREG
+from typing import BinaryIO, Callable, Optional, Tuple
 
 import paramiko
 import psutil
 from paramiko.channel import ChannelFile, ChannelStderrFile, ChannelStdinFile
 
-from src.containers.exceptions import (FailedToAuthorizeKeyError,
-                                       PoweroffTimeoutExceededError)
+from src.containers.exceptions import (
+    FailedToAuthorizeKeyError,
+    PoweroffTimeoutExceededError,
+)
 from src.system import syspath
+from src.system.server_logging import subsystem_logger
+from src.system.tracing import span
 
 
 class SSHInterface:
@@ -33,6 +39,7 @@ class SSHInterface:
     :param passwd: The password for the SSH user
     :param container_name: The name of the container
     :param logger: The logger used for logging
+    :param key_dir: The folder the keys of the container are written to
     :param ssh_client: The SSH client
     :param ftp_client: The client for file transfer
     """
@@ -43,6 +50,7 @@ class SSHInterface:
     passwd: str
     container_name: str
     logger: logging.Logger
+    key_dir: Path
     ssh_client: Optional[paramiko.SSHClient] = None
     ftp_client: Optional[paramiko.SFTPClient] = None
 
@@ -54,13 +62,15 @@ class SSHInterface:
         passwd: str,
         container_name: str,
         logger: logging.Logger,
+        key_dir: Optional[Path] = None,
     ):
         self.host = host
         self.user = user
         self.port = port
         self.passwd = passwd
         self.container_name = container_name
-        self.logger = logger
+        self.logger = subsystem_logger(logger, "ssh")
+        self.key_dir = key_dir or syspath.get_container_dir(container_name)
 
     def open_all(self) -> None:
         """
@@ -71,39 +81,91 @@ class SSHInterface:
         self.ssh_client.connect(
             hostname=self.host, username=self.user, port=self.port, password=self.passwd
         )
+        # Requests on the connection are small and answered right away, so Nagle's
+        # algorithm would hold each one back until the previous one is acked
+        self.ssh_client.get_transport().sock.setsockopt(
+            socket.IPPROTO_TCP, socket.TCP_NODELAY, 1
+        )
         self.ftp_client = self.ssh_client.open_sftp()
 
-    def put(self, local_file_path: str, remote_file_path: str) -> None:
+    def put(
+        self,
+        local_file_path: str,
+        remote_file_path: str,
+        callback: Optional[Callable[[int, int], None]] = None,
+    ) -> None:
         """
         Puts a file into SSH
         Will raise a FileNotFoundError, IsADirectoryError
 
         :param local_file_path: The local file to be inserted
         :param remote_file_path: The remote path in SSH
+        :param callback: Called with the bytes transferred so far and the total
         """
         if isdir(local_file_path):
             raise IsADirectoryError(local_file_path)
 
-        # If destination is a directory, put file with basename(local) in said directory
+        remote_file_path = self._put_destination(local_file_path, remote_file_path)
+
+        # Attempt put
+        self.logger.debug("Attempting put(%s, %s)", local_file_path, remote_file_path)
+        with span("sftp_put", container=self.container_name, path=remote_file_path):
+            self.ftp_client.put(local_file_path, remote_file_path, callback=callback)
+
+    def putfo(
+        self,
+        fileobj: BinaryIO,
+        local_file_path: str,
+        remote_file_path: str,
+        callback: Optional[Callable[[int, int], None]] = None,
+    ) -> None:
+        """
+        Puts the contents of an open file into SSH
+
+        :param fileobj: The open local file
+        :param local_file_path: The path of the local file, used to name the remote
+                                file if remote_file_path is a directory
+        :param remote_file_path: The remote path in SSH
+        :param callback: Called with the bytes transferred so far and the total
+        """
+        remote_file_path = self._put_destination(local_file_path, remote_file_path)
+        self.logger.debug("Attempting putfo(%s, %s)", local_file_path, remote_file_path)
+        with span("sftp_put", container=self.container_name, path=remote_file_path):
+            self.ftp_client.putfo(
+                fileobj,
+                remote_file_path,
+                file_size=_file_size(fileobj),
+                callback=callback,
+            )
+
+    def _put_destination(self, local_file_path: str, remote_file_path: str) -> str:
+        """
+        If destination is a directory, put file with basename(local) in said directory
+
+        :param local_file_path: The local file to be inserted
+        :param remote_file_path: The remote path in SSH
+        :return: The remote path of the file
+        """
         try:
             if S_ISDIR(self.ftp_client.lstat(remote_file_path).st_mode):
-                remote_file_path = posixjoin(
-                    remote_file_path, basename(local_file_path)
-                )
+                return posixjoin(remote_file_path, basename(local_file_path))
         except FileNotFoundError:
             pass
+        return remote_file_path
 
-        # Attempt put
-        self.logger.debug(f"Attempting put({local_file_path}, {remote_file_path})")
-        self.ftp_client.put(local_file_path, remote_file_path)
-
-    def get(self, remote_file_path: str, local_file_path: str) -> None:
+    def get(
+        self,
+        remote_file_path: str,
+        local_file_path: str,
+        callback: Optional[Callable[[int, int], None]] = None,
+    ) -> None:
         """
         Gets a file from the SSH
         Raises IsADirectoryError, FileNotFoundError
 
         :param remote_file_path: The path to file in the SSH machine
         :param local_file_path: The path to the local file
+        :param callback: Called with the bytes transferred so far and the total
         """
         if isdir(local_file_path):
             local_file_path = joindir(local_file_path, posixbasename(remote_file_path))
@@ -111,9 +173,31 @@ class SSHInterface:
         if S_ISDIR(self.ftp_client.lstat(remote_file_path).st_mode):
             raise IsADirectoryError(remote_file_path)
 
-        self.logger.debug(f"Attempting get({local_file_path}, {remote_file_path})")
+        self.logger.debug("Attempting get(%s, %s)", local_file_path, remote_file_path)
 
-        self.ftp_client.get(remote_file_path, local_file_path)
+        with span("sftp_get", container=self.container_name, path=remote_file_path):
+            self.ftp_client.get(remote_file_path, local_file_path, callback=callback)
+
+    def getfo(
+        self,
+        remote_file_path: str,
+        fileobj: BinaryIO,
+        callback: Optional[Callable[[int, int], None]] = None,
+    ) -> None:
+        """
+        Gets a file from the SSH into an open file
+        Raises IsADirectoryError, FileNotFoundError
+
+        :param remote_file_path: The path to file in the SSH machine
+        :param fileobj: The open local file
+        :param callback: Called with the bytes transferred so far and the total
+        """
+        if S_ISDIR(self.ftp_client.lstat(remote_file_path).st_mode):
+            raise IsADirectoryError(remote_file_path)
+
+        self.logger.debug("Attempting getfo(%s)", remote_file_path)
+        with span("sftp_get", container=self.container_name, path=remote_file_path):
+            self.ftp_client.getfo(remote_file_path, fileobj, callback=callback)
 
     def exec_ssh_command(
         self, cli: list
@@ -124,9 +208,19 @@ class SSHInterface:
         :param cli: The command run in the SSH as an array
         """
         command = "echo $$ && exec " + " ".join(map(shlex.quote, cli))
-        self.logger.debug(f'Exec "{command}" -> {self.container_name}')
-        stdin, stdout, stderr = self.ssh_client.exec_command(command)
-        pid = int(stdout.readline())
+        self.logger.debug('Exec "%s" -> %s', command, self.container_name)
+        with span("ssh_exec", container=self.container_name, command=cli[0]):
+            stdin, stdout, stderr = self.ssh_client.exec_command(command)
+
+            # Read the PID straight from the channel, so that none of the command's
+            # output is left behind in the buffer of the stdout file object
+            pid_line = b""
+            while not pid_line.endswith(b"\n"):
+                byte = stdout.channel.recv(1)
+                if not byte:
+                    break
+                pid_line += byte
+        pid = int(pid_line)
         return stdin, stdout, stderr, pid
 
     def send_poweroff(self, pid: int) -> None:
@@ -135,19 +229,20 @@ class SSHInterface:
         """
         self.logger.debug("Attempting to poweroff")
 
-        _, stdout, _ = self.ssh_client.exec_command("poweroff")
-        stdout.channel.recv_exit_status()
+        with span("poweroff", container=self.container_name):
+            _, stdout, _ = self.ssh_client.exec_command("poweroff")
+            stdout.channel.recv_exit_status()
 
-        for _ in range(15):  # Max timeout: 15 seconds
-            if psutil.pid_exists(pid):
-                if os.name != "nt" and psutil.Process(pid).status() == "zombie":
-                    os.kill(pid, signal.SIGKILL)
+            for _ in range(15):  # Max timeout: 15 seconds
+                if psutil.pid_exists(pid):
+                    if os.name != "nt" and psutil.Process(pid).status() == "zombie":
+                        os.kill(pid, signal.SIGKILL)
+                        break
+                    time.sleep(1)
+                else:
                     break
-                time.sleep(1)
             else:
-                break
-        else:
-            raise PoweroffTimeoutExceededError(f"PID={pid}")
+                raise PoweroffTimeoutExceededError(f"PID={pid}")
 
     def close_all(self) -> None:
         """
@@ -165,23 +260,35 @@ class SSHInterface:
         if not self.ssh_client:
             raise OSError("ssh client not opened")
 
-        if syspath.get_container_id_rsa(self.container_name).is_file():
-            os.remove(syspath.get_container_id_rsa(self.container_name))
-        if syspath.get_get_container_id_rsa_pub(self.container_name).is_file():
-            os.remove(syspath.get_get_container_id_rsa_pub(self.container_name))
-
-        key = paramiko.RSAKey.generate(2048)
-        key.write_private_key_file(syspath.get_container_id_rsa(self.container_name))
-        with open(
-            syspath.get_get_container_id_rsa_pub(self.container_name),
-            "w",
-            encoding="utf-8",
-        ) as pub:
-            pub.write(f"ssh-rsa {key.get_base64()}\n")
-
-        _, stdout, _ = self.ssh_client.exec_command(
-            f'echo "ssh-rsa {key.get_base64()}" > $HOME/.ssh/authorized_keys'
-        )
+        private_key, public_key = self.key_dir / "id_rsa", self.key_dir / "id_rsa.pub"
+        if private_key.is_file():
+            os.remove(private_key)
+        if public_key.is_file():
+            os.remove(public_key)
+
+        with span("generate_key", container=self.container_name):
+            key = paramiko.RSAKey.generate(2048)
+            key.write_private_key_file(str(private_key))
+            with open(public_key, "w", encoding="utf-8") as pub:
+                pub.write(f"ssh-rsa {key.get_base64()}\n")
+
+        with span("authorize_key", container=self.container_name):
+            _, stdout, _ = self.ssh_client.exec_command(
+                f'echo "ssh-rsa {key.get_base64()}" > $HOME/.ssh/authorized_keys'
+            )
+            status = stdout.channel.recv_exit_status()
 
-        if stdout.channel.recv_exit_status():
+        if status:
             raise FailedToAuthorizeKeyError(stdout.channel.exit_status)
+
+
+def _file_size(fileobj: BinaryIO) -> int:
+    """
+    :param fileobj: An open file
+    :return: The size of the file, or 0 if it is not a regular file
+    """
+    try:
+        stat = os.fstat(fileobj.fileno())
+    except (AttributeError, OSError, ValueError):
+        return 0
+    return stat.st_size if S_ISREG(stat.st_mode) else 0
@@ -58,6 +58,15 @@ def get_server_info_file() -> Path:
     return get_container_home() / "server_info.json"
 
 
+def get_server_socket_file() -> Path:
+    """
+    Returns the path to the server's unix domain socket
+
+    :return: The path to the server's unix domain socket
+    """
+    return get_container_home() / "server.sock"
+
+
 def get_server_log_file() -> Path:
     """
     Returns the path to the server log file
@@ -67,6 +76,24 @@ def get_server_log_file() -> Path:
     return get_container_home() / "server.log"
 
 
+def get_pool_file() -> Path:
+    """
+    Returns the path to the warm pool json file
+
+    :return: The path to the json holding the size of the warm pool of each image
+    """
+    return get_container_home() / "pool.json"
+
+
+def get_pool_dir() -> Path:
+    """
+    Returns the path to the folder of the warm pool
+
+    :return: The folder holding the containers booted ahead of time
+    """
+    return get_container_home() / ".pool"
+
+
 def get_repo_file() -> Path:
     """
     Returns the path to the repo json file
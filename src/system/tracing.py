@@ -0,0 +1,157 @@
+"""
+Records spans of work, tagged with the ID of the request they belong to, and
+exports them in the Chrome trace event format (chrome://tracing, Perfetto)
+"""
+
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Deque, Dict, Iterator, List, Optional
+
+# The ID of the request being handled. Set by the server for every request, and
+# carried into worker threads along with the rest of the context.
+current_trace: ContextVar[Optional[str]] = ContextVar("current_trace", default=None)
+
+# Number of spans kept in memory; older spans are dropped
+MAX_SPANS = 100_000
+
+
+def new_trace_id() -> str:
+    """
+    :return: A new, random trace ID
+    """
+    return uuid.uuid4().hex[:16]
+
+
+class Tracer:
+    """
+    Keeps the most recent spans of the process, as Chrome "complete" events.
+    Timestamps are wall-clock times, so that the spans of the client and of the
+    server line up. When exported, each trace gets a lane (tid) of its own, so the
+    spans of a request nest properly even though requests are served concurrently.
+
+    :param process_name: The name of the process in exported traces
+    :param spans: The most recent spans
+    """
+
+    process_name: str
+    spans: Deque[Dict[str, Any]]
+
+    def __init__(self, process_name: str) -> None:
+        self.process_name = process_name
+        self.spans = deque(maxlen=MAX_SPANS)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str, **args: Any) -> Iterator[None]:
+        """
+        Records the time taken by the body of the with statement, under the
+        current trace
+
+        :param name: The name of the span
+        :param args: Details shown along with the span
+        """
+        trace_id = current_trace.get()
+        began = time.time()
+        counter = time.perf_counter()
+        try:
+            yield
+        finally:
+            event = {
+                "name": name,
+                "ph": "X",
+                "ts": began * 1e6,
+                "dur": (time.perf_counter() - counter) * 1e6,
+                "pid": os.getpid(),
+                "args": {
+                    **{key: str(value) for key, value in args.items()},
+                    "trace": trace_id,
+                    "thread": threading.current_thread().name,
+                },
+            }
+            with self._lock:
+                self.spans.append(event)
+
+    def export(self, trace_id: Optional[str] = None, limit: int = 2000) -> List[Dict]:
+        """
+        Exports spans as Chrome trace events, along with the metadata naming the
+        process and the lanes
+
+        :param trace_id: Only export the spans of this trace, if given
+        :param limit: Maximum number of spans exported, the most recent first
+        :return: The trace events
+        """
+        with self._lock:
+            spans = [
+                span
+                for span in self.spans
+                if trace_id is None or span["args"]["trace"] == trace_id
+            ][-limit:]
+
+        pid = os.getpid()
+        events = [
+            {
+                "name": "process_name",
+                "ph": "M",
+                "pid": pid,
+                "args": {"name": self.process_name},
+            }
+        ]
+        lanes: Dict[Optional[str], int] = {}
+        for span in spans:
+            trace = span["args"]["trace"]
+            if trace not in lanes:
+                lanes[trace] = len(lanes) + 1
+                events.append(
+                    {
+                        "name": "thread_name",
+                        "ph": "M",
+                        "pid": pid,
+                        "tid": lanes[trace],
+                        "args": {"name": f"trace {trace}" if trace else "untraced"},
+                    }
+                )
+            events.append({**span, "tid": lanes[trace]})
+        return events
+
+
+def chrome_trace(events: List[Dict]) -> Dict[str, Any]:
+    """
+    Wraps trace events into a document that trace viewers can load
+
+    :param events: Trace events, possibly from several processes
+    :return: The JSON-serializable document
+    """
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+tracer = Tracer("jabberwocky client")
+
+
+def span(name: str, **args: Any):
+    """
+    Records a span on the tracer of the process. See Tracer.span.
+    """
+    return tracer.span(name, **args)
+
+
+@contextmanager
+def traced(name: str, **args: Any) -> Iterator[None]:
+    """
+    Records a span on the tracer of the process, under the current trace, or under
+    a new trace if there is none. Requests sent to the server from within carry
+    the trace.
+
+    :param name: The name of the span
+    :param args: Details shown along with the span
+    """
+    token = current_trace.set(current_trace.get() or new_trace_id())
+    try:
+        with tracer.span(name, **args):
+            yield
+    finally:
+        current_trace.reset(token)
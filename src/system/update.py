@@ -7,8 +7,7 @@ import re
 import subprocess
 import sys
 import tempfile
-from distutils.version import \
-    StrictVersion  # pylint: disable=deprecated-module
+from distutils.version import StrictVersion  # pylint: disable=deprecated-module
 from pathlib import Path
 from platform import machine
 from sys import platform